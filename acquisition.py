@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+智慧飲水系統 - 取樣 / 顯示 / 寫入執行緒
+
+感測迴圈拆成生產者 / 消費者：
+    Sampler          依排程讀 HX711，放進有界佇列（不受 LCD、SQLite 拖慢）
+    AdaptiveRate     依杯墊活動調整取樣週期與每次讀取筆數（閒置降頻、拿起時加速）
+    LatestValueWorker LCD 更新：只保留最新一筆，來不及就直接跳過舊畫面
+    TaskWorker       資料庫 / 檔案寫入：依序執行，不丟棄任何工作
+LoopStats 記錄實際取樣週期與延遲，用來確認 I/O 卡住時取樣仍然準時。
+"""
+
+import math
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Optional
+
+import metrics
+
+SAMPLE_QUEUE_SIZE = 32   # 取樣佇列長度（約 10 秒的樣本）
+STATS_WINDOW = 256       # 週期統計使用最近幾筆
+
+# 取樣週期附近切細一點，才看得出 0.3 秒預算的偏差
+PERIOD_BUCKETS = (0.1, 0.2, 0.25, 0.28, 0.29, 0.3, 0.31, 0.32, 0.35, 0.4, 0.5, 1.0, 2.0)
+LOOP_PERIOD_SECONDS = metrics.histogram(
+    'hydration_loop_period_seconds', '實際取樣週期', ['coaster'], PERIOD_BUCKETS)
+LOOP_LATENESS_SECONDS = metrics.histogram(
+    'hydration_loop_lateness_seconds', '取樣相對排程的延遲', ['coaster'])
+LOOP_JITTER_SECONDS = metrics.gauge(
+    'hydration_loop_jitter_seconds', '最近取樣週期的標準差', ['coaster'])
+SAMPLE_PERIOD_SECONDS = metrics.gauge(
+    'hydration_sample_period_seconds', '目前排程的取樣週期（自適應取樣）', ['coaster'])
+
+
+class LoopStats:
+    """取樣週期與排程延遲統計（最近 STATS_WINDOW 筆）"""
+
+    def __init__(self, period: float, window: int = STATS_WINDOW, label: str = None):
+        self.period = period
+        self.label = label
+        self._periods = deque(maxlen=window)
+        self._lateness = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._last_start = None
+        self.samples = 0
+        self.late = 0        # 延遲超過半個週期的次數
+        self.overruns = 0    # 佇列滿了而丟棄的樣本數
+
+    def record(self, scheduled: float, started: float):
+        lateness = max(0.0, started - scheduled)
+        label = self.label or ''
+        LOOP_LATENESS_SECONDS.observe(lateness, label)
+        with self._lock:
+            if self._last_start is not None:
+                LOOP_PERIOD_SECONDS.observe(started - self._last_start, label)
+                self._periods.append(started - self._last_start)
+            self._last_start = started
+            self._lateness.append(lateness)
+            self.samples += 1
+            if lateness > self.period / 2:
+                self.late += 1
+
+    def set_period(self, period: float):
+        """排程週期改變（自適應取樣換檔）：清掉舊週期的統計，抖動只算同一個週期的樣本"""
+        with self._lock:
+            self.period = period
+            self._periods.clear()
+
+    def snapshot(self) -> Dict:
+        """目前統計值（毫秒）"""
+        with self._lock:
+            periods = list(self._periods)
+            lateness = list(self._lateness)
+            samples, late, overruns = self.samples, self.late, self.overruns
+        if periods:
+            mean = sum(periods) / len(periods)
+            jitter = math.sqrt(sum((p - mean) ** 2 for p in periods) / len(periods))
+        else:
+            mean = jitter = 0.0
+        if self.label is not None:
+            LOOP_JITTER_SECONDS.set(jitter, self.label)
+        return {
+            'samples': samples,
+            'period_ms': mean * 1000,
+            'jitter_ms': jitter * 1000,
+            'max_late_ms': max(lateness, default=0.0) * 1000,
+            'late': late,
+            'overruns': overruns,
+        }
+
+
+class AdaptiveRate:
+    """自適應取樣排程：steps 為由快到慢的 (週期秒, 每次讀取筆數)
+
+    observe() 由消費者在每筆樣本處理後呼叫：拿起或重量不穩時立刻跳到最快的一級；
+    持續穩定 hold[i] 秒後才退到下一級，一路退回最慢的閒置級。
+    取樣執行緒只讀取 period / reads（單一屬性讀寫，不需要鎖）。
+    """
+
+    def __init__(self, steps, hold, label: str = None):
+        if len(hold) != len(steps) - 1:
+            raise ValueError("hold 的長度必須比 steps 少一")
+        self.steps = tuple(steps)
+        self.hold = tuple(hold)
+        self.label = label
+        self.level = 0
+        self.changes = 0
+        self._quiet_since = None
+        self._apply(len(self.steps) - 1)
+
+    def _apply(self, level: int):
+        if level != self.level:
+            self.changes += 1
+        self.level = level
+        self.period, self.reads = self.steps[level]
+        if self.label is not None:
+            SAMPLE_PERIOD_SECONDS.set(self.period, self.label)
+
+    def observe(self, ts: float, active: bool):
+        """回報最新樣本的狀態（active：拿起中、重量變化或視窗未穩定）"""
+        if active:
+            self._quiet_since = None
+            if self.level != 0:
+                self._apply(0)
+            return
+        if self._quiet_since is None:
+            self._quiet_since = ts
+        elif self.level < len(self.hold) and ts - self._quiet_since >= self.hold[self.level]:
+            # 每退一級重新計時，週期逐級拉長
+            self._quiet_since = ts
+            self._apply(self.level + 1)
+
+
+class Sampler(threading.Thread):
+    """取樣執行緒
+
+    read() 回傳一筆重量（g）；樣本以 (tag, 時間戳記, 重量) 放入 self.queue。
+    period 可以是固定秒數，或 AdaptiveRate（每輪重新讀取週期，並以 read(reads) 指定讀取筆數）。
+    多個杯墊時可傳入同一個 out 佇列，由 tag 分辨是哪個杯墊的樣本。
+    realtime=False（重播模式）時以 sleep() 推進虛擬時鐘、佇列滿了就等待，不丟樣本。
+    讀取拋出例外時把例外放在 self.error，並送出 None 通知消費者結束。
+    """
+
+    def __init__(self, read: Callable[..., float], period,
+                 timestamp: Callable[[], float] = time.time,
+                 monotonic: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep,
+                 realtime: bool = True, queue_size: int = SAMPLE_QUEUE_SIZE,
+                 out: queue.Queue = None, tag=None):
+        super().__init__(name=f'hx711-sampler-{tag}' if tag is not None else 'hx711-sampler', daemon=True)
+        self.read = read
+        self.rate = period if isinstance(period, AdaptiveRate) else None
+        self.period = period if self.rate is None else self.rate.period
+        self.timestamp = timestamp
+        self.monotonic = monotonic
+        self.sleep = sleep
+        self.realtime = realtime
+        self.queue = out if out is not None else queue.Queue(maxsize=queue_size)
+        self.tag = tag
+        self.stats = LoopStats(self.period, label=str(tag) if tag is not None else 'main')
+        self.error: Optional[BaseException] = None
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        next_t = self.monotonic()
+        try:
+            while not self._stop_event.is_set():
+                started = self.monotonic()
+                self.stats.record(next_t, started)
+                if self.rate is not None:
+                    value = self.read(self.rate.reads)
+                else:
+                    value = self.read()
+                self._put((self.tag, self.timestamp(), value))
+
+                if self.rate is not None and self.rate.period != self.period:
+                    # 換檔：下一筆起改用新週期，LoopStats 的延遲門檻與週期統計也跟著換
+                    self.period = self.rate.period
+                    self.stats.set_period(self.period)
+                next_t += self.period
+                delay = next_t - self.monotonic()
+                if delay > 0:
+                    self.sleep(delay)
+                elif -delay > self.period:
+                    # 落後超過一個週期：重新對齊排程，不要連續補讀
+                    next_t = self.monotonic()
+        except BaseException as e:
+            self.error = e
+        finally:
+            self._put(None, force=True)
+
+    def _put(self, item, force: bool = False):
+        if not self.realtime or force:
+            while True:
+                try:
+                    self.queue.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    if self._stop_event.is_set() and not force:
+                        return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.stats.overruns += 1
+
+
+class LatestValueWorker(threading.Thread):
+    """只處理最新一筆資料的背景執行緒（例如 LCD 更新）
+
+    idle 為選用的 callable：每次處理完（或等到時間）後在同一條執行緒呼叫，
+    回傳幾秒後要再呼叫一次，None 表示等到下一筆資料（例如送出被節流保留的 LCD 畫面）。
+    """
+
+    def __init__(self, fn: Callable, name: str = 'latest-worker',
+                 idle: Callable[[], Optional[float]] = None):
+        super().__init__(name=name, daemon=True)
+        self.fn = fn
+        self.idle = idle
+        self._cond = threading.Condition()
+        self._pending = None
+        self._stopping = False
+        self.skipped = 0
+        self.errors = 0
+
+    def submit(self, *args, **kwargs):
+        with self._cond:
+            if self._pending is not None:
+                self.skipped += 1
+            self._pending = (args, kwargs)
+            self._cond.notify()
+
+    def stop(self, timeout: float = 2.0):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self.join(timeout)
+
+    def run(self):
+        wait = None
+        while True:
+            with self._cond:
+                if self._pending is None and not self._stopping:
+                    self._cond.wait(wait)
+                if self._pending is None and self._stopping:
+                    return
+                task, self._pending = self._pending, None
+            try:
+                if task is not None:
+                    args, kwargs = task
+                    self.fn(*args, **kwargs)
+                wait = self.idle() if self.idle is not None else None
+            except Exception as e:
+                self.errors += 1
+                wait = None
+                print(f"{self.name} 執行失敗: {e}")
+
+
+class TaskWorker(threading.Thread):
+    """依序執行工作的背景執行緒（資料庫、檔案寫入）；停止時會先做完所有工作"""
+
+    def __init__(self, name: str = 'task-worker'):
+        super().__init__(name=name, daemon=True)
+        self.queue = queue.Queue()
+        self.errors = 0
+
+    def submit(self, fn: Callable, *args, **kwargs):
+        self.queue.put((fn, args, kwargs))
+
+    def pending(self) -> int:
+        return self.queue.qsize()
+
+    def stop(self, timeout: float = 10.0):
+        self.queue.put(None)
+        self.join(timeout)
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            fn, args, kwargs = task
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                self.errors += 1
+                print(f"{self.name} 執行失敗: {e}")
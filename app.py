@@ -4,11 +4,24 @@
 智慧飲水系統 - Flask Web 應用
 """
 
-from flask import Flask, render_template, request, jsonify, redirect, url_for
-from werkzeug.utils import secure_filename
+from flask import Flask, Response, abort, g, render_template, request, jsonify, redirect, send_from_directory, url_for
+import hmac
+import io
+import json
 import os
-from datetime import datetime
+import queue
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
 import database as db
+import history_io
+import metrics
+import thumbnails
+import reminders
+import weight_trace
+from broadcaster import StatusBroadcaster
+from live_status import LiveStatusReader
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
@@ -17,8 +30,55 @@ app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # 5MB
 # 確保上傳資料夾存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# 初始化資料庫
-db.init_database()
+# 初始化資料庫：每個行程在第一個請求前做一次（不在 import 時做，多 worker 的 WSGI server 也安全）
+_db_ready = False
+_db_lock = threading.Lock()
+
+def init_app_database():
+    """初始化資料庫（每個行程只做一次）"""
+    global _db_ready
+    if _db_ready:
+        return
+    with _db_lock:
+        if not _db_ready:
+            db.init_database()
+            if HUB_MODE:
+                _start_reminders()
+            _db_ready = True
+
+@app.before_request
+def _ensure_database():
+    init_app_database()
+
+# main.py 發佈的即時狀態（共享記憶體）
+live_status = LiveStatusReader()
+
+# SSE 推播：單一 producer 扇出給所有開啟的頁面
+broadcaster = StatusBroadcaster(lambda: live_status.read() or db.get_current_status())
+SSE_HEARTBEAT_SEC = 15
+
+# ========== 效能量測 ==========
+
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    'hydration_http_request_seconds', 'Flask 路由的處理時間', ['route', 'method', 'status'])
+
+@app.before_request
+def _start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def _record_latency(response):
+    start = g.get('request_start')
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, route, request.method, str(response.status_code))
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus 文字格式的效能量測（包含 main.py 寫出的快照）"""
+    text = metrics.render({'web': metrics.snapshot(), 'sensor': metrics.read_snapshot()})
+    return Response(text, mimetype='text/plain; version=0.0.4')
 
 # ========== 網頁路由 ==========
 
@@ -44,36 +104,128 @@ def settings():
 
 # ========== API 路由 ==========
 
+# --- 條件式 GET（ETag） ---
+
+MEDIA_MAX_AGE = 365 * 86400  # /media 檔名含內容雜湊，內容不會變
+
+def _today() -> str:
+    return datetime.now().strftime('%Y-%m-%d')
+
+def _drinks_version(last_date: str, versions) -> str:
+    """飲水資料的版本：只含過去日期時用 'history'（匯入、hub 上傳、封存或重建彙總時才改變），
+    含今天時用 'drinks'"""
+    if last_date < _today():
+        return 'h%s' % versions.get('history', 0)
+    return 'd%s' % versions.get('drinks', 0)
+
+def _conditional(etag: str, build, max_age: int = None):
+    """If-None-Match 相符時直接回 304，不執行查詢與序列化；否則呼叫 build() 並加上 ETag"""
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = build()
+    response.set_etag(etag, weak=True)
+    if max_age:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    else:
+        # 可以快取，但每次都要帶 ETag 回來確認
+        response.cache_control.no_cache = True
+    return response
+
 # --- 即時狀態 ---
 
 @app.route('/api/status')
 def api_status():
     """取得即時狀態"""
     try:
-        status = db.get_current_status()
-        bottle = db.get_active_bottle()
-        settings = db.get_all_settings()
-        
-        return jsonify({
-            'success': True,
-            'status': status,
-            'bottle': bottle,
-            'settings': settings
-        })
+        # 優先讀共享記憶體；main.py 未執行時退回資料庫快照
+        status = live_status.read() or db.get_current_status()
+        # 取樣統計每筆樣本都在變，不放進 ETag；304 時會留著舊值，所以也不放進回應（請看 /metrics）
+        status.pop('sampling', None)
+        versions = db.get_versions()
+        # 只用會顯示的欄位當版本（seq / timestamp 每輪都變，不放進 ETag）
+        etag = 'status-%s-%s-%s-%s-b%s-s%s' % (
+            status['water_ml'], status['status'], status['last_drink_minutes'], status['today_total_ml'],
+            versions.get('bottles', 0), versions.get('settings', 0),
+        )
+
+        def build():
+            bottle = db.get_active_bottle()
+            settings = db.get_all_settings()
+
+            return jsonify({
+                'success': True,
+                'status': status,
+                'bottle': bottle,
+                'settings': settings
+            })
+
+        return _conditional(etag, build)
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/stream')
+def api_stream():
+    """即時狀態推播（Server-Sent Events）"""
+    q = broadcaster.subscribe()
+
+    def generate():
+        try:
+            # 告訴瀏覽器斷線後多久重連
+            yield 'retry: 3000\n\n'
+            while True:
+                try:
+                    item = q.get(timeout=SSE_HEARTBEAT_SEC)
+                except queue.Empty:
+                    # 心跳：維持連線，也讓伺服器發現已關閉的分頁
+                    yield ': keep-alive\n\n'
+                    continue
+                if item is None:
+                    # 訂閱者跟不上而被剔除，結束連線讓瀏覽器重連
+                    return
+                event, data = item
+                yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        finally:
+            broadcaster.unsubscribe(q)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
 # --- 水壺管理 ---
 
 @app.route('/api/bottles', methods=['GET'])
 def api_get_bottles():
     """取得所有水壺"""
     try:
-        bottles = db.get_all_bottles()
-        return jsonify({'success': True, 'bottles': bottles})
+        etag = 'bottles-%s' % db.get_versions().get('bottles', 0)
+        return _conditional(etag, lambda: jsonify({'success': True, 'bottles': _with_photos(db.get_all_bottles())}))
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+def _with_photos(bottles):
+    """加上照片與縮圖網址"""
+    for b in bottles:
+        b['photo'] = thumbnails.photo_urls(b.get('photo_path'))
+    return bottles
+
+@app.route('/media/<name>')
+def media(name):
+    """水壺照片與縮圖：檔名含內容雜湊，可以永久快取"""
+    if os.path.exists(os.path.join(thumbnails.MEDIA_DIR, name)):
+        response = send_from_directory(thumbnails.MEDIA_DIR, name, max_age=MEDIA_MAX_AGE)
+        response.cache_control.immutable = True
+        return response
+    # 縮圖還沒產生好（或沒有安裝 Pillow）：先回原圖，不讓瀏覽器快取
+    original = thumbnails.find_original(name.split('_')[0])
+    if original is None:
+        abort(404)
+    response = send_from_directory(thumbnails.MEDIA_DIR, original)
+    response.cache_control.no_cache = True
+    return response
+
 @app.route('/api/bottles', methods=['POST'])
 def api_add_bottle():
     """新增水壺"""
@@ -88,10 +240,8 @@ def api_add_bottle():
         if 'photo' in request.files:
             file = request.files['photo']
             if file and file.filename:
-                filename = secure_filename(f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file.filename}")
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                photo_path = f"uploads/{filename}"
+                # 以內容雜湊命名，縮圖在背景產生，不拖慢這個請求
+                photo_path = thumbnails.save_upload(file)
         
         bottle_id = db.add_bottle(name, empty_weight, capacity, photo_path)
         
@@ -112,10 +262,8 @@ def api_update_bottle(bottle_id):
         if 'photo' in request.files:
             file = request.files['photo']
             if file and file.filename:
-                filename = secure_filename(f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file.filename}")
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                photo_path = f"uploads/{filename}"
+                # 以內容雜湊命名，縮圖在背景產生，不拖慢這個請求
+                photo_path = thumbnails.save_upload(file)
         
         db.update_bottle(bottle_id, name, empty_weight, capacity, photo_path)
         
@@ -141,15 +289,41 @@ def api_activate_bottle(bottle_id):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+# --- 杯墊管理 ---
+
+@app.route('/api/coasters', methods=['GET'])
+def api_get_coasters():
+    """取得所有杯墊與其水壺"""
+    try:
+        coasters = db.get_all_coasters()
+        return jsonify({'success': True, 'coasters': coasters})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/coasters/<coaster_id>/bottle', methods=['POST'])
+def api_set_coaster_bottle(coaster_id):
+    """指定杯墊使用的水壺（bottle_id 留空表示跟隨目前使用中的水壺）"""
+    try:
+        bottle_id = request.json.get('bottle_id')
+        db.set_coaster_bottle(coaster_id, int(bottle_id) if bottle_id else None)
+        return jsonify({'success': True})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
 # --- 飲水記錄 ---
 
 @app.route('/api/drinks/today')
 def api_today_drinks():
     """取得今日飲水記錄"""
     try:
-        drinks = db.get_today_drinks()
-        total = db.get_today_total()
-        return jsonify({'success': True, 'drinks': drinks, 'total': total})
+        etag = 'today-%s-d%s' % (_today(), db.get_versions().get('drinks', 0))
+
+        def build():
+            drinks = db.get_today_drinks()
+            total = db.get_today_total()
+            return jsonify({'success': True, 'drinks': drinks, 'total': total})
+
+        return _conditional(etag, build)
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
@@ -157,8 +331,9 @@ def api_today_drinks():
 def api_drinks_by_date(date):
     """取得指定日期的飲水記錄"""
     try:
-        drinks = db.get_drinks_by_date(date)
-        return jsonify({'success': True, 'drinks': drinks})
+        # 過去的日期也可能被匯入 / hub 上傳 / 封存改寫，每次都帶 ETag 回來確認（304 幾乎不花成本）
+        etag = 'date-%s-%s' % (date, _drinks_version(date, db.get_versions()))
+        return _conditional(etag, lambda: jsonify({'success': True, 'drinks': db.get_drinks_by_date(date)}))
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
@@ -166,9 +341,169 @@ def api_drinks_by_date(date):
 def api_hourly_stats():
     """取得每小時統計"""
     try:
-        date = request.args.get('date')
-        stats = db.get_hourly_stats(date)
-        return jsonify({'success': True, 'stats': stats})
+        date = request.args.get('date') or _today()
+        etag = 'hourly-%s-%s' % (date, _drinks_version(date, db.get_versions()))
+        return _conditional(etag, lambda: jsonify({'success': True, 'stats': db.get_hourly_stats(date)}))
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/drinks/range')
+def api_drink_range():
+    """取得區間統計（?from=&to=&bucket=hour|day|week|month）"""
+    try:
+        end = request.args.get('to') or _today()
+        start = request.args.get('from') or (datetime.strptime(end, '%Y-%m-%d') - timedelta(days=29)).strftime('%Y-%m-%d')
+        bucket = request.args.get('bucket', 'day')
+        versions = db.get_versions()
+        etag = 'range-%s-%s-%s-%s-%s-s%s' % (
+            start, end, bucket, _today(), _drinks_version(end, versions), versions.get('settings', 0),
+        )
+        return _conditional(etag, lambda: jsonify({'success': True, **db.get_drink_range(start, end, bucket)}))
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+# --- 匯出 / 匯入 ---
+
+@app.route('/api/export')
+def api_export():
+    """串流匯出飲水記錄（?from=&to=&format=csv|ndjson）"""
+    try:
+        fmt = request.args.get('format', 'csv')
+        if fmt not in history_io.FORMATS:
+            raise ValueError(f"不支援的格式: {fmt}")
+        start = request.args.get('from')
+        end = request.args.get('to')
+        chunks = history_io.export_chunks(db.iter_drinks(start, end), fmt)
+        filename = f"drinks_{start or 'all'}_{end or 'now'}.{fmt}"
+        return Response(chunks, mimetype=history_io.FORMATS[fmt], headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/import', methods=['POST'])
+def api_import():
+    """匯入飲水記錄（上傳欄位 file，CSV 或 NDJSON）"""
+    try:
+        file = request.files.get('file')
+        if not file:
+            raise ValueError("請上傳檔案")
+        fmt = request.form.get('format') or history_io.guess_format(file.filename)
+        stream = io.TextIOWrapper(file.stream, encoding='utf-8', newline='')
+        result = db.import_drinks(history_io.parse_rows(stream, fmt))
+        return jsonify({'success': True, **result})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+# --- 多裝置匯集（hub 模式） ---
+
+# HYDRATION_HUB=1 時接受其他杯墊（uploader.py）上傳的資料；設定 HYDRATION_HUB_TOKEN 可限制上傳者
+HUB_MODE = os.environ.get('HYDRATION_HUB') == '1'
+HUB_TOKEN = os.environ.get('HYDRATION_HUB_TOKEN')
+INGEST_MAX_BYTES = 16 * 1024 * 1024   # 解壓縮後的上限
+INGEST_MAX_EVENTS = 5000              # 每批最多的事件數
+
+def _ingest_body() -> bytes:
+    """讀取請求內容（Content-Encoding: gzip 時解壓縮，並限制解壓後的大小）"""
+    data = request.get_data()
+    if request.content_encoding == 'gzip':
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = d.decompress(data, INGEST_MAX_BYTES)
+        if d.unconsumed_tail:
+            raise ValueError("解壓縮後超過大小上限")
+    return data
+
+# 喝水提醒（hub）：每台裝置一個排程，到期時推播 SSE 的 reminder 事件
+# 排程在行程內，hub 請用 serve.py（單一行程、多執行緒）執行
+reminder_scheduler = None
+
+def _start_reminders():
+    global reminder_scheduler
+    sinks = [lambda r: broadcaster.publish('reminder', r)]
+    webhook_url = db.get_setting('reminder_webhook_url')
+    if webhook_url:
+        sinks.append(reminders.WebhookSink(webhook_url))
+    scheduler = reminders.ReminderScheduler(sinks)
+    for device_id, last_drink in db.get_device_last_drinks().items():
+        scheduler.track(device_id, datetime.strptime(last_drink, db.TS_FORMAT).timestamp())
+    scheduler.start()
+    reminder_scheduler = scheduler
+
+def _track_reminder(device_id: str, last_drink: str = None):
+    """裝置上傳了新的飲水記錄（或第一次出現）時重新排程"""
+    if reminder_scheduler is None:
+        return
+    if last_drink:
+        reminder_scheduler.track(device_id, datetime.strptime(last_drink, db.TS_FORMAT).timestamp())
+    elif not reminder_scheduler.tracking(device_id):
+        reminder_scheduler.track(device_id, time.time())
+
+@app.route('/api/ingest', methods=['POST'])
+def api_ingest():
+    """hub：接收一台裝置上傳的一批飲水事件與狀態（JSON，可 gzip 壓縮）"""
+    if not HUB_MODE:
+        abort(404)
+    # 固定時間比較，避免由回應時間猜出 token；以 bytes 比較，非 ASCII 的標頭也不會拋出例外
+    auth = request.headers.get('Authorization', '').encode('utf-8', 'surrogateescape')
+    if HUB_TOKEN and not hmac.compare_digest(auth, f'Bearer {HUB_TOKEN}'.encode('utf-8')):
+        return jsonify({'success': False, 'error': 'unauthorized'}), 401
+    try:
+        batch = json.loads(_ingest_body())
+        events = batch.get('events') or []
+        if len(events) > INGEST_MAX_EVENTS:
+            raise ValueError(f"每批最多 {INGEST_MAX_EVENTS} 筆事件")
+        result = db.ingest_batch(str(batch['device_id']), int(batch['seq']), events, batch.get('status'))
+    except (KeyError, TypeError, ValueError, zlib.error) as e:
+        # 格式錯誤：重送也不會成功
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        # 資料庫忙碌等暫時性錯誤：上傳端會稍後重送
+        return jsonify({'success': False, 'error': str(e)}), 503
+    _track_reminder(str(batch['device_id']), result.get('last_drink'))
+    return jsonify({'success': True, **result})
+
+@app.route('/api/devices')
+def api_devices():
+    """hub：各裝置的最新狀態"""
+    try:
+        return jsonify({'success': True, 'devices': db.get_devices()})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+# --- 重量軌跡 ---
+
+WEIGHT_DEFAULT_POINTS = 500
+WEIGHT_MAX_POINTS = 5000
+
+def _parse_ts(value: str, default: float) -> float:
+    """時間參數：可為 epoch 秒或 'YYYY-MM-DD HH:MM:SS' / ISO 格式"""
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+@app.route('/api/weight')
+def api_weight():
+    """取得降採樣後的重量軌跡"""
+    try:
+        now = datetime.now().timestamp()
+        end_ts = _parse_ts(request.args.get('to'), now)
+        start_ts = _parse_ts(request.args.get('from'), end_ts - 3600)
+        points = min(int(request.args.get('points', WEIGHT_DEFAULT_POINTS)), WEIGHT_MAX_POINTS)
+        series = request.args.get('series', 'grams')
+        if series not in ('grams', 'ema'):
+            raise ValueError(f'unknown series: {series}')
+
+        result = weight_trace.downsample_range(start_ts, end_ts, points, series)
+        return jsonify({
+            'success': True,
+            'from': start_ts,
+            'to': end_ts,
+            'columns': ['ts', 'grams', 'ema'],
+            **result
+        })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
@@ -178,8 +513,8 @@ def api_hourly_stats():
 def api_get_settings():
     """取得所有設定"""
     try:
-        settings = db.get_all_settings()
-        return jsonify({'success': True, 'settings': settings})
+        etag = 'settings-%s' % db.get_versions().get('settings', 0)
+        return _conditional(etag, lambda: jsonify({'success': True, 'settings': db.get_all_settings()}))
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
@@ -190,6 +525,8 @@ def api_update_settings():
         data = request.json
         for key, value in data.items():
             db.set_setting(key, str(value))
+        if reminder_scheduler is not None:
+            reminder_scheduler.reload()
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
@@ -205,5 +542,7 @@ if __name__ == '__main__':
     print("或: http://localhost:5000")
     print("按 Ctrl+C 停止")
     print("="*60)
-    
+
+    # 開發用（debug 與自動重新載入）；正式環境請用 serve.py
+    init_app_database()
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+智慧飲水系統 - 飲水偵測效能與準確度測試
+
+    python3 benchmarks/bench_detector.py                  # 合成標記軌跡
+    python3 benchmarks/bench_detector.py --trace t.csv --labels l.csv --empty-g 150
+
+- 效能：DrinkDetector.feed_many 與舊版 main.py 迴圈寫法（list.pop(0) + min/max）的樣本吞吐量
+- 一致性：兩者在同一軌跡上必須偵測出完全相同的事件
+- 準確度：與標記的飲水事件比對，輸出 precision / recall / 平均誤差；
+  低於門檻時以非零結束碼離開，可直接當作回歸檢查
+"""
+
+import argparse
+import csv
+import os
+import sys
+import time
+from typing import List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import hardware
+from detector import DrinkDetector
+
+MATCH_BEFORE_SEC = 2    # 偵測時間可早於標記的秒數
+MATCH_AFTER_SEC = 15    # 偵測時間可晚於標記的秒數（放回後需等待穩定）
+MIN_PRECISION = 0.9
+MIN_RECALL = 0.9
+
+
+def legacy_detect(samples: List[float], empty_g: float) -> List[Tuple[int, int]]:
+    """重構前 main.py 迴圈內的偵測邏輯（作為對照組）"""
+    ema_g = None
+    last_stable_ml = 0
+    recent_g = []
+    prev_ema_g = None
+    events = []
+    for i, grams in enumerate(samples):
+        if ema_g is None:
+            ema_g = grams
+        else:
+            change = abs(grams - ema_g)
+            if change > 100:
+                alpha = 0.6
+            elif change > 20:
+                alpha = 0.4
+            else:
+                alpha = 0.2
+            ema_g = (alpha * grams) + ((1 - alpha) * ema_g)
+
+        recent_g.append(ema_g)
+        if len(recent_g) > 8:
+            recent_g.pop(0)
+        g_var = max(recent_g) - min(recent_g)
+
+        lifting = False
+        if ema_g < -200:
+            lifting = True
+        if prev_ema_g is not None and (prev_ema_g - ema_g) > 100:
+            lifting = True
+        prev_ema_g = ema_g
+
+        water_ml = int(round(max(0.0, ema_g - empty_g)))
+        stable = (g_var <= 20) and (not lifting)
+
+        if stable and water_ml > 0:
+            if last_stable_ml > 0:
+                drop = last_stable_ml - water_ml
+                if drop >= 15:
+                    events.append((i, drop))
+            last_stable_ml = water_ml
+    return events
+
+
+def match_events(detected: List[Tuple[float, int]], labels: List[Tuple[float, int]]) -> dict:
+    """依時間把偵測事件對應到標記事件"""
+    used = set()
+    errors = []
+    for label_ts, label_ml in labels:
+        for j, (ts, ml) in enumerate(detected):
+            if j in used:
+                continue
+            if label_ts - MATCH_BEFORE_SEC <= ts <= label_ts + MATCH_AFTER_SEC:
+                used.add(j)
+                errors.append(ml - label_ml)
+                break
+    tp = len(errors)
+    return {
+        'tp': tp,
+        'precision': tp / len(detected) if detected else 1.0,
+        'recall': tp / len(labels) if labels else 1.0,
+        'mae_ml': sum(abs(e) for e in errors) / tp if tp else 0.0,
+        'bias_ml': sum(errors) / tp if tp else 0.0,
+    }
+
+
+def load_labels(path: str) -> List[Tuple[float, int]]:
+    labels = []
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            try:
+                labels.append((float(row[0]), int(float(row[1]))))
+            except (ValueError, IndexError):
+                continue
+    return labels
+
+
+def bench(fn, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trace', help="ts,grams CSV 或 traces/*.bin")
+    parser.add_argument('--labels', help="標記檔：ts,ml CSV")
+    parser.add_argument('--empty-g', type=float, default=None, help="空壺重量 (g)")
+    parser.add_argument('--traces', type=int, default=20, help="合成軌跡數量")
+    parser.add_argument('--minutes', type=float, default=240, help="每條合成軌跡長度（分鐘）")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.trace:
+        if args.empty_g is None:
+            parser.error("--trace 需要搭配 --empty-g")
+        samples = hardware.load_trace(args.trace)
+        traces = [{
+            'samples': samples,
+            'drinks': load_labels(args.labels) if args.labels else None,
+            'empty_g': args.empty_g,
+        }]
+    else:
+        traces = [hardware.synthetic_trace(minutes=args.minutes, seed=seed) for seed in range(args.traces)]
+
+    total_samples = sum(len(t['samples']) for t in traces)
+    grams_lists = [[g for _, g in t['samples']] for t in traces]
+
+    # 一致性
+    for t, grams in zip(traces, grams_lists):
+        new = DrinkDetector(t['empty_g']).feed_many(grams)
+        old = legacy_detect(grams, t['empty_g'])
+        if new != old:
+            print("✗ DrinkDetector 與舊版偵測結果不一致")
+            sys.exit(1)
+    print(f"✓ 與舊版偵測結果一致（{len(traces)} 條軌跡，{total_samples:,} 筆樣本）")
+
+    # 效能
+    t_new = bench(lambda: [DrinkDetector(t['empty_g']).feed_many(g) for t, g in zip(traces, grams_lists)], args.repeat)
+    t_old = bench(lambda: [legacy_detect(g, t['empty_g']) for t, g in zip(traces, grams_lists)], args.repeat)
+    print(f"DrinkDetector：{total_samples / t_new:12,.0f} 樣本/秒")
+    print(f"舊版迴圈    ：{total_samples / t_old:12,.0f} 樣本/秒（{t_old / t_new:.2f}x）")
+
+    # 準確度
+    labelled = [(t, g) for t, g in zip(traces, grams_lists) if t['drinks'] is not None]
+    if not labelled:
+        return
+    detected_all, labels_all = [], []
+    for t, grams in labelled:
+        ts = [s[0] for s in t['samples']]
+        detected = [(ts[i], ml) for i, ml in DrinkDetector(t['empty_g']).feed_many(grams)]
+        result = match_events(detected, t['drinks'])
+        detected_all.append(len(detected))
+        labels_all.append((result, len(t['drinks'])))
+
+    tp = sum(r['tp'] for r, _ in labels_all)
+    n_labels = sum(n for _, n in labels_all)
+    n_detected = sum(detected_all)
+    precision = tp / n_detected if n_detected else 1.0
+    recall = tp / n_labels if n_labels else 1.0
+    mae = sum(r['mae_ml'] * r['tp'] for r, _ in labels_all) / tp if tp else 0.0
+    bias = sum(r['bias_ml'] * r['tp'] for r, _ in labels_all) / tp if tp else 0.0
+    print(f"準確度：標記 {n_labels} 次 / 偵測 {n_detected} 次 / 命中 {tp} 次")
+    print(f"  precision={precision:.3f} recall={recall:.3f} 平均誤差={mae:.1f} ml 偏差={bias:+.1f} ml")
+
+    if precision < MIN_PRECISION or recall < MIN_RECALL:
+        print(f"✗ 低於門檻（precision >= {MIN_PRECISION}, recall >= {MIN_RECALL}）")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
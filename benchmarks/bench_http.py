@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+智慧飲水系統 - Dashboard API 負載測試
+
+    python3 benchmarks/bench_http.py                          # 暫存資料庫 + serve.py 的 server
+    python3 benchmarks/bench_http.py --url http://pi.local:5000 --duration 10
+    python3 benchmarks/bench_http.py --max-p99-ms 50 --min-rps 200   # 當作回歸檢查
+
+沒有指定 --url 時，先建立一個填入 --days 天份飲水記錄的暫存資料庫，
+再以 serve.create_server() 在本機隨機埠啟動 server（與正式環境相同的啟動方式）。
+每個端點以 --concurrency 條 keep-alive 連線持續請求 --duration 秒，
+輸出每秒請求數與 p50 / p99 延遲；指定門檻時未達標以非零結束碼離開。
+"""
+
+import argparse
+import http.client
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import database as db
+
+ENDPOINTS = ('/api/status', '/api/drinks/today', '/api/drinks/hourly')
+
+
+def seed_database(days: int, drinks_per_day: int, seed: int = 0):
+    """建立暫存資料庫並填入過去 days 天（含今天）的飲水記錄"""
+    db.DB_PATH = os.path.join(tempfile.mkdtemp(prefix='hydration_http_'), 'bench.db')
+    db.init_database()
+    db.set_active_bottle(db.add_bottle('bench', 150, 700))
+    rng = random.Random(seed)
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def rows():
+        for d in range(days - 1, -1, -1):
+            day = today - timedelta(days=d)
+            for _ in range(drinks_per_day):
+                ts = day + timedelta(seconds=rng.randint(7 * 3600, 23 * 3600))
+                if ts > datetime.now():
+                    continue
+                yield {'timestamp': ts.strftime(db.TS_FORMAT), 'amount_ml': rng.randint(30, 300)}
+
+    result = db.import_drinks(rows())
+    print(f"資料庫：{db.DB_PATH}（{result['inserted']} 筆飲水記錄，{days} 天）")
+
+
+def run_endpoint(host: str, port: int, path: str, concurrency: int, duration: float) -> Dict:
+    """以 concurrency 條連線持續請求 path，回傳統計"""
+    latencies: List[float] = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client():
+        conn = http.client.HTTPConnection(host, port, timeout=10)
+        local = []
+        failed = 0
+        while time.perf_counter() < deadline:
+            t = time.perf_counter()
+            try:
+                conn.request('GET', path)
+                resp = conn.getresponse()
+                resp.read()
+                if resp.status != 200:
+                    failed += 1
+                    continue
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                conn.close()
+                continue
+            local.append(time.perf_counter() - t)
+        conn.close()
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    pick = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else float('nan')
+    return {
+        'path': path,
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': len(latencies) / elapsed,
+        'p50_ms': pick(0.5),
+        'p99_ms': pick(0.99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dashboard API 負載測試")
+    parser.add_argument('--url', default=None, help="測試既有的 server（預設在本機啟動一個）")
+    parser.add_argument('--days', type=int, default=365, help="暫存資料庫的記錄天數")
+    parser.add_argument('--drinks-per-day', type=int, default=12)
+    parser.add_argument('--concurrency', type=int, default=8, help="同時連線數")
+    parser.add_argument('--duration', type=float, default=5.0, help="每個端點的測試秒數")
+    parser.add_argument('--endpoint', action='append', help="要測試的路徑（可重複，預設三個主要 API）")
+    parser.add_argument('--max-p99-ms', type=float, default=None, help="p99 超過此值時失敗")
+    parser.add_argument('--min-rps', type=float, default=None, help="每秒請求數低於此值時失敗")
+    args = parser.parse_args()
+
+    server = None
+    if args.url:
+        url = urllib.parse.urlparse(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        seed_database(args.days, args.drinks_per_day)
+        import serve
+        server, name = serve.create_server('127.0.0.1', 0)
+        host = '127.0.0.1'
+        port = getattr(server, 'effective_port', None) or server.server_port
+        threading.Thread(target=server.run, daemon=True).start()
+        print(f"Server：{name} @ {host}:{port}")
+
+    failed = False
+    print(f"{'端點':<22}{'請求數':>8}{'錯誤':>6}{'req/s':>10}{'p50 ms':>9}{'p99 ms':>9}")
+    for path in args.endpoint or ENDPOINTS:
+        r = run_endpoint(host, port, path, args.concurrency, args.duration)
+        print(f"{r['path']:<22}{r['requests']:>8}{r['errors']:>6}{r['rps']:>10,.0f}{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}")
+        if r['errors'] or not r['requests']:
+            failed = True
+        if args.max_p99_ms is not None and r['p99_ms'] > args.max_p99_ms:
+            failed = True
+        if args.min_rps is not None and r['rps'] < args.min_rps:
+            failed = True
+
+    if server is not None:
+        server.close()
+    if failed:
+        print("✗ 未達效能門檻或有錯誤")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+智慧飲水系統 - hub 上傳吞吐量測試
+
+    python3 benchmarks/bench_ingest.py --devices 2000 --rounds 5
+
+模擬多台裝置輪流把一批（狀態 + 0~2 筆飲水事件，gzip JSON）POST 到 /api/ingest，
+使用暫存資料庫與 Flask 測試用戶端（不經過網路），輸出每秒批次數與 p50 / p99 延遲。
+每台裝置每隔幾秒上傳一次時，hub 需要的吞吐量約為 裝置數 / 上傳週期。
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import database as db
+
+
+def percentile(values, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="hub /api/ingest 吞吐量測試")
+    parser.add_argument('--devices', type=int, default=2000, help="模擬的裝置數")
+    parser.add_argument('--rounds', type=int, default=5, help="每台裝置上傳幾批")
+    parser.add_argument('--drink-rate', type=float, default=0.05, help="每批含飲水事件的機率")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    db.DB_PATH = os.path.join(tempfile.mkdtemp(prefix='hydration_ingest_'), 'hub.db')
+    os.environ['HYDRATION_HUB'] = '1'
+    os.environ.pop('HYDRATION_HUB_TOKEN', None)
+    import app as webapp
+    client = webapp.app.test_client()
+    rng = random.Random(args.seed)
+
+    latencies = []
+    events = 0
+    started = time.perf_counter()
+    for seq in range(1, args.rounds + 1):
+        for d in range(args.devices):
+            batch_events = []
+            if rng.random() < args.drink_rate:
+                batch_events = [
+                    {'uid': f'dev{d}-{seq}-{i}', 'timestamp': time.strftime(db.TS_FORMAT),
+                     'amount_ml': rng.randint(20, 300), 'coaster_id': 'main'}
+                    for i in range(rng.randint(1, 2))
+                ]
+            payload = {
+                'device_id': f'dev{d}',
+                'seq': seq if batch_events else 0,
+                'events': batch_events,
+                'status': {'water_ml': rng.randint(0, 800), 'status': 'OK',
+                           'last_drink_minutes': rng.randint(0, 90), 'today_total_ml': rng.randint(0, 2500)},
+            }
+            body = gzip.compress(json.dumps(payload).encode('utf-8'))
+            t = time.perf_counter()
+            resp = client.post('/api/ingest', data=body, headers={
+                'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+            latencies.append(time.perf_counter() - t)
+            if resp.status_code != 200:
+                raise SystemExit(f"上傳失敗：{resp.status_code} {resp.get_data(as_text=True)}")
+            events += len(batch_events)
+    elapsed = time.perf_counter() - started
+
+    batches = len(latencies)
+    print(f"裝置數：{args.devices}  批次數：{batches}  事件數：{events}")
+    print(f"吞吐量：{batches / elapsed:,.0f} 批次/秒")
+    print(f"延遲：p50={percentile(latencies, 0.5) * 1000:.2f} ms  p99={percentile(latencies, 0.99) * 1000:.2f} ms")
+    print(f"以 5 秒上傳週期計算，單一行程可支援約 {batches / elapsed * 5:,.0f} 台裝置")
+    print(f"資料庫：{db.DB_PATH}")
+
+
+if __name__ == '__main__':
+    main()
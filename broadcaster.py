@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+智慧飲水系統 - Server-Sent Events 推播
+
+單一背景執行緒（producer）定期檢查即時狀態與新的飲水事件，
+有變化時才把差異推給所有訂閱者，讓開再多分頁也只有一份查詢負載。
+"""
+
+import queue
+import threading
+import time
+from typing import Callable, Dict, Optional, Set
+
+import database as db
+
+POLL_SEC = 0.5          # 檢查即時狀態 / 新事件的週期
+CONFIG_POLL_SEC = 1     # 檢查水壺與設定變更的週期（database.py 有快取，成本很低）
+SUBSCRIBER_QUEUE = 100  # 每個訂閱者最多暫存的事件數
+DRINK_EVENT_LIMIT = 20  # 一次輪詢最多逐筆推送的飲水事件；超過時（匯入、hub 上傳）改送一個 refresh
+
+# 比較狀態差異時忽略的欄位（每次發佈都會變；sampling 為取樣週期統計，隨每筆樣本變動）
+_VOLATILE_KEYS = ('timestamp', 'seq', 'id', 'sampling')
+
+
+class StatusBroadcaster:
+    """一個 producer 扇出給多個 SSE 訂閱者"""
+
+    def __init__(self, read_status: Callable[[], Optional[Dict]],
+                 poll_sec: float = POLL_SEC, config_poll_sec: float = CONFIG_POLL_SEC):
+        self._read_status = read_status
+        self.poll_sec = poll_sec
+        self.config_poll_sec = config_poll_sec
+
+        self._subscribers: Set[queue.Queue] = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+
+        self._status: Dict = {}
+        self._config: Dict = {}
+        self._last_drink_id = None
+
+    # ---------- 訂閱管理 ----------
+
+    def subscribe(self) -> queue.Queue:
+        """新增訂閱者；會先收到一份完整快照"""
+        q = queue.Queue(maxsize=SUBSCRIBER_QUEUE)
+        with self._lock:
+            if self._thread is None:
+                # 第一次訂閱才啟動，避免在 import 時（例如 fork 前）就建立執行緒
+                self._thread = threading.Thread(target=self._run, name='sse-producer', daemon=True)
+                self._thread.start()
+            if self._status or self._config:
+                q.put_nowait(('snapshot', {'status': self._status, **self._config}))
+            self._subscribers.add(q)
+            self._wakeup.notify()
+        return q
+
+    def unsubscribe(self, q: queue.Queue):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, event: str, data: Dict):
+        """推送事件給所有訂閱者；跟不上的訂閱者會被斷線，讓瀏覽器重新連線取得快照"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait((event, data))
+            except queue.Full:
+                self.unsubscribe(q)
+                _drain(q)
+                q.put_nowait(None)
+
+    # ---------- producer ----------
+
+    def _run(self):
+        next_config = 0.0
+        while True:
+            with self._lock:
+                while not self._subscribers:
+                    self._wakeup.wait()
+
+            try:
+                self._poll_status()
+                self._poll_drinks()
+                if time.monotonic() >= next_config:
+                    self._poll_config()
+                    next_config = time.monotonic() + self.config_poll_sec
+            except Exception as e:
+                print(f"SSE 推播更新失敗: {e}")
+
+            time.sleep(self.poll_sec)
+
+    def _poll_status(self):
+        status = self._read_status()
+        if not status:
+            return
+        status = {k: v for k, v in status.items() if k != 'id'}
+        delta = {
+            k: v for k, v in status.items()
+            if k in _VOLATILE_KEYS or self._status.get(k) != v
+        }
+        changed = any(k not in _VOLATILE_KEYS for k in delta)
+        with self._lock:
+            first = not self._status
+            self._status = status
+        if first:
+            self.publish('snapshot', {'status': status, **self._config})
+        elif changed:
+            self.publish('status', delta)
+
+    def _poll_drinks(self):
+        if self._last_drink_id is None:
+            self._last_drink_id = db.get_last_drink_id()
+            return
+        drinks = db.get_drinks_since(self._last_drink_id, DRINK_EVENT_LIMIT + 1)
+        if len(drinks) > DRINK_EVENT_LIMIT:
+            # 大量新記錄：逐筆推送會塞滿訂閱者的佇列，改請頁面重新載入資料
+            self._last_drink_id = db.get_last_drink_id()
+            self.publish('refresh', {'last_id': self._last_drink_id})
+            return
+        for drink in drinks:
+            self._last_drink_id = drink['id']
+            self.publish('drink', drink)
+
+    def _poll_config(self):
+        config = {'bottle': db.get_active_bottle(), 'settings': db.get_all_settings()}
+        with self._lock:
+            changed = config != self._config
+            self._config = config
+        if changed:
+            self.publish('config', config)
+
+
+def _drain(q: queue.Queue):
+    try:
+        while True:
+            q.get_nowait()
+    except queue.Empty:
+        pass
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+智慧飲水系統 - 感測狀態檢查點
+
+main.py 定期把每個杯墊的濾波 / 穩定水量 / 今日總量 / 上次飲水時間寫到檢查點檔，
+重新啟動（--fast）時直接還原，不必重新暖機，也不會漏掉停機期間喝掉的水：
+還原的穩定水量與重啟後第一次穩定的水量相比，差值就會被判定為一次飲水。
+"""
+
+import json
+import os
+import time
+from typing import Dict
+
+import database as db
+
+CHECKPOINT_NAME = 'sensor_checkpoint.json'
+MAX_AGE_SEC = 15 * 60   # 超過這個時間就不還原濾波狀態（水壺可能已經被換掉）
+
+
+def default_path() -> str:
+    """檢查點與資料庫放在同一個資料夾"""
+    return os.path.join(os.path.dirname(os.path.abspath(db.DB_PATH)), CHECKPOINT_NAME)
+
+
+def save(coasters: Dict[str, Dict], path: str = None):
+    """寫入檢查點（先寫暫存檔再換名，當機時不會留下寫到一半的檔案）"""
+    path = path or default_path()
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'time': time.time(), 'coasters': coasters}, f)
+    os.replace(tmp, path)
+
+
+def load(path: str = None) -> Dict:
+    """讀取檢查點；不存在或損壞時回傳空 dict"""
+    try:
+        with open(path or default_path(), encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data.get('coasters'), dict) else {}
@@ -4,288 +4,1079 @@
 智慧飲水系統 - 資料庫模組
 """
 
+import json
 import sqlite3
 import os
-from datetime import datetime
-from typing import List, Dict, Optional
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator, List, Dict, Optional
+
+import metrics
 
 DB_PATH = os.path.join(os.path.dirname(__file__), 'hydration.db')
 
+# 連線設定
+BUSY_TIMEOUT_MS = 5000      # 遇到寫入鎖時最多等待的時間
+STATEMENT_CACHE_SIZE = 128  # 每條連線快取的已編譯 SQL 數量
+POOL_MAX_IDLE = 8           # 連線池最多保留的閒置連線數
+
+# 匯出時每次從游標取出的筆數 / 匯入時每批 executemany 的筆數
+EXPORT_FETCH_SIZE = 500
+IMPORT_BATCH_SIZE = 1000
+
+# 區間統計：一次最多查詢的天數（小時粒度另有限制），以及已結束區段的快取筆數
+RANGE_MAX_DAYS = 3660
+RANGE_MAX_HOUR_DAYS = 62
+RANGE_CACHE_SIZE = 64
+
+# 保存期限：超過 retention_days 的原始飲水記錄移到封存資料庫（每日 / 每小時彙總表不受影響）
+ARCHIVE_SUFFIX = '_archive.db'
+_ARCHIVE_COLUMNS = 'id, bottle_id, amount_ml, timestamp, coaster_id, event_uid, device_id'
+VACUUM_PAGES = 256          # 每次漸進回收的最多頁數（約 1 MiB），不會長時間鎖住資料庫
+VACUUM_MIN_FREE_PAGES = 64  # 可回收的空頁少於這個數量就不回收
+
+# 設定 / 水壺快取：最多每隔這麼久檢查一次 cache_versions（需小於感測迴圈的 0.3 秒）
+CACHE_CHECK_SEC = 0.25
+
+# 與 SQLite datetime('now', 'localtime') 相同的時間格式，字串比較即等於時間比較
+TS_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# ========== 連線管理 ==========
+
+def _connect(path: str) -> sqlite3.Connection:
+    """開啟一條新連線並套用 WAL 與逾時設定"""
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        check_same_thread=False,
+    )
+    conn.row_factory = sqlite3.Row
+    # 新資料庫在建立資料表前設定才有效；既有資料庫由 incremental_vacuum() 第一次執行時轉換
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    # WAL：讀取不會擋住感測迴圈的寫入，寫入也不會擋住網頁讀取
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    # WAL 模式下 NORMAL 已可保證資料庫不損毀，並大幅減少 fsync
+    conn.execute('PRAGMA synchronous=NORMAL')
+    _attach_archive(conn, path)
+    return conn
+
+def archive_path(path: str = None) -> str:
+    """封存資料庫的路徑（與主資料庫同一個資料夾）"""
+    return os.path.splitext(path or DB_PATH)[0] + ARCHIVE_SUFFIX
+
+def _attach_archive(conn: sqlite3.Connection, path: str):
+    """掛上封存資料庫，並建立合併兩邊的暫存檢視 drink_events_all（查詢原始記錄用）"""
+    conn.execute('ATTACH DATABASE ? AS archive', (archive_path(path),))
+    conn.execute('PRAGMA archive.journal_mode=WAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive.drink_events (
+            id INTEGER PRIMARY KEY,
+            bottle_id INTEGER,
+            amount_ml INTEGER NOT NULL,
+            timestamp TIMESTAMP,
+            coaster_id TEXT,
+            event_uid TEXT,
+            device_id TEXT
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_archive_timestamp ON drink_events (timestamp)')
+    # 搬移分兩個交易（先複製再刪除），中途當機時兩邊可能暫時都有同一筆，以 id 排除
+    conn.execute(f'''
+        CREATE TEMP VIEW IF NOT EXISTS drink_events_all AS
+        SELECT {_ARCHIVE_COLUMNS} FROM main.drink_events
+        UNION ALL
+        SELECT {_ARCHIVE_COLUMNS} FROM archive.drink_events a
+        WHERE NOT EXISTS (SELECT 1 FROM main.drink_events m WHERE m.id = a.id)
+    ''')
+
+class ConnectionPool:
+    """簡單的 SQLite 連線池：借出 / 歸還長駐連線，避免每次呼叫都重新開檔"""
+
+    def __init__(self, path: str, max_idle: int = POOL_MAX_IDLE):
+        self.path = path
+        self.max_idle = max_idle
+        self._idle: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return _connect(self.path)
+
+    def release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+_pools: Dict[tuple, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+def _get_pool() -> ConnectionPool:
+    """依 (資料庫路徑, 行程) 取得連線池；fork 後的子行程會建立自己的連線"""
+    key = (DB_PATH, os.getpid())
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(key, ConnectionPool(DB_PATH))
+    return pool
+
+@contextmanager
+def _connection():
+    """借用一條連線，用完自動歸還"""
+    pool = _get_pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+@contextmanager
+def _transaction():
+    """借用一條連線並包在交易中：成功則 commit，例外則 rollback"""
+    with _connection() as conn:
+        with conn:
+            yield conn
+
+def close_connections():
+    """關閉本行程所有閒置連線（測試或切換 DB_PATH 時使用）"""
+    with _pools_lock:
+        pools = [p for key, p in _pools.items() if key[1] == os.getpid()]
+    for pool in pools:
+        pool.close_all()
+
+# ========== 設定 / 水壺快取 ==========
+#
+# 設定與水壺很少變動，卻在每次輪詢、每筆飲水事件都會讀取。
+# 讀取結果快取在行程記憶體中，並以 cache_versions 表的版本號判斷是否過期：
+# settings / bottles / coasters 的觸發器在每次修改時把對應版本 +1，
+# 因此 main.py 與 app.py 任一方修改後，另一方最晚在 CACHE_CHECK_SEC 內就會重新讀取。
+
+_cache: Dict[tuple, tuple] = {}     # (DB_PATH, 名稱, 參數) -> (版本, 值)
+_versions: Dict[str, tuple] = {}    # DB_PATH -> (檢查時間, {名稱: 版本})
+_cache_lock = threading.Lock()
+
+def _cache_versions() -> Dict[str, int]:
+    """取得目前各快取的版本號（CACHE_CHECK_SEC 內重複使用上次的結果）"""
+    now = time.monotonic()
+    entry = _versions.get(DB_PATH)
+    if entry and now - entry[0] < CACHE_CHECK_SEC:
+        return entry[1]
+    with _connection() as conn:
+        versions = dict(conn.execute('SELECT name, version FROM cache_versions').fetchall())
+    _versions[DB_PATH] = (now, versions)
+    return versions
+
+def get_versions() -> Dict[str, int]:
+    """取得 settings / bottles / drinks 的版本號（API 用來產生 ETag）"""
+    return dict(_cache_versions())
+
+def _copy(value):
+    """回傳快取值的複本，避免呼叫端修改到快取內容"""
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, list):
+        return [dict(v) if isinstance(v, dict) else v for v in value]
+    return value
+
+def _cached(name: str, key, loader):
+    """以 cache_versions[name] 為版本快取 loader() 的結果"""
+    version = _cache_versions().get(name, 0)
+    cache_key = (DB_PATH, name, key)
+    hit = _cache.get(cache_key)
+    if hit is not None and hit[0] == version:
+        return _copy(hit[1])
+    value = loader()
+    with _cache_lock:
+        _cache[cache_key] = (version, value)
+    return _copy(value)
+
+def invalidate_cache():
+    """讓下一次讀取立即重新檢查版本（本行程修改資料後呼叫）"""
+    _versions.pop(DB_PATH, None)
+
+# ========== 資料表 ==========
+
 def init_database():
-    """初始化資料庫"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # 水壺資料表
+    """初始化資料庫（多個行程同時呼叫也安全：整個初始化與遷移在同一個寫入交易中）"""
+    with _transaction() as c:
+        # 立即取得寫入鎖；其他行程會等到這裡完成後，看到已是最新版本而略過遷移
+        c.execute('BEGIN IMMEDIATE')
+        # 水壺資料表
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS bottles (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                empty_weight REAL NOT NULL,
+                capacity INTEGER NOT NULL,
+                photo_path TEXT,
+                is_active INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+            )
+        ''')
+
+        # 飲水記錄表
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS drink_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                bottle_id INTEGER,
+                amount_ml INTEGER NOT NULL,
+                timestamp TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+                FOREIGN KEY (bottle_id) REFERENCES bottles (id)
+            )
+        ''')
+
+        # 系統設定表
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+            )
+        ''')
+
+        # 即時狀態表（單行）
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS current_status (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                water_ml INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'OK',
+                last_drink_minutes INTEGER DEFAULT 0,
+                today_total_ml INTEGER DEFAULT 0,
+                timestamp TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+            )
+        ''')
+
+        # 初始化預設設定
+        c.execute('''
+            INSERT OR IGNORE INTO settings (key, value) VALUES 
+            ('daily_goal_ml', '2000'),
+            ('remind_interval_min', '60'),
+            ('retention_days', '365'),
+            ('quiet_hours', '')
+        ''')
+
+        # 初始化狀態
+        c.execute('INSERT OR IGNORE INTO current_status (id) VALUES (1)')
+
+        _migrate(c)
+
+    invalidate_cache()
+    print(f"✓ 資料庫初始化完成: {DB_PATH}")
+
+# ========== 結構遷移 ==========
+
+def _migration_1_drink_event_indexes(c):
+    """drink_events 的時間與水壺索引（日期查詢改用範圍條件才用得到）"""
+    c.execute('CREATE INDEX IF NOT EXISTS idx_drink_events_timestamp ON drink_events (timestamp)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_drink_events_bottle ON drink_events (bottle_id, timestamp)')
+
+def _migration_2_rollup_tables(c):
+    """每日 / 每小時彙總表，由觸發器在新增飲水記錄時同步累加"""
     c.execute('''
-        CREATE TABLE IF NOT EXISTS bottles (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            empty_weight REAL NOT NULL,
-            capacity INTEGER NOT NULL,
-            photo_path TEXT,
-            is_active INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
-        )
+        CREATE TABLE IF NOT EXISTS daily_totals (
+            date TEXT PRIMARY KEY,
+            total_ml INTEGER NOT NULL DEFAULT 0,
+            count INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
     ''')
-    
-    # 飲水記錄表
     c.execute('''
-        CREATE TABLE IF NOT EXISTS drink_events (
+        CREATE TABLE IF NOT EXISTS hourly_totals (
+            date TEXT NOT NULL,
+            hour TEXT NOT NULL,
+            total_ml INTEGER NOT NULL DEFAULT 0,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (date, hour)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_drink_events_rollup
+        AFTER INSERT ON drink_events
+        BEGIN
+            INSERT INTO daily_totals (date, total_ml, count)
+            VALUES (date(NEW.timestamp), NEW.amount_ml, 1)
+            ON CONFLICT (date) DO UPDATE SET
+                total_ml = total_ml + excluded.total_ml,
+                count = count + 1;
+            INSERT INTO hourly_totals (date, hour, total_ml, count)
+            VALUES (date(NEW.timestamp), strftime('%H', NEW.timestamp), NEW.amount_ml, 1)
+            ON CONFLICT (date, hour) DO UPDATE SET
+                total_ml = total_ml + excluded.total_ml,
+                count = count + 1;
+        END
+    ''')
+    # 此時 drink_events 還沒有之後遷移加入的欄位，也還沒有封存資料
+    _rebuild_rollups(c, 'drink_events')
+
+def _migration_3_staging_table(c):
+    """離線重新推導的飲水事件（reprocess.py），依 run_id 分批保存以便比較"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS drink_events_staging (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id TEXT NOT NULL,
             bottle_id INTEGER,
             amount_ml INTEGER NOT NULL,
-            timestamp TIMESTAMP DEFAULT (datetime('now', 'localtime')),
-            FOREIGN KEY (bottle_id) REFERENCES bottles (id)
+            timestamp TIMESTAMP NOT NULL,
+            params TEXT
         )
     ''')
-    
-    # 系統設定表
+    c.execute('CREATE INDEX IF NOT EXISTS idx_staging_run ON drink_events_staging (run_id, timestamp)')
+
+def _migration_4_coasters(c):
+    """多杯墊：每個杯墊可指定自己的水壺，飲水記錄標記杯墊 ID"""
     c.execute('''
-        CREATE TABLE IF NOT EXISTS settings (
-            key TEXT PRIMARY KEY,
-            value TEXT NOT NULL,
-            updated_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+        CREATE TABLE IF NOT EXISTS coasters (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            bottle_id INTEGER,
+            FOREIGN KEY (bottle_id) REFERENCES bottles (id)
         )
     ''')
-    
-    # 即時狀態表（單行）
+    columns = [row[1] for row in c.execute('PRAGMA table_info(drink_events)')]
+    if 'coaster_id' not in columns:
+        c.execute('ALTER TABLE drink_events ADD COLUMN coaster_id TEXT')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_drink_events_coaster ON drink_events (coaster_id, timestamp)')
+
+def _migration_5_cache_versions(c):
+    """設定 / 水壺快取的版本號，由觸發器在每次修改時遞增"""
     c.execute('''
-        CREATE TABLE IF NOT EXISTS current_status (
-            id INTEGER PRIMARY KEY CHECK (id = 1),
-            water_ml INTEGER DEFAULT 0,
-            status TEXT DEFAULT 'OK',
-            last_drink_minutes INTEGER DEFAULT 0,
-            today_total_ml INTEGER DEFAULT 0,
-            timestamp TIMESTAMP DEFAULT (datetime('now', 'localtime'))
-        )
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
     ''')
-    
-    # 初始化預設設定
+    for table, name in (('settings', 'settings'), ('bottles', 'bottles'), ('coasters', 'bottles')):
+        _create_version_triggers(c, table, name)
+
+def _create_version_triggers(c, table: str, name: str):
+    """table 每次新增 / 修改 / 刪除時把 cache_versions[name] 加一"""
+    for op in ('INSERT', 'UPDATE', 'DELETE'):
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{op.lower()}
+            AFTER {op} ON {table}
+            BEGIN
+                INSERT INTO cache_versions (name, version) VALUES ('{name}', 1)
+                ON CONFLICT (name) DO UPDATE SET version = version + 1;
+            END
+        ''')
+
+def _migration_6_drink_version(c):
+    """飲水記錄的版本號（API 的 ETag 使用）"""
+    _create_version_triggers(c, 'drink_events', 'drinks')
+
+def _migration_7_history_version(c):
+    """過去日期的飲水記錄被新增 / 刪除時遞增 'history'，讓已結束區段的統計快取失效"""
+    for op, row in (('INSERT', 'NEW'), ('DELETE', 'OLD')):
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_drink_events_history_{op.lower()}
+            AFTER {op} ON drink_events
+            WHEN date({row}.timestamp) < date('now', 'localtime')
+            BEGIN
+                INSERT INTO cache_versions (name, version) VALUES ('history', 1)
+                ON CONFLICT (name) DO UPDATE SET version = version + 1;
+            END
+        ''')
+
+def _migration_8_event_uid(c):
+    """飲水事件的唯一 ID：日誌重送時以 INSERT OR IGNORE 避免重複"""
+    columns = [row[1] for row in c.execute('PRAGMA table_info(drink_events)')]
+    if 'event_uid' not in columns:
+        c.execute('ALTER TABLE drink_events ADD COLUMN event_uid TEXT')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_drink_events_uid ON drink_events (event_uid)')
+
+def _migration_9_devices(c):
+    """hub 模式：各裝置已收到的批次序號與最新狀態；飲水記錄標記來源裝置"""
     c.execute('''
-        INSERT OR IGNORE INTO settings (key, value) VALUES 
-        ('daily_goal_ml', '2000'),
-        ('remind_interval_min', '60')
+        CREATE TABLE IF NOT EXISTS devices (
+            id TEXT PRIMARY KEY,
+            last_seq INTEGER NOT NULL DEFAULT 0,
+            water_ml INTEGER,
+            status TEXT,
+            last_drink_minutes INTEGER,
+            today_total_ml INTEGER,
+            last_seen TIMESTAMP
+        ) WITHOUT ROWID
     ''')
-    
-    # 初始化狀態
-    c.execute('INSERT OR IGNORE INTO current_status (id) VALUES (1)')
-    
-    conn.commit()
-    conn.close()
-    print(f"✓ 資料庫初始化完成: {DB_PATH}")
+    columns = [row[1] for row in c.execute('PRAGMA table_info(drink_events)')]
+    if 'device_id' not in columns:
+        c.execute('ALTER TABLE drink_events ADD COLUMN device_id TEXT')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_drink_events_device ON drink_events (device_id, timestamp)')
+
+# 依序執行；已套用的版本記錄在 PRAGMA user_version
+_MIGRATIONS = [
+    _migration_1_drink_event_indexes,
+    _migration_2_rollup_tables,
+    _migration_3_staging_table,
+    _migration_4_coasters,
+    _migration_5_cache_versions,
+    _migration_6_drink_version,
+    _migration_7_history_version,
+    _migration_8_event_uid,
+    _migration_9_devices,
+]
+
+def _migrate(c):
+    """把既有資料庫升級到最新結構"""
+    version = c.execute('PRAGMA user_version').fetchone()[0]
+    for target, step in enumerate(_MIGRATIONS, start=1):
+        if version < target:
+            step(c)
+            c.execute(f'PRAGMA user_version = {target}')
+
+def _rebuild_rollups(c, source: str = 'drink_events_all'):
+    """由 drink_events（含已封存的記錄）重新計算彙總表"""
+    c.execute('DELETE FROM daily_totals')
+    c.execute('DELETE FROM hourly_totals')
+    c.execute(f'''
+        INSERT INTO daily_totals (date, total_ml, count)
+        SELECT date(timestamp), SUM(amount_ml), COUNT(*)
+        FROM {source}
+        GROUP BY date(timestamp)
+    ''')
+    c.execute(f'''
+        INSERT INTO hourly_totals (date, hour, total_ml, count)
+        SELECT date(timestamp), strftime('%H', timestamp), SUM(amount_ml), COUNT(*)
+        FROM {source}
+        GROUP BY date(timestamp), strftime('%H', timestamp)
+    ''')
+
+def rebuild_rollups():
+    """重建每日 / 每小時彙總表（手動修改 drink_events 後使用）"""
+    with _transaction() as c:
+        _rebuild_rollups(c)
+        # 過去日期的統計可能改變，讓區間統計快取失效
+        c.execute('''
+            INSERT INTO cache_versions (name, version) VALUES ('history', 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1
+        ''')
+    invalidate_cache()
+
+def _day_range(date: str = None) -> tuple:
+    """把 'YYYY-MM-DD'（預設今天）轉成半開區間 [當天 00:00:00, 隔天 00:00:00)"""
+    day = datetime.strptime(date, '%Y-%m-%d') if date else datetime.now()
+    start = day.replace(hour=0, minute=0, second=0, microsecond=0)
+    return start.strftime(TS_FORMAT), (start + timedelta(days=1)).strftime(TS_FORMAT)
 
 # ========== 水壺管理 ==========
 
 def add_bottle(name: str, empty_weight: float, capacity: int, photo_path: str = None) -> int:
     """新增水壺"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-        INSERT INTO bottles (name, empty_weight, capacity, photo_path)
-        VALUES (?, ?, ?, ?)
-    ''', (name, empty_weight, capacity, photo_path))
-    bottle_id = c.lastrowid
-    conn.commit()
-    conn.close()
-    return bottle_id
+    with _transaction() as conn:
+        c = conn.execute('''
+            INSERT INTO bottles (name, empty_weight, capacity, photo_path)
+            VALUES (?, ?, ?, ?)
+        ''', (name, empty_weight, capacity, photo_path))
+    invalidate_cache()
+    return c.lastrowid
+
+def _load_all_bottles() -> List[Dict]:
+    with _connection() as conn:
+        rows = conn.execute('SELECT * FROM bottles ORDER BY created_at DESC').fetchall()
+    return [dict(row) for row in rows]
 
 def get_all_bottles() -> List[Dict]:
     """取得所有水壺"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('SELECT * FROM bottles ORDER BY created_at DESC')
-    bottles = [dict(row) for row in c.fetchall()]
-    conn.close()
-    return bottles
+    return _cached('bottles', 'all', _load_all_bottles)
+
+def _load_active_bottle() -> Optional[Dict]:
+    with _connection() as conn:
+        bottle = conn.execute('SELECT * FROM bottles WHERE is_active = 1 LIMIT 1').fetchone()
+    return dict(bottle) if bottle else None
 
 def get_active_bottle() -> Optional[Dict]:
     """取得當前使用的水壺"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('SELECT * FROM bottles WHERE is_active = 1 LIMIT 1')
-    bottle = c.fetchone()
-    conn.close()
-    return dict(bottle) if bottle else None
+    return _cached('bottles', 'active', _load_active_bottle)
 
 def set_active_bottle(bottle_id: int):
     """設定當前使用的水壺"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    # 先取消所有啟用
-    c.execute('UPDATE bottles SET is_active = 0')
-    # 啟用指定水壺
-    c.execute('UPDATE bottles SET is_active = 1 WHERE id = ?', (bottle_id,))
-    conn.commit()
-    conn.close()
+    with _transaction() as c:
+        # 先取消所有啟用
+        c.execute('UPDATE bottles SET is_active = 0')
+        # 啟用指定水壺
+        c.execute('UPDATE bottles SET is_active = 1 WHERE id = ?', (bottle_id,))
+    invalidate_cache()
 
 def update_bottle(bottle_id: int, name: str, empty_weight: float, capacity: int, photo_path: str = None):
     """更新水壺資訊"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    if photo_path:
-        c.execute('''
-            UPDATE bottles 
-            SET name = ?, empty_weight = ?, capacity = ?, photo_path = ?
-            WHERE id = ?
-        ''', (name, empty_weight, capacity, photo_path, bottle_id))
-    else:
-        c.execute('''
-            UPDATE bottles 
-            SET name = ?, empty_weight = ?, capacity = ?
-            WHERE id = ?
-        ''', (name, empty_weight, capacity, bottle_id))
-    conn.commit()
-    conn.close()
+    with _transaction() as c:
+        if photo_path:
+            c.execute('''
+                UPDATE bottles 
+                SET name = ?, empty_weight = ?, capacity = ?, photo_path = ?
+                WHERE id = ?
+            ''', (name, empty_weight, capacity, photo_path, bottle_id))
+        else:
+            c.execute('''
+                UPDATE bottles 
+                SET name = ?, empty_weight = ?, capacity = ?
+                WHERE id = ?
+            ''', (name, empty_weight, capacity, bottle_id))
+    invalidate_cache()
 
 def delete_bottle(bottle_id: int):
     """刪除水壺"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('DELETE FROM bottles WHERE id = ?', (bottle_id,))
-    conn.commit()
-    conn.close()
+    with _transaction() as c:
+        c.execute('DELETE FROM bottles WHERE id = ?', (bottle_id,))
+        c.execute('UPDATE coasters SET bottle_id = NULL WHERE bottle_id = ?', (bottle_id,))
+    invalidate_cache()
+
+# ========== 杯墊管理 ==========
+
+def _load_all_coasters() -> List[Dict]:
+    with _connection() as conn:
+        rows = conn.execute('''
+            SELECT c.id, c.name, c.bottle_id, b.name AS bottle_name, b.empty_weight
+            FROM coasters c
+            LEFT JOIN bottles b ON b.id = c.bottle_id
+            ORDER BY c.id
+        ''').fetchall()
+    return [dict(row) for row in rows]
+
+def get_all_coasters() -> List[Dict]:
+    """取得所有杯墊與其水壺"""
+    return _cached('bottles', 'coasters', _load_all_coasters)
+
+def register_coaster(coaster_id: str, name: str = None):
+    """登記杯墊（已存在時不變）"""
+    with _transaction() as c:
+        c.execute('INSERT OR IGNORE INTO coasters (id, name) VALUES (?, ?)', (coaster_id, name or coaster_id))
+    invalidate_cache()
+
+def set_coaster_bottle(coaster_id: str, bottle_id: Optional[int]):
+    """指定杯墊使用的水壺（None 表示跟隨目前使用中的水壺）"""
+    with _transaction() as c:
+        c.execute('''
+            INSERT INTO coasters (id, name, bottle_id) VALUES (?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET bottle_id = excluded.bottle_id
+        ''', (coaster_id, coaster_id, bottle_id))
+    invalidate_cache()
+
+def _load_coaster_bottle(coaster_id: str) -> Optional[Dict]:
+    with _connection() as conn:
+        bottle = conn.execute('''
+            SELECT b.* FROM coasters c
+            JOIN bottles b ON b.id = c.bottle_id
+            WHERE c.id = ?
+        ''', (coaster_id,)).fetchone()
+    return dict(bottle) if bottle else None
+
+def get_coaster_bottle(coaster_id: str) -> Optional[Dict]:
+    """取得杯墊的水壺；未指定時使用目前使用中的水壺"""
+    bottle = _cached('bottles', ('coaster', coaster_id), lambda: _load_coaster_bottle(coaster_id))
+    return bottle or get_active_bottle()
 
 # ========== 飲水記錄 ==========
 
-def add_drink_event(amount_ml: int, bottle_id: int = None):
-    """記錄飲水事件"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    c.execute('''
-        INSERT INTO drink_events (bottle_id, amount_ml)
-        VALUES (?, ?)
-    ''', (bottle_id, amount_ml))
-    conn.commit()
-    conn.close()
+def add_drink_event(amount_ml: int, bottle_id: int = None, coaster_id: str = None,
+                    timestamp: str = None, event_uid: str = None):
+    """記錄飲水事件（timestamp 預設為現在；相同 event_uid 只會記錄一次）"""
+    with _transaction() as c:
+        c.execute('''
+            INSERT OR IGNORE INTO drink_events (bottle_id, amount_ml, coaster_id, timestamp, event_uid)
+            VALUES (?, ?, ?, COALESCE(?, datetime('now', 'localtime')), ?)
+        ''', (bottle_id, amount_ml, coaster_id, timestamp, event_uid))
+    invalidate_cache()
+
+def add_drink_events(events: List[Dict]) -> int:
+    """在同一個交易中寫入多筆飲水事件（含 uid / timestamp），已存在的 uid 略過，回傳新寫入筆數"""
+    rows = [
+        (e.get('bottle_id'), int(e['amount_ml']), e.get('coaster_id'), e['timestamp'], e['uid'])
+        for e in events
+    ]
+    with _transaction() as c:
+        inserted = c.executemany('''
+            INSERT OR IGNORE INTO drink_events (bottle_id, amount_ml, coaster_id, timestamp, event_uid)
+            VALUES (?, ?, ?, ?, ?)
+        ''', rows).rowcount
+    invalidate_cache()
+    return inserted
 
 def get_today_drinks() -> List[Dict]:
     """取得今日飲水記錄"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('''
-        SELECT * FROM drink_events 
-        WHERE DATE(timestamp) = DATE('now', 'localtime')
-        ORDER BY timestamp DESC
-    ''')
-    drinks = [dict(row) for row in c.fetchall()]
-    conn.close()
-    return drinks
-
-def get_today_total() -> int:
-    """取得今日總飲水量"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-        SELECT COALESCE(SUM(amount_ml), 0) 
-        FROM drink_events 
-        WHERE DATE(timestamp) = DATE('now', 'localtime')
-    ''')
-    total = c.fetchone()[0]
-    conn.close()
-    return total
+    with _connection() as conn:
+        rows = conn.execute('''
+            SELECT * FROM drink_events 
+            WHERE timestamp >= ? AND timestamp < ?
+            ORDER BY timestamp DESC
+        ''', _day_range()).fetchall()
+    return [dict(row) for row in rows]
+
+def get_today_total(coaster_id: str = None) -> int:
+    """取得今日總飲水量（指定 coaster_id 時只計算該杯墊）"""
+    if coaster_id is not None:
+        with _connection() as conn:
+            row = conn.execute('''
+                SELECT COALESCE(SUM(amount_ml), 0) FROM drink_events
+                WHERE coaster_id = ? AND timestamp >= ? AND timestamp < ?
+            ''', (coaster_id, *_day_range())).fetchone()
+        return row[0]
+
+    today = datetime.now().strftime('%Y-%m-%d')
+    with _connection() as conn:
+        row = conn.execute('SELECT total_ml FROM daily_totals WHERE date = ?', (today,)).fetchone()
+    return row[0] if row else 0
 
 def get_drinks_by_date(date: str) -> List[Dict]:
-    """取得指定日期的飲水記錄"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('''
-        SELECT * FROM drink_events 
-        WHERE DATE(timestamp) = ?
-        ORDER BY timestamp DESC
-    ''', (date,))
-    drinks = [dict(row) for row in c.fetchall()]
-    conn.close()
-    return drinks
+    """取得指定日期的飲水記錄（含已封存的記錄）"""
+    with _connection() as conn:
+        rows = conn.execute('''
+            SELECT * FROM drink_events_all
+            WHERE timestamp >= ? AND timestamp < ?
+            ORDER BY timestamp DESC
+        ''', _day_range(date)).fetchall()
+    return [dict(row) for row in rows]
 
 def get_hourly_stats(date: str = None) -> List[Dict]:
     """取得每小時飲水統計"""
     if not date:
         date = datetime.now().strftime('%Y-%m-%d')
-    
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('''
-        SELECT 
-            strftime('%H', timestamp) as hour,
-            SUM(amount_ml) as total_ml,
-            COUNT(*) as count
-        FROM drink_events 
-        WHERE DATE(timestamp) = ?
-        GROUP BY hour
-        ORDER BY hour
-    ''', (date,))
-    stats = [dict(row) for row in c.fetchall()]
-    conn.close()
-    return stats
+
+    with _connection() as conn:
+        rows = conn.execute('''
+            SELECT hour, total_ml, count
+            FROM hourly_totals
+            WHERE date = ?
+            ORDER BY hour
+        ''', (date,)).fetchall()
+    return [dict(row) for row in rows]
+
+# ========== 區間統計 ==========
+
+RANGE_BUCKETS = ('hour', 'day', 'week', 'month')
+
+# 每個區段的鍵值（週以星期一為起點）
+_BUCKET_KEY = {
+    'day': "date",
+    'week': "date(date, '-6 days', 'weekday 1')",
+    'month': "strftime('%Y-%m', date)",
+}
+
+def _bucket_start(day: datetime, bucket: str) -> datetime:
+    """day 所在區段的第一天"""
+    if bucket == 'week':
+        return day - timedelta(days=day.weekday())
+    if bucket == 'month':
+        return day.replace(day=1)
+    return day
+
+def _query_range(start: str, end: str, bucket: str, goal: int) -> List[Dict]:
+    """單一 SQL 計算 [start, end] 各區段的總量、次數與達標天數（日期含頭含尾）"""
+    with _connection() as conn:
+        if bucket == 'hour':
+            rows = conn.execute('''
+                SELECT date || ' ' || hour AS bucket, date AS start,
+                       total_ml, count
+                FROM hourly_totals
+                WHERE date >= ? AND date <= ?
+                ORDER BY date, hour
+            ''', (start, end)).fetchall()
+            return [dict(row) for row in rows]
+
+        rows = conn.execute(f'''
+            WITH RECURSIVE days(date) AS (
+                SELECT :start
+                UNION ALL
+                SELECT date(date, '+1 day') FROM days WHERE date < :end
+            ),
+            per_day AS (
+                SELECT days.date, COALESCE(t.total_ml, 0) AS total_ml, COALESCE(t.count, 0) AS count
+                FROM days
+                LEFT JOIN daily_totals t ON t.date = days.date
+            )
+            SELECT {_BUCKET_KEY[bucket]} AS bucket, MIN(date) AS start,
+                   SUM(total_ml) AS total_ml, SUM(count) AS count,
+                   COUNT(*) AS days,
+                   SUM(total_ml >= :goal) AS days_met,
+                   ROUND(AVG(MIN(total_ml * 100.0 / :goal, 100)), 1) AS goal_pct
+            FROM per_day
+            GROUP BY bucket
+            ORDER BY bucket
+        ''', {'start': start, 'end': end, 'goal': max(goal, 1)}).fetchall()
+    return [dict(row) for row in rows]
+
+@lru_cache(maxsize=RANGE_CACHE_SIZE)
+def _closed_range(db_path: str, start: str, end: str, bucket: str, goal: int, version: int) -> tuple:
+    """已結束區段的統計；過去的資料只有 'history' 版本改變時才需要重算"""
+    return tuple(_query_range(start, end, bucket, goal))
+
+def get_drink_range(start_date: str, end_date: str, bucket: str = 'day') -> Dict:
+    """取得 [start_date, end_date] 依小時 / 日 / 週 / 月分組的飲水統計與每日目標達成情況"""
+    if bucket not in RANGE_BUCKETS:
+        raise ValueError(f"不支援的區段: {bucket}")
+    first = datetime.strptime(start_date, '%Y-%m-%d')
+    last = datetime.strptime(end_date, '%Y-%m-%d')
+    if last < first:
+        raise ValueError("結束日期早於起始日期")
+    max_days = RANGE_MAX_HOUR_DAYS if bucket == 'hour' else RANGE_MAX_DAYS
+    if (last - first).days >= max_days:
+        raise ValueError(f"查詢區間最多 {max_days} 天")
+
+    goal = int(get_setting('daily_goal_ml') or 2000)
+
+    # 今天所在的區段還會變動，之前的區段已結束、可以快取
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    open_start = max(_bucket_start(today, bucket), first)
+    buckets = []
+    if first < open_start:
+        closed_end = min(last, open_start - timedelta(days=1)).strftime('%Y-%m-%d')
+        version = _cache_versions().get('history', 0)
+        buckets += [dict(b) for b in _closed_range(DB_PATH, start_date, closed_end, bucket, goal, version)]
+    if open_start <= last:
+        buckets += _query_range(open_start.strftime('%Y-%m-%d'), end_date, bucket, goal)
+
+    total_ml = sum(b['total_ml'] for b in buckets)
+    summary = {'total_ml': total_ml, 'count': sum(b['count'] for b in buckets), 'goal_ml': goal}
+    if bucket != 'hour':
+        days = sum(b['days'] for b in buckets)
+        summary.update(
+            days=days,
+            days_met=sum(b['days_met'] for b in buckets),
+            avg_daily_ml=round(total_ml / days) if days else 0,
+        )
+    return {'bucket': bucket, 'from': start_date, 'to': end_date, 'buckets': buckets, 'summary': summary}
+
+def get_last_drink_id() -> int:
+    """取得最新一筆飲水記錄的 ID（沒有記錄時為 0）"""
+    with _connection() as conn:
+        row = conn.execute('SELECT COALESCE(MAX(id), 0) FROM drink_events').fetchone()
+    return row[0]
+
+def get_drinks_since(last_id: int, limit: int = -1) -> List[Dict]:
+    """取得 ID 大於 last_id 的飲水記錄（由舊到新，最多 limit 筆；-1 為不限）"""
+    with _connection() as conn:
+        rows = conn.execute('''
+            SELECT * FROM drink_events
+            WHERE id > ?
+            ORDER BY id
+            LIMIT ?
+        ''', (last_id, limit)).fetchall()
+    return [dict(row) for row in rows]
+
+# ========== 多裝置匯集（hub） ==========
+
+def ingest_batch(device_id: str, seq: int, events: List[Dict], status: Dict = None) -> Dict:
+    """寫入一台裝置上傳的一批飲水事件與狀態（單一交易）
+
+    seq 為裝置端遞增的批次序號；不大於已收到的序號時標記為 duplicate（重送，或裝置遺失了上傳進度）。
+    不論序號為何，事件一律以 event_uid 做 INSERT OR IGNORE：同一筆事件只記錄一次，
+    序號重新開始的裝置送來的新事件也不會被當成重送而丟掉。
+    沒有事件的批次（只更新狀態）不檢查也不更新 seq。
+    """
+    rows = [
+        (_normalize_ts(e['timestamp']), int(e['amount_ml']), e.get('coaster_id'), device_id, e['uid'])
+        for e in events
+    ]
+    status = status or {}
+    with _transaction() as c:
+        # 先寫入再讀取：交易一開始就取得寫入鎖，同一裝置的並行請求不會互相死結
+        c.execute('INSERT OR IGNORE INTO devices (id) VALUES (?)', (device_id,))
+        last_seq = c.execute('SELECT last_seq FROM devices WHERE id = ?', (device_id,)).fetchone()[0]
+        inserted = 0
+        last_drink = None
+        duplicate = bool(rows) and seq <= last_seq
+        if rows:
+            inserted = c.executemany('''
+                INSERT OR IGNORE INTO drink_events (timestamp, amount_ml, coaster_id, device_id, event_uid)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows).rowcount
+            last_seq = max(last_seq, seq)
+            if inserted:
+                last_drink = max(row[0] for row in rows)
+        c.execute('''
+            UPDATE devices
+            SET last_seq = ?, last_seen = datetime('now', 'localtime'),
+                water_ml = COALESCE(?, water_ml), status = COALESCE(?, status),
+                last_drink_minutes = COALESCE(?, last_drink_minutes),
+                today_total_ml = COALESCE(?, today_total_ml)
+            WHERE id = ?
+        ''', (last_seq, status.get('water_ml'), status.get('status'), status.get('last_drink_minutes'),
+              status.get('today_total_ml'), device_id))
+    if inserted:
+        invalidate_cache()
+    return {'duplicate': duplicate, 'inserted': inserted, 'last_seq': last_seq, 'last_drink': last_drink}
+
+def get_devices() -> List[Dict]:
+    """取得所有上傳過資料的裝置與其最新狀態"""
+    with _connection() as conn:
+        rows = conn.execute('SELECT * FROM devices ORDER BY id').fetchall()
+    return [dict(row) for row in rows]
+
+def get_device_last_drinks() -> Dict[str, str]:
+    """各裝置最後一次飲水的時間（沒有記錄時為最後上傳時間），提醒排程啟動時使用"""
+    with _connection() as conn:
+        rows = conn.execute('''
+            SELECT d.id,
+                   COALESCE((SELECT MAX(timestamp) FROM drink_events e WHERE e.device_id = d.id),
+                            d.last_seen) AS last_drink
+            FROM devices d
+        ''').fetchall()
+    return {row['id']: row['last_drink'] for row in rows if row['last_drink']}
+
+# ========== 匯出 / 匯入 ==========
+
+EXPORT_COLUMNS = ('id', 'timestamp', 'amount_ml', 'bottle_id', 'coaster_id')
+
+def iter_drinks(start_date: str = None, end_date: str = None) -> Iterator[sqlite3.Row]:
+    """依時間順序逐批讀出飲水記錄（日期含頭含尾，含已封存的記錄），記憶體用量固定
+
+    日期格式在呼叫時就檢查（拋出 ValueError），不會等到開始讀取、回應已送出後才失敗。
+    """
+    # 邊界必須是日期字串：timestamp 欄位為 NUMERIC 親和性，'9999' 之類的值會被轉成數字而比較失準
+    start = _day_range(start_date)[0] if start_date else '0000-01-01 00:00:00'
+    end = _day_range(end_date)[1] if end_date else '9999-12-31 23:59:59'
+    return _iter_drink_rows(start, end)
+
+def _iter_drink_rows(start: str, end: str) -> Iterator[sqlite3.Row]:
+    with _connection() as conn:
+        cursor = conn.execute(f'''
+            SELECT {', '.join(EXPORT_COLUMNS)} FROM drink_events_all
+            WHERE timestamp >= ? AND timestamp < ?
+            ORDER BY timestamp, id
+        ''', (start, end))
+        while True:
+            rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            yield from rows
+
+def _normalize_ts(value: str) -> str:
+    """接受 'YYYY-MM-DD HH:MM:SS' 或 ISO 格式，統一成 TS_FORMAT"""
+    return datetime.fromisoformat(str(value).strip()).strftime(TS_FORMAT)
+
+def import_drinks(rows: Iterable[Dict]) -> Dict:
+    """批次匯入飲水記錄；整批在同一個交易中，任何一筆格式錯誤就全部不寫入
+
+    rows 為含 timestamp / amount_ml（可選 bottle_id / coaster_id）的 dict；
+    與既有記錄的時間、水量、杯墊都相同時視為重複而略過，因此同一份檔案可重複匯入。
+    """
+    sql = '''
+        INSERT INTO drink_events (timestamp, amount_ml, bottle_id, coaster_id)
+        SELECT ?, ?, ?, ?
+        WHERE NOT EXISTS (
+            SELECT 1 FROM drink_events_all
+            WHERE timestamp = ? AND amount_ml = ? AND coaster_id IS ?
+        )
+    '''
+    total = inserted = 0
+    with _transaction() as c:
+        batch = []
+        for line, row in enumerate(rows, start=1):
+            try:
+                ts = _normalize_ts(row['timestamp'])
+                amount_ml = int(row['amount_ml'])
+                if amount_ml <= 0:
+                    raise ValueError(f"飲水量必須大於 0: {amount_ml}")
+                bottle_id = int(row['bottle_id']) if row.get('bottle_id') not in (None, '') else None
+                coaster_id = row.get('coaster_id') or None
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"第 {line} 筆格式錯誤: {e}")
+            batch.append((ts, amount_ml, bottle_id, coaster_id, ts, amount_ml, coaster_id))
+            total += 1
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                # rowcount 只計算本身插入的筆數（不含觸發器），重複的記錄不會計入
+                inserted += c.executemany(sql, batch).rowcount
+                batch.clear()
+        if batch:
+            inserted += c.executemany(sql, batch).rowcount
+    invalidate_cache()
+    return {'rows': total, 'inserted': inserted, 'skipped': total - inserted}
+
+# ========== 離線重新推導 ==========
+
+def replace_staging_events(run_id: str, bottle_id: Optional[int], events: List[tuple], params: Dict = None):
+    """以 [(epoch 秒, ml)] 取代某個 run_id 的 staging 事件"""
+    params_json = json.dumps(params, sort_keys=True) if params else None
+    rows = [
+        (run_id, bottle_id, int(ml), datetime.fromtimestamp(ts).strftime(TS_FORMAT), params_json)
+        for ts, ml in events
+    ]
+    with _transaction() as c:
+        c.execute('DELETE FROM drink_events_staging WHERE run_id = ?', (run_id,))
+        c.executemany('''
+            INSERT INTO drink_events_staging (run_id, bottle_id, amount_ml, timestamp, params)
+            VALUES (?, ?, ?, ?, ?)
+        ''', rows)
+
+def compare_staging(run_id: str, start_date: str, end_date: str) -> List[Dict]:
+    """逐日比較 staging 事件與正式飲水記錄"""
+    start, _ = _day_range(start_date)
+    _, end = _day_range(end_date)
+    with _connection() as conn:
+        rows = conn.execute('''
+            WITH staged AS (
+                SELECT date(timestamp) AS date, COUNT(*) AS n, SUM(amount_ml) AS ml
+                FROM drink_events_staging
+                WHERE run_id = ? AND timestamp >= ? AND timestamp < ?
+                GROUP BY date(timestamp)
+            ),
+            recorded AS (
+                SELECT date, count AS n, total_ml AS ml
+                FROM daily_totals
+                WHERE date >= ? AND date <= ?
+            ),
+            dates AS (
+                SELECT date FROM staged UNION SELECT date FROM recorded
+            )
+            SELECT d.date,
+                   COALESCE(r.n, 0) AS recorded_count, COALESCE(r.ml, 0) AS recorded_ml,
+                   COALESCE(s.n, 0) AS staged_count, COALESCE(s.ml, 0) AS staged_ml
+            FROM dates d
+            LEFT JOIN recorded r ON r.date = d.date
+            LEFT JOIN staged s ON s.date = d.date
+            ORDER BY d.date
+        ''', (run_id, start, end, start_date, end_date)).fetchall()
+    return [dict(row) for row in rows]
+
+# ========== 保存期限與空間回收 ==========
+
+def archive_old_events(retention_days: int = None) -> int:
+    """把早於保存期限的原始飲水記錄移到封存資料庫，回傳搬移筆數
+
+    retention_days 預設讀取設定 retention_days（0 為永久保存，今天的記錄一定保留）。
+    每日 / 每小時彙總表不受影響；單日明細、匯出與匯入比對會透過 drink_events_all 一併查詢封存資料。
+    """
+    if retention_days is None:
+        retention_days = int(get_setting('retention_days') or 0)
+    if retention_days <= 0:
+        return 0
+    cutoff = _day_range((datetime.now() - timedelta(days=retention_days)).strftime('%Y-%m-%d'))[0]
+    # WAL 模式下跨資料庫的交易不保證整體原子性：先複製並提交，再從主資料庫刪除
+    with _transaction() as c:
+        c.execute(f'''
+            INSERT OR IGNORE INTO archive.drink_events ({_ARCHIVE_COLUMNS})
+            SELECT {_ARCHIVE_COLUMNS} FROM main.drink_events WHERE timestamp < ?
+        ''', (cutoff,))
+    with _transaction() as c:
+        moved = c.execute('''
+            DELETE FROM main.drink_events
+            WHERE timestamp < ? AND id IN (SELECT id FROM archive.drink_events)
+        ''', (cutoff,)).rowcount
+    if moved:
+        invalidate_cache()
+    return moved
+
+def incremental_vacuum(max_pages: int = VACUUM_PAGES) -> int:
+    """回收最多 max_pages 個空頁，回傳回收的頁數
+
+    需要 auto_vacuum=INCREMENTAL；舊資料庫第一次呼叫時會先執行一次完整的 VACUUM 轉換
+    （只在感測器閒置時由 main.py 呼叫）。
+    """
+    with _connection() as conn:
+        if conn.execute('PRAGMA main.auto_vacuum').fetchone()[0] != 2:
+            conn.execute('PRAGMA main.auto_vacuum=INCREMENTAL')
+            conn.execute('VACUUM main')
+            return 0
+        free = conn.execute('PRAGMA main.freelist_count').fetchone()[0]
+        if free < VACUUM_MIN_FREE_PAGES:
+            return 0
+        pages = min(free, max_pages)
+        # execute() 只執行一步（只回收一頁）；executescript 會執行到完成
+        conn.executescript(f'PRAGMA main.incremental_vacuum({pages});')
+    return pages
+
+def run_maintenance() -> Dict:
+    """封存過期記錄並回收空間"""
+    return {'archived': archive_old_events(), 'vacuumed_pages': incremental_vacuum()}
 
 # ========== 系統設定 ==========
 
 def get_setting(key: str) -> str:
     """取得設定值"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT value FROM settings WHERE key = ?', (key,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else None
+    return get_all_settings().get(key)
 
 def set_setting(key: str, value: str):
     """設定值"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-        INSERT OR REPLACE INTO settings (key, value, updated_at)
-        VALUES (?, ?, datetime('now', 'localtime'))
-    ''', (key, value))
-    conn.commit()
-    conn.close()
+    with _transaction() as c:
+        c.execute('''
+            INSERT OR REPLACE INTO settings (key, value, updated_at)
+            VALUES (?, ?, datetime('now', 'localtime'))
+        ''', (key, value))
+    invalidate_cache()
+
+def _load_all_settings() -> Dict:
+    with _connection() as conn:
+        rows = conn.execute('SELECT key, value FROM settings').fetchall()
+    return {row['key']: row['value'] for row in rows}
 
 def get_all_settings() -> Dict:
     """取得所有設定"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('SELECT key, value FROM settings')
-    settings = {row['key']: row['value'] for row in c.fetchall()}
-    conn.close()
-    return settings
+    return _cached('settings', None, _load_all_settings)
 
 # ========== 即時狀態 ==========
 
 def update_status(water_ml: int, status: str, last_drink_minutes: int, today_total_ml: int):
     """更新即時狀態"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-        UPDATE current_status 
-        SET water_ml = ?, status = ?, last_drink_minutes = ?, 
-            today_total_ml = ?, timestamp = datetime('now', 'localtime')
-        WHERE id = 1
-    ''', (water_ml, status, last_drink_minutes, today_total_ml))
-    conn.commit()
-    conn.close()
+    with _transaction() as c:
+        c.execute('''
+            UPDATE current_status 
+            SET water_ml = ?, status = ?, last_drink_minutes = ?, 
+                today_total_ml = ?, timestamp = datetime('now', 'localtime')
+            WHERE id = 1
+        ''', (water_ml, status, last_drink_minutes, today_total_ml))
 
 def get_current_status() -> Dict:
     """取得即時狀態"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('SELECT * FROM current_status WHERE id = 1')
-    status = dict(c.fetchone())
-    conn.close()
-    return status
+    with _connection() as conn:
+        status = conn.execute('SELECT * FROM current_status WHERE id = 1').fetchone()
+    return dict(status)
+
+# ========== 效能量測 ==========
+
+DB_CALL_SECONDS = metrics.histogram(
+    'hydration_db_call_seconds', 'database.py 查詢 / 寫入函式的耗時', ['function'])
+
+# 只量測實際執行 SQL 的函式；快取的讀取函式量測其載入函式（快取未命中時才執行），
+# archive_path / get_versions / invalidate_cache 這類每次連線或請求都會呼叫的小函式不量測
+_INSTRUMENTED = (
+    # 寫入
+    'init_database', 'rebuild_rollups', 'add_bottle', 'set_active_bottle', 'update_bottle', 'delete_bottle',
+    'register_coaster', 'set_coaster_bottle', 'add_drink_event', 'add_drink_events', 'ingest_batch',
+    'import_drinks', 'replace_staging_events', 'archive_old_events', 'incremental_vacuum',
+    'set_setting', 'update_status',
+    # 查詢
+    'get_today_drinks', 'get_today_total', 'get_drinks_by_date', 'get_hourly_stats', 'get_drink_range',
+    'get_last_drink_id', 'get_drinks_since', 'get_devices', 'get_device_last_drinks', 'compare_staging',
+    'get_current_status',
+    # 快取未命中時的查詢
+    '_load_all_bottles', '_load_active_bottle', '_load_all_coasters', '_load_coaster_bottle',
+    '_load_all_settings',
+)
+
+def _instrument():
+    """幫 _INSTRUMENTED 中的函式加上耗時量測"""
+    module = globals()
+    for name in _INSTRUMENTED:
+        module[name] = metrics.timed(DB_CALL_SECONDS, name)(module[name])
+
+_instrument()
 
 # ========== 初始化 ==========
 
 if __name__ == "__main__":
+    import sys
+
     init_database()
+
+    if sys.argv[1:] == ['rebuild-rollups']:
+        rebuild_rollups()
+        print("✓ 彙總表已重建")
+        sys.exit(0)
+
     print("資料庫測試：")
     
     # 測試新增水壺
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+智慧飲水系統 - 飲水事件偵測
+
+把 main.py 迴圈中的自適應 EMA、拿起偵測、穩定判斷與飲水判斷
+抽成不含任何 I/O 的狀態機：逐筆餵入重量（g），偵測到飲水時回傳飲水量（ml）。
+"""
+
+from collections import deque
+from typing import Dict, Iterable, List, Tuple
+
+# 預設參數（與 main.py 設定區相同）
+DRINK_EVENT_MIN_ML = 15
+LIFT_DROP_G = 100
+LIFT_MIN_PRESENT_G = -200
+STABLE_VAR_G = 20
+STABLE_WINDOW = 8
+
+# 自適應 EMA：變化越大，越相信新樣本
+EMA_FAST_CHANGE_G = 100
+EMA_MID_CHANGE_G = 20
+EMA_FAST_ALPHA = 0.6
+EMA_MID_ALPHA = 0.4
+EMA_SLOW_ALPHA = 0.2
+
+
+class DrinkDetector:
+    """飲水事件狀態機
+
+    每次 feed() 後可讀取 ema_g / water_ml / stable / lifting / last_stable_ml。
+    穩定判斷使用單調佇列維護最近 STABLE_WINDOW 筆 EMA 的最小 / 最大值，每筆 O(1)。
+    """
+
+    __slots__ = (
+        'empty_bottle_g', 'drink_min_ml', 'lift_drop_g', 'lift_min_present_g',
+        'stable_var_g', 'window',
+        'ema_g', 'prev_ema_g', 'water_ml', 'stable', 'lifting', 'last_stable_ml',
+        '_n', '_min_q', '_max_q',
+    )
+
+    def __init__(self, empty_bottle_g: float,
+                 drink_min_ml: int = DRINK_EVENT_MIN_ML,
+                 lift_drop_g: float = LIFT_DROP_G,
+                 lift_min_present_g: float = LIFT_MIN_PRESENT_G,
+                 stable_var_g: float = STABLE_VAR_G,
+                 window: int = STABLE_WINDOW):
+        self.empty_bottle_g = empty_bottle_g
+        self.drink_min_ml = drink_min_ml
+        self.lift_drop_g = lift_drop_g
+        self.lift_min_present_g = lift_min_present_g
+        self.stable_var_g = stable_var_g
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        """清除濾波與穩定狀態"""
+        self.ema_g = None
+        self.prev_ema_g = None
+        self.water_ml = 0
+        self.stable = False
+        self.lifting = False
+        self.last_stable_ml = 0
+        self._n = 0
+        self._min_q = deque()
+        self._max_q = deque()
+
+    def state(self) -> Dict:
+        """可序列化的濾波狀態（寫入檢查點用）"""
+        return {
+            'empty_bottle_g': self.empty_bottle_g,
+            'ema_g': self.ema_g,
+            'last_stable_ml': self.last_stable_ml,
+        }
+
+    def restore(self, state: Dict) -> bool:
+        """由 state() 的結果還原；空壺重量不同（換了水壺）時不還原"""
+        if state.get('empty_bottle_g') != self.empty_bottle_g or state.get('ema_g') is None:
+            return False
+        self.reset()
+        ema_g = self.ema_g = self.prev_ema_g = state['ema_g']
+        self.last_stable_ml = state.get('last_stable_ml', 0)
+        # 視窗當作填滿了還原前的 EMA：新樣本要連續穩定一整個視窗才會判定穩定，
+        # 不會因為重啟後的第一筆雜訊就誤判飲水
+        self._n = self.window
+        self._min_q.append((self.window - 1, ema_g))
+        self._max_q.append((self.window - 1, ema_g))
+        return True
+
+    def feed(self, grams: float) -> int:
+        """餵入一筆重量樣本；偵測到飲水事件時回傳飲水量（ml），否則回傳 0"""
+        # EMA 濾波（自適應）
+        ema_g = self.ema_g
+        if ema_g is None:
+            ema_g = grams
+        else:
+            change = abs(grams - ema_g)
+            if change > EMA_FAST_CHANGE_G:
+                alpha = EMA_FAST_ALPHA
+            elif change > EMA_MID_CHANGE_G:
+                alpha = EMA_MID_ALPHA
+            else:
+                alpha = EMA_SLOW_ALPHA
+            ema_g = (alpha * grams) + ((1 - alpha) * ema_g)
+        self.ema_g = ema_g
+
+        # 滑動視窗最小 / 最大值（單調佇列）
+        n = self._n
+        self._n = n + 1
+        min_q = self._min_q
+        while min_q and min_q[-1][1] >= ema_g:
+            min_q.pop()
+        min_q.append((n, ema_g))
+        max_q = self._max_q
+        while max_q and max_q[-1][1] <= ema_g:
+            max_q.pop()
+        max_q.append((n, ema_g))
+        oldest = n - self.window
+        if min_q[0][0] <= oldest:
+            min_q.popleft()
+        if max_q[0][0] <= oldest:
+            max_q.popleft()
+
+        # 拿起判斷
+        prev = self.prev_ema_g
+        lifting = ema_g < self.lift_min_present_g or (prev is not None and prev - ema_g > self.lift_drop_g)
+        self.prev_ema_g = ema_g
+        self.lifting = lifting
+
+        water_g = ema_g - self.empty_bottle_g
+        water_ml = round(water_g) if water_g > 0 else 0
+        self.water_ml = water_ml
+
+        stable = not lifting and max_q[0][1] - min_q[0][1] <= self.stable_var_g
+        self.stable = stable
+
+        # 飲水事件：兩次穩定之間水量下降超過門檻
+        drank_ml = 0
+        if stable and water_ml > 0:
+            last = self.last_stable_ml
+            if last > 0 and last - water_ml >= self.drink_min_ml:
+                drank_ml = last - water_ml
+            self.last_stable_ml = water_ml
+        return drank_ml
+
+    def feed_many(self, samples: Iterable[float]) -> List[Tuple[int, int]]:
+        """批次餵入樣本，回傳 [(樣本索引, 飲水量 ml)]
+
+        與逐筆呼叫 feed() 結果相同；迴圈內只用區域變數，結束時再寫回狀態，
+        省下每筆的方法呼叫與屬性存取（重播、重算歷史軌跡時使用）。
+        """
+        empty_g = self.empty_bottle_g
+        drink_min_ml = self.drink_min_ml
+        lift_drop_g = self.lift_drop_g
+        lift_min_present_g = self.lift_min_present_g
+        stable_var_g = self.stable_var_g
+        window = self.window
+        ema_g = self.ema_g
+        prev = self.prev_ema_g
+        water_ml = self.water_ml
+        stable = self.stable
+        lifting = self.lifting
+        last = self.last_stable_ml
+        n = self._n
+        min_q = self._min_q
+        max_q = self._max_q
+        min_pop, max_pop = min_q.pop, max_q.pop
+        min_push, max_push = min_q.append, max_q.append
+        events = []
+        push_event = events.append
+        for i, grams in enumerate(samples):
+            if ema_g is None:
+                ema_g = grams
+            else:
+                change = grams - ema_g
+                if change < 0:
+                    change = -change
+                if change > EMA_FAST_CHANGE_G:
+                    ema_g = EMA_FAST_ALPHA * grams + (1 - EMA_FAST_ALPHA) * ema_g
+                elif change > EMA_MID_CHANGE_G:
+                    ema_g = EMA_MID_ALPHA * grams + (1 - EMA_MID_ALPHA) * ema_g
+                else:
+                    ema_g = EMA_SLOW_ALPHA * grams + (1 - EMA_SLOW_ALPHA) * ema_g
+
+            while min_q and min_q[-1][1] >= ema_g:
+                min_pop()
+            min_push((n, ema_g))
+            while max_q and max_q[-1][1] <= ema_g:
+                max_pop()
+            max_push((n, ema_g))
+            if min_q[0][0] <= n - window:
+                min_q.popleft()
+            if max_q[0][0] <= n - window:
+                max_q.popleft()
+            n += 1
+
+            lifting = ema_g < lift_min_present_g or (prev is not None and prev - ema_g > lift_drop_g)
+            prev = ema_g
+
+            water_g = ema_g - empty_g
+            water_ml = round(water_g) if water_g > 0 else 0
+            stable = not lifting and max_q[0][1] - min_q[0][1] <= stable_var_g
+
+            if stable and water_ml > 0:
+                if last > 0 and last - water_ml >= drink_min_ml:
+                    push_event((i, last - water_ml))
+                last = water_ml
+
+        self.ema_g = ema_g
+        self.prev_ema_g = prev
+        self.water_ml = water_ml
+        self.stable = stable
+        self.lifting = lifting
+        self.last_stable_ml = last
+        self._n = n
+        return events
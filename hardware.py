@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+智慧飲水系統 - 感測 / 顯示後端
+
+main.py 只透過 Hardware 存取 HX711、LCD 與時間，因此可以換成：
+    - create_pi_hardware()：樹莓派實體硬體（RPi.GPIO / hx711 / RPLCD）
+    - create_replay_hardware()：重播記錄或合成的重量軌跡，
+      搭配記憶體 LCD 與虛擬時鐘，在一般 Linux 上以超過即時的速度執行
+"""
+
+import csv
+import random
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import weight_trace
+
+
+class Hardware:
+    """一組感測 / 顯示後端
+
+    hx 是第一個杯墊的 HX711；create_scale(dout, sck) 可建立其他杯墊的 HX711（重播後端沒有）。
+    """
+
+    def __init__(self, hx, lcd, clock: Callable[[], float], sleep: Callable[[float], None],
+                 cleanup: Callable[[], None] = lambda: None, realtime: bool = True,
+                 create_scale: Optional[Callable[[int, int], object]] = None):
+        self.hx = hx
+        self.lcd = lcd
+        self.clock = clock
+        self.sleep = sleep
+        self.cleanup = cleanup
+        self.realtime = realtime
+        self.create_scale = create_scale
+
+
+# ========== 樹莓派實體硬體 ==========
+
+def create_pi_hardware(dout_pin: int, sck_pin: int, lcd_addr: int, cols: int, rows: int) -> Hardware:
+    """建立實體硬體後端（只有在這裡才 import 樹莓派專用套件）"""
+    import time
+
+    import RPi.GPIO as GPIO
+    from hx711 import HX711
+    from RPLCD.i2c import CharLCD
+
+    GPIO.setwarnings(False)
+    GPIO.setmode(GPIO.BCM)
+
+    lcd = CharLCD(
+        i2c_expander="PCF8574",
+        address=lcd_addr,
+        port=1,
+        cols=cols,
+        rows=rows,
+        charmap="A00"
+    )
+
+    def create_scale(dout: int, sck: int):
+        return HX711(dout_pin=dout, pd_sck_pin=sck)
+
+    return Hardware(create_scale(dout_pin, sck_pin), lcd, time.time, time.sleep,
+                    cleanup=GPIO.cleanup, create_scale=create_scale)
+
+
+# ========== 模擬後端 ==========
+
+class TraceExhausted(Exception):
+    """重播的軌跡已經讀完"""
+
+
+class VirtualClock:
+    """虛擬時鐘：sleep 只推進時間，不真的等待"""
+
+    def __init__(self, start: float = 0.0):
+        self.now = start
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, sec: float):
+        self.now += max(0.0, sec)
+
+
+class SimulatedHX711:
+    """依序回放重量軌跡的 HX711，介面與 hx711.HX711 相同
+
+    有時鐘與時間戳記時，讀取會跳到時鐘當下的樣本：取樣排程拉長（自適應取樣的閒置級）
+    時中間的樣本就讀不到，和實際硬體一樣。
+    """
+
+    def __init__(self, samples: Sequence[Tuple[float, float]], offset: float, scale: float,
+                 clock: Optional[VirtualClock] = None, noise_g: float = 0.0, seed: int = 0):
+        self.samples = samples
+        self.offset = offset
+        self.scale = scale
+        self.clock = clock
+        self.noise_g = noise_g
+        self.index = 0
+        self._rng = random.Random(seed)
+
+    def reset(self):
+        return False
+
+    def get_raw_data(self, times: int = 5) -> List[float]:
+        if self.index >= len(self.samples):
+            raise TraceExhausted()
+        if self.clock is not None:
+            # 容許 1 ms 的浮點誤差，固定週期取樣時不會誤跳樣本
+            now = self.clock.now + 1e-3
+            samples = self.samples
+            while (self.index + 1 < len(samples) and samples[self.index + 1][0] is not None
+                   and samples[self.index + 1][0] <= now):
+                self.index += 1
+        ts, grams = self.samples[self.index]
+        self.index += 1
+        if self.clock is not None and ts is not None:
+            # 有時間戳記的軌跡：時鐘跟著軌跡走
+            self.clock.now = max(self.clock.now, ts)
+        raws = []
+        for _ in range(times):
+            g = grams + (self._rng.gauss(0, self.noise_g) if self.noise_g else 0.0)
+            raws.append(g * self.scale + self.offset)
+        return raws
+
+
+class MemoryLCD:
+    """記憶體中的 LCD，介面與 RPLCD.CharLCD 相同，並統計寫出的字元數"""
+
+    def __init__(self, cols: int = 20, rows: int = 4):
+        self.cols = cols
+        self.rows = rows
+        self.lines = [' ' * cols for _ in range(rows)]
+        self.chars_written = 0
+        self.cursor_moves = 0
+        self._pos = (0, 0)
+
+    @property
+    def cursor_pos(self) -> Tuple[int, int]:
+        return self._pos
+
+    @cursor_pos.setter
+    def cursor_pos(self, pos: Tuple[int, int]):
+        self.cursor_moves += 1
+        self._pos = pos
+
+    def write_string(self, text: str):
+        row, col = self._pos
+        line = self.lines[row]
+        text = text[:self.cols - col]
+        self.lines[row] = line[:col] + text + line[col + len(text):]
+        self.chars_written += len(text)
+        self._pos = (row, col + len(text))
+
+    def clear(self):
+        self.lines = [' ' * self.cols for _ in range(self.rows)]
+        self._pos = (0, 0)
+
+
+def create_replay_hardware(samples: Sequence[Tuple[float, float]], offset: float, scale: float,
+                           cols: int = 20, rows: int = 4, noise_g: float = 0.0) -> Hardware:
+    """建立重播後端：模擬 HX711 + 記憶體 LCD + 虛擬時鐘"""
+    start = samples[0][0] if samples and samples[0][0] is not None else 0.0
+    clock = VirtualClock(start)
+    hx = SimulatedHX711(samples, offset, scale, clock=clock, noise_g=noise_g)
+    return Hardware(hx, MemoryLCD(cols, rows), clock.time, clock.sleep, realtime=False)
+
+
+# ========== 軌跡來源 ==========
+
+def load_trace(path: str) -> List[Tuple[float, float]]:
+    """讀取重量軌跡：weight_trace 的 .bin 檔，或 ts,grams 欄位的 CSV"""
+    if path.endswith('.bin'):
+        with open(path, 'rb') as f:
+            data = f.read()
+        usable = len(data) - len(data) % weight_trace.RECORD.size
+        return [(ts, grams) for ts, grams, _ in weight_trace.RECORD.iter_unpack(data[:usable])]
+
+    samples = []
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            try:
+                samples.append((float(row[0]), float(row[1])))
+            except (ValueError, IndexError):
+                continue  # 標題列或空白列
+    return samples
+
+
+def synthetic_trace(minutes: float = 60, empty_g: float = 150.0, start_ml: float = 500.0,
+                    period: float = 0.3, drink_every_min: float = 8, seed: int = 0,
+                    start_ts: float = 1_700_000_000.0) -> Dict:
+    """產生帶標記的合成軌跡：水壺靜置、拿起喝水、放回；缺水時補水
+
+    回傳 {'samples': [(ts, grams)], 'drinks': [(ts, ml)], 'empty_g': ...}
+    """
+    rng = random.Random(seed)
+    samples: List[Tuple[float, float]] = []
+    drinks: List[Tuple[float, float]] = []
+    ts = start_ts
+    water = start_ml
+    end = start_ts + minutes * 60
+
+    def emit(grams: float, count: int, noise: float = 1.5):
+        nonlocal ts
+        for _ in range(count):
+            samples.append((ts, grams + rng.gauss(0, noise)))
+            ts += period
+
+    while ts < end:
+        # 靜置一段時間
+        emit(empty_g + water, int(rng.uniform(0.5, 1.5) * drink_every_min * 60 / period))
+        if ts >= end:
+            break
+
+        if water < 80:
+            # 補水：拿起、放回時變重（不算飲水）
+            emit(0.0, int(rng.uniform(5, 15) / period), noise=20)
+            water = rng.uniform(400, 600)
+            continue
+
+        # 拿起喝水：感測器幾乎歸零，數秒後放回
+        sip = round(min(water - 20, rng.uniform(20, 200)))
+        emit(0.0, int(rng.uniform(3, 10) / period), noise=20)
+        water -= sip
+        drinks.append((ts, sip))
+
+    return {'samples': samples, 'drinks': drinks, 'empty_g': empty_g}
+
+
+def pack_trace(samples: Sequence[Tuple[float, float]]) -> bytes:
+    """把 (ts, grams) 軌跡打包成 weight_trace 的 .bin 格式（ema 欄位填 grams）"""
+    return b''.join(weight_trace.RECORD.pack(ts, g, g) for ts, g in samples)
+
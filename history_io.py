@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+智慧飲水系統 - 飲水記錄匯出 / 匯入
+
+匯出以產生器逐批輸出 CSV 或 NDJSON，資料量再大記憶體用量都固定；
+匯入逐行解析後交給 database.import_drinks() 批次寫入。
+
+    python3 history_io.py export --from 2024-01-01 --to 2024-12-31 > drinks.csv
+    python3 history_io.py import drinks.ndjson
+"""
+
+import argparse
+import contextlib
+import csv
+import io
+import json
+import sys
+from typing import Iterable, Iterator, Dict, TextIO
+
+import database as db
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+CHUNK_ROWS = 500   # 每個輸出區塊包含的筆數
+
+
+def export_chunks(rows: Iterable, fmt: str = 'csv') -> Iterator[str]:
+    """把飲水記錄轉成 CSV / NDJSON 文字區塊"""
+    if fmt not in FORMATS:
+        raise ValueError(f"不支援的格式: {fmt}")
+    buf = io.StringIO()
+    if fmt == 'csv':
+        writer = csv.writer(buf)
+        writer.writerow(db.EXPORT_COLUMNS)
+        write = writer.writerow
+    else:
+        def write(row):
+            buf.write(json.dumps(dict(zip(db.EXPORT_COLUMNS, row)), ensure_ascii=False))
+            buf.write('\n')
+
+    n = 0
+    for row in rows:
+        write(tuple(row))
+        n += 1
+        if n % CHUNK_ROWS == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def parse_rows(stream: TextIO, fmt: str = 'csv') -> Iterator[Dict]:
+    """逐行解析匯入檔（CSV 需有標題列）"""
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+    elif fmt == 'ndjson':
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        raise ValueError(f"不支援的格式: {fmt}")
+
+
+def guess_format(filename: str, default: str = 'csv') -> str:
+    """由副檔名判斷格式"""
+    name = (filename or '').lower()
+    if name.endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    if name.endswith('.csv'):
+        return 'csv'
+    return default
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_export = sub.add_parser('export', help="匯出到標準輸出")
+    p_export.add_argument('--from', dest='start', help="起始日期 YYYY-MM-DD")
+    p_export.add_argument('--to', dest='end', help="結束日期 YYYY-MM-DD（含）")
+    p_export.add_argument('--format', choices=FORMATS, default='csv')
+    p_import = sub.add_parser('import', help="由檔案匯入")
+    p_import.add_argument('path')
+    p_import.add_argument('--format', choices=FORMATS, default=None)
+    args = parser.parse_args()
+
+    # 初始化訊息改印到 stderr，避免混進匯出的資料
+    with contextlib.redirect_stdout(sys.stderr):
+        db.init_database()
+    if args.command == 'export':
+        for chunk in export_chunks(db.iter_drinks(args.start, args.end), args.format):
+            sys.stdout.write(chunk)
+    else:
+        fmt = args.format or guess_format(args.path)
+        with open(args.path, encoding='utf-8', newline='') as f:
+            result = db.import_drinks(parse_rows(f, fmt))
+        print(f"✓ 匯入 {result['inserted']} 筆，略過重複 {result['skipped']} 筆（共 {result['rows']} 筆）",
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+智慧飲水系統 - 飲水事件日誌（write-behind）
+
+偵測到飲水時先把事件追加到本機日誌檔（JSON Lines，寫入後 fsync），
+再由背景執行緒把尚未寫入的事件整批 commit 到 SQLite：
+
+    感測迴圈 ──append()──▶ drink_journal.jsonl ──JournalFlusher──▶ drink_events
+
+- 每筆事件有唯一的 event_uid，資料庫以 INSERT OR IGNORE 寫入，重送不會重複
+- 已寫入資料庫的位置記錄在 .offset 檔；當機重啟後從該位置繼續
+- 資料庫被鎖住（app.py 正在寫入）時以指數退避重試，事件不會遺失
+- 損壞或欄位不完整的行移到 drink_journal.jsonl.bad，不會卡住之後的事件
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import database as db
+
+JOURNAL_NAME = 'drink_journal.jsonl'
+FLUSH_SEC = 1.0               # 背景寫入的週期
+RETRY_MIN_SEC = 0.5           # 寫入失敗後的重試間隔（指數退避）
+RETRY_MAX_SEC = 30.0
+ROTATE_BYTES = 1024 * 1024    # 全部寫入資料庫後，日誌超過這個大小就清空
+
+
+def default_path() -> str:
+    """日誌與資料庫放在同一個資料夾"""
+    return os.path.join(os.path.dirname(os.path.abspath(db.DB_PATH)), JOURNAL_NAME)
+
+
+class DrinkJournal:
+    """只追加的飲水事件日誌"""
+
+    def __init__(self, path: str = None, fsync: bool = True):
+        self.path = path or default_path()
+        self.offset_path = self.path + '.offset'
+        self.bad_path = self.path + '.bad'
+        self._quarantined = set()   # 已移到 .bad 的行（起始位置），資料庫重試時不重複搬移
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._f = open(self.path, 'ab+')
+        # 上次當機時可能留下寫到一半的最後一行，先補上換行，避免和下一筆黏在一起
+        self._f.seek(0, os.SEEK_END)
+        if self._f.tell():
+            self._f.seek(-1, os.SEEK_END)
+            if self._f.read(1) != b'\n':
+                self._f.write(b'\n')
+                self._f.flush()
+
+    def append(self, amount_ml: int, ts: float = None, bottle_id: int = None,
+               coaster_id: str = None) -> str:
+        """寫入一筆飲水事件並 fsync，回傳 event_uid"""
+        event = {
+            'uid': uuid.uuid4().hex,
+            'timestamp': datetime.fromtimestamp(ts if ts is not None else time.time()).strftime(db.TS_FORMAT),
+            'amount_ml': int(amount_ml),
+            'bottle_id': bottle_id,
+            'coaster_id': coaster_id,
+        }
+        line = (json.dumps(event, ensure_ascii=False) + '\n').encode('utf-8')
+        with self._lock:
+            self._f.seek(0, os.SEEK_END)
+            self._f.write(line)
+            self._f.flush()
+            if self.fsync:
+                os.fsync(self._f.fileno())
+        return event['uid']
+
+    def committed_offset(self) -> int:
+        """已寫入資料庫的位置（位元組）"""
+        try:
+            with open(self.offset_path) as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _set_committed_offset(self, offset: int):
+        tmp = self.offset_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.offset_path)
+
+    def pending(self) -> Tuple[List[Dict], int]:
+        """讀出尚未寫入資料庫的事件，回傳 (事件, 讀到的結束位置)"""
+        offset = self.committed_offset()
+        with self._lock:
+            self._f.seek(0, os.SEEK_END)
+            size = self._f.tell()
+            if offset > size:
+                # 日誌被清空過而 .offset 沒更新到：從頭開始（重送的事件會被忽略）
+                offset = 0
+                self._quarantined.clear()
+            self._f.seek(offset)
+            data = self._f.read(size - offset)
+        # 只處理完整的行
+        end = data.rfind(b'\n') + 1
+        events = []
+        pos = offset
+        for raw in data[:end].splitlines(keepends=True):
+            start, pos = pos, pos + len(raw)
+            if not raw.strip():
+                continue
+            try:
+                event = json.loads(raw)
+                _check_event(event)
+            except (ValueError, TypeError, KeyError) as e:
+                self._quarantine(start, raw, e)
+                continue
+            events.append(event)
+        return events, offset + end
+
+    def _quarantine(self, start: int, raw: bytes, error: Exception):
+        """把無法寫入資料庫的一行移到 .bad 檔保留，之後的事件照常寫入"""
+        if start in self._quarantined:
+            return
+        self._quarantined.add(start)
+        print(f"日誌中有損壞的一行，已移到 {os.path.basename(self.bad_path)}: {raw.rstrip()[:80]!r}（{error}）")
+        try:
+            with open(self.bad_path, 'ab') as f:
+                f.write(raw.rstrip(b'\n') + b'\n')
+        except OSError as e:
+            print(f"無法寫入 {self.bad_path}: {e}")
+
+    def commit(self, end: int):
+        """標記 end 之前的事件已寫入資料庫；日誌太大且全部寫入時清空"""
+        with self._lock:
+            self._f.seek(0, os.SEEK_END)
+            if end == self._f.tell() and end >= ROTATE_BYTES:
+                self._f.truncate(0)
+                self._f.flush()
+                self._quarantined.clear()
+                os.fsync(self._f.fileno())
+                end = 0
+            self._set_committed_offset(end)
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+
+def _check_event(event: Dict):
+    """確認事件有 database.add_drink_events 需要的欄位，格式不符時拋出例外"""
+    if not isinstance(event, dict):
+        raise TypeError('不是 JSON 物件')
+    if not event['uid'] or not isinstance(event['uid'], str):
+        raise ValueError('uid 無效')
+    datetime.strptime(event['timestamp'], db.TS_FORMAT)
+    if int(event['amount_ml']) <= 0:
+        raise ValueError('飲水量必須大於 0')
+
+
+class JournalFlusher(threading.Thread):
+    """背景執行緒：把日誌中的事件整批寫入 SQLite（group commit）"""
+
+    def __init__(self, journal: DrinkJournal, interval: float = FLUSH_SEC):
+        super().__init__(name='journal-flusher', daemon=True)
+        self.journal = journal
+        self.interval = interval
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self.committed = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+
+    def notify(self):
+        """有新事件時呼叫，讓下一次寫入提早進行"""
+        self._wake.set()
+
+    def flush(self) -> int:
+        """寫入目前所有待寫事件，回傳新寫入的筆數；資料庫忙碌時拋出例外"""
+        events, end = self.journal.pending()
+        inserted = db.add_drink_events(events) if events else 0
+        if end != self.journal.committed_offset():
+            self.journal.commit(end)
+        self.committed += inserted
+        return inserted
+
+    def stop(self, timeout: float = 10.0):
+        self._stop_event.set()
+        self._wake.set()
+        self.join(timeout)
+
+    def run(self):
+        delay = RETRY_MIN_SEC
+        while True:
+            stopping = self._stop_event.is_set()
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # 資料庫鎖住或暫時無法寫入（或其他非預期錯誤）：事件仍在日誌中，稍後重試，
+                # 執行緒不能結束，否則之後的飲水事件都不會寫入資料庫
+                self.failures += 1
+                self.last_error = str(e)
+                kind = '資料庫寫入失敗' if isinstance(e, sqlite3.Error) else f'寫入失敗（{type(e).__name__}）'
+                print(f"  ✗ {kind}，{delay:.1f} 秒後重試: {e}")
+                if stopping:
+                    return
+                self._stop_event.wait(delay)
+                delay = min(delay * 2, RETRY_MAX_SEC)
+                continue
+            delay = RETRY_MIN_SEC
+            if stopping:
+                return
+            self._wake.wait(self.interval)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+智慧飲水系統 - 差異式 LCD 繪製
+
+PCF8574 I2C 擴充板每個字元要送好幾個 I2C 位元組，整頁 80 字元重寫相當慢。
+LCDRenderer 保留目前畫面的 framebuffer，只把有變動的字元區段送出，
+並限制最短更新間隔；畫面內容沒變時完全不碰 I2C。
+"""
+
+import time
+from typing import Callable, List, Optional, Sequence, Tuple
+
+MIN_REFRESH_SEC = 0.5   # 兩次實際更新之間的最短間隔
+MERGE_GAP = 2           # 兩段變動之間只隔幾個相同字元時合併送出（省一次游標移動）
+
+
+def diff_runs(old: str, new: str, merge_gap: int = MERGE_GAP) -> List[Tuple[int, str]]:
+    """比較同一行的新舊內容，回傳需要重寫的 [(起始欄, 字串)]"""
+    runs = []
+    start = None
+    last = -1
+    for col, (a, b) in enumerate(zip(old, new)):
+        if a == b:
+            continue
+        if start is not None and col - last - 1 > merge_gap:
+            runs.append((start, new[start:last + 1]))
+            start = None
+        if start is None:
+            start = col
+        last = col
+    if start is not None:
+        runs.append((start, new[start:last + 1]))
+    return runs
+
+
+class LCDRenderer:
+    """以 framebuffer 為基礎的 LCD 繪製器，介面為整頁字串"""
+
+    def __init__(self, lcd, cols: int = 20, rows: int = 4,
+                 min_interval: float = MIN_REFRESH_SEC,
+                 clock: Callable[[], float] = time.monotonic):
+        self.lcd = lcd
+        self.cols = cols
+        self.rows = rows
+        self.min_interval = min_interval
+        self.clock = clock
+        self.frame: Optional[List[str]] = None   # 目前 LCD 上的內容；None 表示未知，需整頁重畫
+        self._pending: Optional[List[str]] = None
+        self._last_refresh = None
+        # 統計
+        self.frames = 0
+        self.unchanged = 0
+        self.throttled = 0
+        self.chars_sent = 0
+        self.cursor_moves = 0
+
+    def _normalize(self, lines: Sequence[str]) -> List[str]:
+        lines = [(s[:self.cols]).ljust(self.cols) for s in lines[:self.rows]]
+        return lines + [' ' * self.cols] * (self.rows - len(lines))
+
+    def invalidate(self):
+        """LCD 內容被外部改變（例如 clear()）後呼叫，下次整頁重畫"""
+        self.frame = None
+
+    def render(self, lines: Sequence[str], force: bool = False) -> int:
+        """更新畫面，回傳實際送出的字元數；間隔太短時先保留，由下次 render() 或 flush_due() 送出"""
+        self._pending = self._normalize(lines)
+        now = self.clock()
+        if not force and self._last_refresh is not None and now - self._last_refresh < self.min_interval:
+            self.throttled += 1
+            return 0
+        return self.flush(now)
+
+    def flush_due(self) -> Optional[float]:
+        """保留中的畫面已過最短間隔就送出；回傳還要等幾秒才能送出，沒有保留畫面時為 None
+
+        由 LCD 執行緒在 render() 之後呼叫（LatestValueWorker 的 idle），
+        畫面被節流後即使不再有新的 render()，最後的內容也會準時出現。
+        """
+        if self._pending is None:
+            return None
+        now = self.clock()
+        if self._last_refresh is not None:
+            wait = self._last_refresh + self.min_interval - now
+            if wait > 0:
+                return wait
+        self.flush(now)
+        return None
+
+    def flush(self, now: float = None) -> int:
+        """把保留中的畫面送出"""
+        new = self._pending
+        if new is None:
+            return 0
+        self._pending = None
+        if new == self.frame:
+            self.unchanged += 1
+            return 0
+
+        old = self.frame or [None] * self.rows
+        sent = 0
+        for row, line in enumerate(new):
+            if old[row] is None:
+                runs = [(0, line)]
+            else:
+                runs = diff_runs(old[row], line)
+            for col, text in runs:
+                self.lcd.cursor_pos = (row, col)
+                self.lcd.write_string(text)
+                self.cursor_moves += 1
+                sent += len(text)
+
+        self.frame = new
+        self.frames += 1
+        self.chars_sent += sent
+        self._last_refresh = self.clock() if now is None else now
+        return sent
+
+    def stats(self) -> dict:
+        return {
+            'frames': self.frames,
+            'unchanged': self.unchanged,
+            'throttled': self.throttled,
+            'chars_sent': self.chars_sent,
+            'cursor_moves': self.cursor_moves,
+        }
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+智慧飲水系統 - 即時狀態共享記憶體通道
+
+main.py 每個迴圈把最新狀態寫進一塊固定格式的 mmap 記錄，
+app.py 直接讀取，完全不經過 SQLite 與 SD 卡。
+
+記錄格式（little-endian）：
+    header : magic(4s) version(H) reserved(H) seq(Q)
+    payload: water_ml(i) status(B) pad(3x) last_drink_minutes(i)
+             today_total_ml(i) timestamp(d)
+             sample_period_ms(f) sample_jitter_ms(f) sample_max_late_ms(f) sample_overruns(I)
+
+seq 採 seqlock 規則：寫入前 +1（奇數 = 寫入中），寫完再 +1（偶數 = 穩定）。
+讀取端讀到前後相同且為偶數的 seq 才採用該筆資料，因此不需要任何鎖。
+"""
+
+import mmap
+import os
+import struct
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+_SHM_DIR = '/dev/shm'
+LIVE_STATUS_PATH = (
+    os.path.join(_SHM_DIR, 'hydration_status')
+    if os.path.isdir(_SHM_DIR)
+    else os.path.join(os.path.dirname(__file__), 'hydration.status')
+)
+
+STALE_SEC = 10      # 超過這個秒數沒更新就視為 main.py 未執行
+READ_RETRIES = 50   # seqlock 讀取重試次數
+
+MAGIC = b'HYDR'
+VERSION = 2
+
+_HEADER = struct.Struct('<4sHHQ')
+_SEQ = struct.Struct('<Q')
+_SEQ_OFFSET = 8
+_PAYLOAD = struct.Struct('<iB3xiidfffI')
+_PAYLOAD_OFFSET = _HEADER.size
+RECORD_SIZE = _HEADER.size + _PAYLOAD.size
+
+STATUS_CODES = {'OK': 0, 'DRINK': 1, 'NO_WATER': 2}
+STATUS_NAMES = {code: name for name, code in STATUS_CODES.items()}
+
+
+def _open_map(path: str, create: bool) -> Optional[mmap.mmap]:
+    """寫入端（create=True）以讀寫開啟；讀取端只需要唯讀
+
+    main.py 常以 root 執行（GPIO），檔案權限為 0o644；其他使用者執行的 app.py
+    以唯讀開啟才不會遇到 PermissionError。讀取端無法開啟時回傳 None（改讀資料庫快照）。
+    """
+    if create:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    else:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return None
+    try:
+        if create and os.fstat(fd).st_size < RECORD_SIZE:
+            os.ftruncate(fd, RECORD_SIZE)
+        elif os.fstat(fd).st_size < RECORD_SIZE:
+            return None
+        if create:
+            return mmap.mmap(fd, RECORD_SIZE)
+        try:
+            return mmap.mmap(fd, RECORD_SIZE, access=mmap.ACCESS_READ)
+        except OSError:
+            return None
+    finally:
+        os.close(fd)
+
+
+class LiveStatusWriter:
+    """寫入端（只應有一個，由 main.py 使用）"""
+
+    def __init__(self, path: str = LIVE_STATUS_PATH):
+        self.path = path
+        self._mm = _open_map(path, create=True)
+        magic, version, _, seq = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            seq = 0
+        # 沿用舊的序號，讓讀取端在重新啟動後仍看到遞增的 seq
+        self._seq = seq + (seq & 1)
+        _HEADER.pack_into(self._mm, 0, MAGIC, VERSION, 0, self._seq)
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    def publish(self, water_ml: int, status: str, last_drink_minutes: int, today_total_ml: int,
+                loop_stats: Dict = None):
+        """發佈一筆即時狀態（loop_stats 為 acquisition.LoopStats.snapshot()）"""
+        loop_stats = loop_stats or {}
+        self._seq += 1
+        _SEQ.pack_into(self._mm, _SEQ_OFFSET, self._seq)
+        _PAYLOAD.pack_into(
+            self._mm, _PAYLOAD_OFFSET,
+            int(water_ml), STATUS_CODES.get(status, 0),
+            int(last_drink_minutes), int(today_total_ml), time.time(),
+            loop_stats.get('period_ms', 0.0), loop_stats.get('jitter_ms', 0.0),
+            loop_stats.get('max_late_ms', 0.0), loop_stats.get('overruns', 0)
+        )
+        self._seq += 1
+        _SEQ.pack_into(self._mm, _SEQ_OFFSET, self._seq)
+
+    def close(self):
+        self._mm.close()
+
+
+class LiveStatusReader:
+    """讀取端（app.py 使用，可多個行程同時讀）"""
+
+    def __init__(self, path: str = LIVE_STATUS_PATH):
+        self.path = path
+        self._mm = None
+
+    def _map(self) -> Optional[mmap.mmap]:
+        if self._mm is None:
+            self._mm = _open_map(self.path, create=False)
+        return self._mm
+
+    def read(self, max_age: float = STALE_SEC) -> Optional[Dict]:
+        """讀取最新狀態；沒有寫入端或資料過期時回傳 None"""
+        mm = self._map()
+        if mm is None:
+            return None
+
+        for _ in range(READ_RETRIES):
+            magic, version, _, seq1 = _HEADER.unpack_from(mm, 0)
+            if magic != MAGIC or version != VERSION:
+                return None
+            if seq1 & 1:
+                continue
+            payload = _PAYLOAD.unpack_from(mm, _PAYLOAD_OFFSET)
+            (seq2,) = _SEQ.unpack_from(mm, _SEQ_OFFSET)
+            if seq1 == seq2:
+                break
+        else:
+            return None
+
+        if seq1 == 0:
+            return None
+
+        (water_ml, status_code, last_drink_minutes, today_total_ml, ts,
+         period_ms, jitter_ms, max_late_ms, overruns) = payload
+        if max_age is not None and time.time() - ts > max_age:
+            return None
+
+        return {
+            'water_ml': water_ml,
+            'status': STATUS_NAMES.get(status_code, 'OK'),
+            'last_drink_minutes': last_drink_minutes,
+            'today_total_ml': today_total_ml,
+            'timestamp': datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S'),
+            'seq': seq1,
+            'sampling': {
+                'period_ms': round(period_ms, 2),
+                'jitter_ms': round(jitter_ms, 2),
+                'max_late_ms': round(max_late_ms, 2),
+                'overruns': overruns,
+            },
+        }
@@ -1,15 +1,34 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import argparse
+import json
+import os
+import queue
+import tempfile
+import threading
 import time
 from datetime import datetime
+from typing import Dict, List, Tuple
 
-import RPi.GPIO as GPIO
-from hx711 import HX711
-from RPLCD.i2c import CharLCD
+# 樹莓派專用套件（RPi.GPIO / hx711 / RPLCD）改由 hardware.create_pi_hardware() 載入
+import hardware
+from hardware import Hardware, TraceExhausted
+from detector import DrinkDetector
+from lcd_renderer import LCDRenderer
+from acquisition import SAMPLE_QUEUE_SIZE, AdaptiveRate, LatestValueWorker, Sampler, TaskWorker
 
 # ========== 新增：導入資料庫模組 ==========
 import database as db
+import metrics
+from live_status import LiveStatusWriter
+import weight_trace
+from weight_trace import WeightRecorder
+from journal import DrinkJournal, JournalFlusher
+import checkpoint
+import reminders
+from reminders import ReminderScheduler
+from uploader import Uploader
 
 # =========================================================
 # 設定區
@@ -39,25 +58,45 @@ RAW_SAMPLES = 10
 EMA_ALPHA = 0.3
 LOOP_SEC = 0.3
 
+# 自適應取樣：(週期秒, 每次讀取筆數) 由快到慢；拿起或重量不穩定時切到第一級，
+# 穩定 SAMPLE_HOLD_SEC[i] 秒後退一級，最後停在閒置級（少讀 HX711、少佔 CPU）
+# detector.py 的穩定視窗（8 筆）、EMA 係數與拿起門檻都是以 LOOP_SEC 的取樣調校的，
+# 因此第一級必須是 (LOOP_SEC, RAW_SAMPLES)：偵測器未穩定時一律以原本的頻率取樣
+ADAPTIVE_SAMPLING = True
+SAMPLE_STEPS = ((LOOP_SEC, RAW_SAMPLES), (1.0, 4))
+SAMPLE_HOLD_SEC = (30,)
+
+# 多杯墊：每個杯墊各自的 HX711 腳位與校正值；第一個杯墊顯示在 LCD 與即時狀態
+# 也可以用 --coasters coasters.json 指定（同樣格式的 JSON 陣列）
+COASTERS = [
+    {'id': 'main', 'dout': HX_DOUT, 'sck': HX_SCK, 'offset': HX_OFFSET, 'scale': HX_SCALE},
+]
+
+STATUS_PERSIST_SEC = 60  # 即時狀態走共享記憶體，SQLite 只保留節流後的快照
+STATS_PRINT_SEC = 60     # 每隔多久印出一次取樣週期 / 抖動統計
+METRICS_WRITE_SEC = 10   # 每隔多久把量測快照寫給 app.py 的 /metrics
+CHECKPOINT_SEC = 5       # --fast 時每隔多久寫一次感測狀態檢查點（一般啟動只在結束時寫入）
+PROBE_TIMEOUT_SEC = 0.5  # --fast 時單次讀取 HX711 的等待上限
+MAINTENANCE_SEC = 6 * 3600  # 資料庫維護（封存過期記錄、回收空間）的最短間隔
+IDLE_SEC = 300              # 所有杯墊穩定這麼久沒有動靜，才視為閒置而進行維護
+
+HX_READ_SECONDS = metrics.histogram(
+    'hydration_hx711_read_seconds', 'hx_read_raw_avg 的耗時', ['coaster'])
+LCD_RENDER_SECONDS = metrics.histogram(
+    'hydration_lcd_render_seconds', 'lcd_show 的耗時（含 I2C 傳輸）')
+
 # =========================================================
 # LCD 顯示
 # =========================================================
 
-lcd = CharLCD(
-    i2c_expander="PCF8574",
-    address=LCD_ADDR,
-    port=1,
-    cols=LCD_COLS,
-    rows=LCD_ROWS,
-    charmap="A00"
-)
-
-def _pad(s: str, width: int = 20) -> str:
-    return (s[:width]).ljust(width)
+lcd = None          # 由 main() 依照硬體後端建立
+renderer = None     # 差異式繪製，只送出有變動的字元
+clock = time.time   # 重播模式下換成虛擬時鐘
 
 def _fmt_time() -> str:
-    return datetime.now().strftime("%H:%M")
+    return datetime.fromtimestamp(clock()).strftime("%H:%M")
 
+@metrics.timed(LCD_RENDER_SECONDS)
 def lcd_show(status: str, water_ml: int, last_mins: int, today_ml: int, lifting: bool):
     now = _fmt_time()
 
@@ -84,16 +123,13 @@ def lcd_show(status: str, water_ml: int, last_mins: int, today_ml: int, lifting:
         else:
             line4 = "Keep going! ^_^"
 
-    lcd.cursor_pos = (0, 0); lcd.write_string(_pad(line1))
-    lcd.cursor_pos = (1, 0); lcd.write_string(_pad(line2))
-    lcd.cursor_pos = (2, 0); lcd.write_string(_pad(line3))
-    lcd.cursor_pos = (3, 0); lcd.write_string(_pad(line4))
+    renderer.render([line1, line2, line3, line4])
 
 # =========================================================
 # HX711 讀取
 # =========================================================
 
-def hx_read_raw_avg(hx: HX711, n: int = 10) -> float:
+def hx_read_raw_avg(hx, n: int = 10) -> float:
     data = hx.get_raw_data(n)
     if isinstance(data, list) and len(data) > 0:
         valid = [v for v in data if v is not False and v is not None]
@@ -104,12 +140,139 @@ def hx_read_raw_avg(hx: HX711, n: int = 10) -> float:
 def raw_to_grams(raw: float, offset: float, scale: float) -> float:
     return (raw - offset) / scale
 
+def probe_scale(hx, timeout: float = PROBE_TIMEOUT_SEC) -> Tuple[bool, threading.Thread]:
+    """在 timeout 秒內讀一筆，回傳 (是否讀到資料, 讀取執行緒)
+
+    HX711 沒接好時 get_raw_data 會一直等，逾時後執行緒仍在操作 GPIO；
+    呼叫端再讀同一個 HX711 之前必須先 join() 這條執行緒。
+    """
+    result = []
+    t = threading.Thread(target=lambda: result.append(hx_read_raw_avg(hx, 1)), daemon=True)
+    t.start()
+    t.join(timeout)
+    return bool(result and result[0]), t
+
+# =========================================================
+# 杯墊
+# =========================================================
+
+class Coaster:
+    """一個杯墊：HX711、校正值、水壺與各自的偵測 / 顯示狀態"""
+
+    def __init__(self, coaster_id: str, hx, offset: float, scale: float, empty_bottle_g: float,
+                 today_ml: int = 0, start_ts: float = 0.0, recorder: WeightRecorder = None,
+                 follow_bottle: bool = True):
+        self.id = coaster_id
+        self.follow_bottle = follow_bottle   # 水壺在網頁上更換時跟著換空壺重量
+        self.hx = hx
+        self.offset = offset
+        self.scale = scale
+        self.recorder = recorder
+        self.detector = DrinkDetector(
+            empty_bottle_g,
+            drink_min_ml=DRINK_EVENT_MIN_ML,
+            lift_drop_g=LIFT_DROP_G,
+            lift_min_present_g=LIFT_MIN_PRESENT_G,
+            stable_var_g=STABLE_VAR_G,
+        )
+        self.today_ml = today_ml
+        self.last_drink_ts = start_ts
+        self.water_ml = 0          # 顯示用水量（含死區）
+        self.mins_since = 0
+        self.reminding = False     # 提醒排程到期後設為 True，喝水後清除
+        self.status = "OK"
+        self.rate = AdaptiveRate(SAMPLE_STEPS, SAMPLE_HOLD_SEC, label=coaster_id) if ADAPTIVE_SAMPLING else None
+
+    def sync_bottle(self) -> bool:
+        """檢查水壺是否更換（資料庫快取，幾乎不花成本）；更換時重設偵測狀態並回傳 True"""
+        if not self.follow_bottle:
+            return False
+        bottle = db.get_coaster_bottle(self.id)
+        if bottle and bottle['empty_weight'] != self.detector.empty_bottle_g:
+            print(f"[{self.id}] 更換水壺：{bottle['name']}（空壺 {bottle['empty_weight']:.1f} g）")
+            self.detector.empty_bottle_g = bottle['empty_weight']
+            # 重設後不會把空壺重量差誤判成飲水
+            self.detector.reset()
+            return True
+        return False
+
+    def bottle_id(self) -> int:
+        bottle = db.get_coaster_bottle(self.id)
+        return bottle['id'] if bottle else None
+
+    def read(self, n: int = RAW_SAMPLES) -> float:
+        """讀取一筆重量（n 筆原始值的平均，g）；在取樣執行緒執行"""
+        with HX_READ_SECONDS.time(self.id):
+            raw = hx_read_raw_avg(self.hx, n)
+        return raw_to_grams(raw, self.offset, self.scale)
+
+    def update(self, ts: float, grams: float) -> int:
+        """處理一筆樣本並更新狀態，回傳飲水量（ml）"""
+        # EMA 濾波、拿起 / 穩定判斷與飲水偵測（detector.py）
+        d = self.detector
+        drank_ml = d.feed(grams)
+        water_ml = d.water_ml
+
+        # ========== 修改：飲水事件判斷 ==========
+        if drank_ml:
+            self.today_ml += drank_ml
+            self.last_drink_ts = ts
+            self.reminding = False
+
+        if self.rate is not None:
+            # 拿起、剛放回（視窗未穩定）或重量變化時回到正常頻率，穩定一段時間後才降回閒置
+            self.rate.observe(ts, bool(drank_ml) or d.lifting or not d.stable)
+
+        if abs(water_ml - self.water_ml) >= DISPLAY_DEADBAND_ML:
+            self.water_ml = water_ml
+        water_ml = self.water_ml
+
+        self.mins_since = int((ts - self.last_drink_ts) / 60)
+
+        if d.lifting:
+            self.status = "OK"
+        elif water_ml <= NO_WATER_ML and (d.stable or d.last_stable_ml <= NO_WATER_ML):
+            self.status = "NO_WATER"
+        elif d.stable and self.reminding:
+            self.status = "DRINK"
+        else:
+            self.status = "OK"
+        return drank_ml
+
+    def checkpoint(self, ts: float) -> Dict:
+        """寫入檢查點的狀態"""
+        state = self.detector.state()
+        state.update(
+            date=datetime.fromtimestamp(ts).strftime('%Y-%m-%d'),
+            today_ml=self.today_ml,
+            last_drink_ts=self.last_drink_ts,
+            water_ml=self.water_ml,
+        )
+        return state
+
+    def restore(self, state: Dict, age: float, ts: float) -> bool:
+        """由檢查點還原；今日總量取資料庫與檢查點較大者（日誌中可能有尚未寫入的事件）"""
+        if state.get('date') == datetime.fromtimestamp(ts).strftime('%Y-%m-%d'):
+            self.today_ml = max(self.today_ml, state.get('today_ml', 0))
+        self.last_drink_ts = state.get('last_drink_ts', self.last_drink_ts)
+        # 停機太久或換了水壺就重新暖機
+        if age > checkpoint.MAX_AGE_SEC or not self.detector.restore(state):
+            return False
+        self.water_ml = state.get('water_ml', 0)
+        return True
+
 # =========================================================
 # 主程式
 # =========================================================
 
-def main():
-    global EMPTY_BOTTLE_G
+def main(hw: Hardware = None, replay: bool = False, verbose: bool = True,
+         coaster_configs: List[Dict] = None, fast: bool = False) -> Dict:
+    """感測主迴圈；replay=True 時不寫即時狀態與重量軌跡，並在軌跡讀完時結束
+
+    fast=True 時每個 HX711 只做一次有時限的讀取（失敗才跑完整的讀取測試），
+    並由檢查點還原濾波狀態，幾百毫秒內就回到監測迴圈。
+    """
+    global lcd, renderer, clock
 
     print("=== 智慧飲水提醒系統 ===")
     print("按 Ctrl+C 停止\n")
@@ -117,169 +280,414 @@ def main():
     # ========== 新增：初始化資料庫 ==========
     db.init_database()
 
-    GPIO.setwarnings(False)
-    GPIO.setmode(GPIO.BCM)
-
-    hx = HX711(dout_pin=HX_DOUT, pd_sck_pin=HX_SCK)
-    hx.reset()
-    time.sleep(0.5)
-
-    print("正在測試 HX711 連線...")
-    time.sleep(1)
-
-    print("讀取測試中 (3 秒)...")
-    for i in range(6):
-        r = hx_read_raw_avg(hx, 3)
-        g = raw_to_grams(r, HX_OFFSET, HX_SCALE)
-        print(f"  [{i+1}/6] raw={r:.0f}, grams={g:.1f}")
-        time.sleep(0.5)
-
-    print("\n✓ HX711 讀取正常！")
-
-    # ========== 新增：從資料庫讀取水壺資訊 ==========
-    if EMPTY_BOTTLE_G is None:
-        bottle = db.get_active_bottle()
-        if bottle:
-            EMPTY_BOTTLE_G = bottle['empty_weight']
-            print(f"\n使用已儲存的水壺：{bottle['name']}")
-            print(f"✓ 空壺重量 = {EMPTY_BOTTLE_G:.1f} g")
+    configs = coaster_configs or COASTERS
+    if hw is None:
+        first = configs[0]
+        hw = hardware.create_pi_hardware(first['dout'], first['sck'], LCD_ADDR, LCD_COLS, LCD_ROWS)
+    lcd = hw.lcd
+    clock = hw.clock
+    renderer = LCDRenderer(lcd, LCD_COLS, LCD_ROWS, clock=time.monotonic if hw.realtime else hw.clock)
+
+    if hw.create_scale is None and len(configs) > 1:
+        print(f"⚠️  此後端只有一個 HX711，只使用杯墊 {configs[0]['id']}")
+        configs = configs[:1]
+
+    # ========== 多杯墊：每個杯墊各自的 HX711 ==========
+    scales = []
+    for i, cfg in enumerate(configs):
+        hx = hw.hx if i == 0 else hw.create_scale(cfg['dout'], cfg['sck'])
+        hx.reset()
+        scales.append(hx)
+
+    probes = [probe_scale(hx) for hx in scales] if fast else []
+    if fast and all(ok for ok, _ in probes):
+        print("✓ HX711 讀取正常（快速啟動）")
+    else:
+        if fast:
+            print("⚠️  HX711 沒有回應，改跑完整的讀取測試")
+            # 逾時的讀取執行緒還在驅動同一個 HX711：等它結束才開始，避免兩條執行緒同時 bit-bang
+            for _, t in probes:
+                t.join()
+        hw.sleep(0.5)
+
+        print("正在測試 HX711 連線...")
+        hw.sleep(1)
+
+        print("讀取測試中 (3 秒)...")
+        for i in range(6):
+            readings = []
+            for cfg, hx in zip(configs, scales):
+                r = hx_read_raw_avg(hx, 3)
+                g = raw_to_grams(r, cfg['offset'], cfg['scale'])
+                readings.append(f"{cfg['id']}: raw={r:.0f}, grams={g:.1f}")
+            print(f"  [{i+1}/6] " + " | ".join(readings))
+            hw.sleep(0.5)
+
+        print("\n✓ HX711 讀取正常！")
+
+    # ========== 新增：從資料庫讀取水壺資訊（每個杯墊可有自己的水壺） ==========
+    multi = len(configs) > 1
+    start_ts = clock()
+    coasters = []
+    deferred = []   # 快速啟動時延後到寫入執行緒做的事
+    for i, (cfg, hx) in enumerate(zip(configs, scales)):
+        if fast:
+            deferred.append((db.register_coaster, cfg['id'], cfg.get('name')))
+        else:
+            db.register_coaster(cfg['id'], cfg.get('name'))
+        bottle = db.get_coaster_bottle(cfg['id'])
+        empty_g = EMPTY_BOTTLE_G if i == 0 and EMPTY_BOTTLE_G is not None else (bottle['empty_weight'] if bottle else None)
+        if empty_g is None:
+            print(f"\n⚠️  杯墊 {cfg['id']} 尚未設定水壺，略過")
+            continue
+        print(f"\n杯墊 {cfg['id']} 使用水壺：{bottle['name'] if bottle else '-'}")
+        print(f"✓ 空壺重量 = {empty_g:.1f} g")
+        if replay:
+            recorder = None
         else:
-            print("\n⚠️  尚未設定水壺！")
-            print("請先到網頁 http://raspberrypi.local:5000/bottles")
-            print("新增並選擇一個水壺，然後重新執行程式。\n")
-            GPIO.cleanup()
-            return
+            trace_dir = weight_trace.TRACE_DIR if i == 0 else os.path.join(weight_trace.TRACE_DIR, cfg['id'])
+            recorder = WeightRecorder(trace_dir, auto_flush=False)
+        coasters.append(Coaster(
+            cfg['id'], hx, cfg['offset'], cfg['scale'], empty_g,
+            # ========== 新增：從資料庫讀取今日總量 ==========
+            today_ml=db.get_today_total(cfg['id'] if multi else None),
+            start_ts=start_ts,
+            recorder=recorder,
+            follow_bottle=not (i == 0 and EMPTY_BOTTLE_G is not None),
+        ))
+
+    if not coasters:
+        print("\n⚠️  尚未設定水壺！")
+        print("請先到網頁 http://raspberrypi.local:5000/bottles")
+        print("新增並選擇一個水壺，然後重新執行程式。\n")
+        hw.cleanup()
+        return {}
 
     print("\n==================================================")
     print("系統開始監測...")
     print("==================================================\n")
 
-    # ========== 新增：從資料庫讀取今日總量 ==========
-    today_ml = db.get_today_total()
-    print(f"今日已飲用：{today_ml} ml\n")
-
-    # ========== 新增：從資料庫讀取設定 ==========
-    settings = db.get_all_settings()
-    remind_interval = int(settings.get('remind_interval_min', 60))
-
-    ema_g = None
-    last_display_ml = 0
-    last_stable_ml = 0
-    last_drink_ts = time.time()
-    recent_g = []
-    prev_ema_g = None
+    primary = coasters[0]   # 第一個杯墊顯示在 LCD 與即時狀態
+
+    # ========== 由檢查點還原濾波 / 穩定水量 / 今日總量 ==========
+    # 只有 --fast 時才由檢查點還原並定期寫入；一般啟動只在結束時寫一次
+    # （之後用 --fast 重啟仍可還原），不必每 5 秒寫 SD 卡
+    use_checkpoint = not replay
+    if use_checkpoint and fast:
+        saved = checkpoint.load()
+        age = clock() - saved.get('time', 0)
+        for c in coasters:
+            state = saved.get('coasters', {}).get(c.id)
+            if state and c.restore(state, age, start_ts):
+                print(f"✓ {c.id} 已由檢查點還原（{age:.0f} 秒前，水量 {c.water_ml} ml）")
+
+    for c in coasters:
+        print(f"{c.id} 今日已飲用：{c.today_ml} ml")
+    print()
+
+    if replay:
+        live = LiveStatusWriter(os.path.join(tempfile.gettempdir(), f'hydration_replay_{os.getpid()}.status'))
+    else:
+        live = LiveStatusWriter()
+
+    loops = 0
+    events = []
+    started = time.perf_counter()
+    last_persist_ts = 0.0
+    last_persist_status = None
+    last_stats_ts = 0.0
+    last_metrics_ts = 0.0
+    last_checkpoint_ts = 0.0
+    last_maintenance_ts = 0.0
+    last_active_ts = start_ts
+
+    # ========== 喝水提醒：到期時才醒來，標記杯墊讓 LCD 顯示 DRINK ==========
+    by_id = {c.id: c for c in coasters}
+
+    def mark_reminding(reminder: Dict):
+        by_id[reminder['key']].reminding = True
+
+    reminder_sinks = [mark_reminding, reminders.print_sink]
+    webhook_url = db.get_setting('reminder_webhook_url')
+    if webhook_url and not replay:
+        reminder_sinks.append(reminders.WebhookSink(webhook_url))
+    scheduler = ReminderScheduler(reminder_sinks, clock=clock)
+    for c in coasters:
+        scheduler.track(c.id, c.last_drink_ts, c.bottle_id())
+    settings_version = db.get_versions().get('settings', 0)
+    if hw.realtime:
+        scheduler.start()
+
+    # ========== 取樣（每個杯墊一條執行緒）、LCD、寫入各自一條執行緒 ==========
+    samples = queue.Queue(maxsize=SAMPLE_QUEUE_SIZE * len(coasters))
+    samplers = [
+        Sampler(
+            c.read,
+            c.rate or LOOP_SEC,
+            timestamp=clock,
+            monotonic=time.monotonic if hw.realtime else clock,
+            sleep=hw.sleep,
+            realtime=hw.realtime,
+            out=samples,
+            tag=c.id,
+        )
+        for c in coasters
+    ]
+    # 被節流保留的畫面由 LCD 執行緒在最短間隔過後補送
+    lcd_worker = LatestValueWorker(lcd_show, name='lcd', idle=lambda: renderer.flush_due())
+    persist_worker = TaskWorker(name='persist')
+    # 飲水事件先寫日誌（fsync），再由背景執行緒整批寫入資料庫
+    journal = DrinkJournal()
+    flusher = JournalFlusher(journal)
+    flusher.start()
+    lcd_worker.start()
+    persist_worker.start()
+    for sampler in samplers:
+        sampler.start()
+    for task in deferred:
+        persist_worker.submit(*task)
 
     try:
-        while True:
-            raw = hx_read_raw_avg(hx, RAW_SAMPLES)
-            grams = raw_to_grams(raw, HX_OFFSET, HX_SCALE)
-
-            # EMA 濾波（自適應）
-            if ema_g is None:
-                ema_g = grams
-            else:
-                change = abs(grams - ema_g)
-
-                if change > 100:
-                    alpha = 0.6
-                elif change > 20:
-                    alpha = 0.4
-                else:
-                    alpha = 0.2
-
-                ema_g = (alpha * grams) + ((1 - alpha) * ema_g)
-
-            recent_g.append(ema_g)
-            if len(recent_g) > 8:
-                recent_g.pop(0)
-
-            g_min = min(recent_g) if recent_g else ema_g
-            g_max = max(recent_g) if recent_g else ema_g
-            g_var = g_max - g_min
-
-            lifting = False
-            if ema_g < LIFT_MIN_PRESENT_G:
-                lifting = True
-            if prev_ema_g is not None and (prev_ema_g - ema_g) > LIFT_DROP_G:
-                lifting = True
-            prev_ema_g = ema_g
-
-            water_ml_float = ema_g - EMPTY_BOTTLE_G
-            water_ml = int(round(max(0.0, water_ml_float)))
-
-            stable = (g_var <= STABLE_VAR_G) and (not lifting)
-
-            # ========== 修改：飲水事件判斷 + 寫入資料庫 ==========
-            drank_ml = 0
-
-            if stable and water_ml > 0:
-                if last_stable_ml > 0:
-                    drop = last_stable_ml - water_ml
-                    if drop >= DRINK_EVENT_MIN_ML:
-                        drank_ml = drop
-                        today_ml += drank_ml
-                        last_drink_ts = time.time()
-                        print(f"  ★ 偵測到飲水事件！喝了 {drank_ml} ml")
-
-                        # ========== 新增：寫入資料庫 ==========
-                        try:
-                            bottle = db.get_active_bottle()
-                            bottle_id = bottle['id'] if bottle else None
-                            db.add_drink_event(drank_ml, bottle_id)
-                            print(f"  ✓ 已記錄到資料庫")
-                        except Exception as e:
-                            print(f"  ✗ 資料庫寫入失敗: {e}")
-
-                last_stable_ml = water_ml
-
-            if abs(water_ml - last_display_ml) >= DISPLAY_DEADBAND_ML:
-                last_display_ml = water_ml
-            else:
-                water_ml = last_display_ml
-
-            mins_since = int((time.time() - last_drink_ts) / 60)
-
-            if lifting:
-                status = "OK"
-            else:
-                if water_ml <= NO_WATER_ML and (stable or last_stable_ml <= NO_WATER_ML):
-                    status = "NO_WATER"
-                elif stable and mins_since >= remind_interval:
-                    status = "DRINK"
-                else:
-                    status = "OK"
-
-            lcd_show(
-                status=status,
-                water_ml=water_ml,
-                last_mins=mins_since,
-                today_ml=today_ml,
-                lifting=lifting
-            )
-
-            # ========== 新增：更新資料庫狀態 ==========
-            try:
-                db.update_status(water_ml, status, mins_since, today_ml)
-            except Exception:
-                pass
-
-            print(
-                f"重={ema_g:6.1f}g 水={water_ml:4d}ml "
-                f"穩={str(stable)[0]} 拿={str(lifting)[0]} 喝={drank_ml:3d}ml 今日={today_ml:4d}ml"
+        running = len(samplers)
+        while running:
+            item = samples.get()
+            if item is None:
+                running -= 1
+                for sampler in samplers:
+                    if sampler.error:
+                        raise sampler.error
+                continue
+            tag, ts, grams = item
+            coaster = by_id[tag]
+            loops += 1
+
+            # 設定與水壺走 database.py 的快取；網頁修改後下一輪就會生效
+            version = db.get_versions().get('settings', 0)
+            if version != settings_version:
+                settings_version = version
+                scheduler.reload()
+            if coaster.sync_bottle():
+                scheduler.track(coaster.id, coaster.last_drink_ts, coaster.bottle_id())
+            if coaster.reminding and scheduler.quiet(ts):
+                # 靜音時段開始：LCD 不再顯示 DRINK，下一次提醒排在時段結束後
+                coaster.reminding = False
+            drank_ml = coaster.update(ts, grams)
+            if drank_ml:
+                scheduler.track(coaster.id, ts, coaster.bottle_id())
+            if not hw.realtime:
+                # 重播（虛擬時鐘）沒有排程執行緒，由迴圈推進
+                scheduler.fire_due(ts)
+            if drank_ml or coaster.detector.lifting or not coaster.detector.stable:
+                last_active_ts = ts
+
+            if coaster.recorder:
+                coaster.recorder.append(ts, grams, coaster.detector.ema_g)
+                if coaster.recorder.flush_due():
+                    persist_worker.submit(coaster.recorder.flush)
+
+            # ========== 修改：飲水事件寫入資料庫（交給寫入執行緒） ==========
+            if drank_ml:
+                events.append((ts, drank_ml))
+                print(f"  ★ [{coaster.id}] 偵測到飲水事件！喝了 {drank_ml} ml")
+                record_drink(journal, persist_worker, coaster.id, drank_ml, ts)
+                flusher.notify()
+
+            if verbose:
+                d = coaster.detector
+                print(
+                    f"[{coaster.id}] 重={d.ema_g:6.1f}g 水={coaster.water_ml:4d}ml "
+                    f"穩={str(d.stable)[0]} 拿={str(d.lifting)[0]} 喝={drank_ml:3d}ml 今日={coaster.today_ml:4d}ml"
+                )
+
+            if coaster is not primary:
+                continue
+
+            lcd_worker.submit(
+                status=coaster.status,
+                water_ml=coaster.water_ml,
+                last_mins=coaster.mins_since,
+                today_ml=coaster.today_ml,
+                lifting=coaster.detector.lifting
             )
 
-            time.sleep(LOOP_SEC)
+            # ========== 即時狀態：每輪寫共享記憶體，SQLite 只做節流快照 ==========
+            stats = samplers[0].stats.snapshot()
+            live.publish(coaster.water_ml, coaster.status, coaster.mins_since, coaster.today_ml, stats)
+
+            if coaster.status != last_persist_status or ts - last_persist_ts >= STATUS_PERSIST_SEC:
+                persist_worker.submit(db.update_status, coaster.water_ml, coaster.status,
+                                      coaster.mins_since, coaster.today_ml)
+                last_persist_ts = ts
+                last_persist_status = coaster.status
+
+            if not replay and ts - last_metrics_ts >= METRICS_WRITE_SEC:
+                last_metrics_ts = ts
+                for sampler in samplers:
+                    sampler.stats.snapshot()   # 更新抖動 gauge
+                persist_worker.submit(metrics.write_snapshot)
+
+            if use_checkpoint and fast and ts - last_checkpoint_ts >= CHECKPOINT_SEC:
+                last_checkpoint_ts = ts
+                persist_worker.submit(checkpoint.save, {c.id: c.checkpoint(ts) for c in coasters})
+
+            # ========== 資料庫維護：只在感測器閒置時進行，不和飲水事件的寫入搶鎖 ==========
+            if (not replay and ts - last_active_ts >= IDLE_SEC
+                    and ts - last_maintenance_ts >= MAINTENANCE_SEC):
+                last_maintenance_ts = ts
+                persist_worker.submit(run_maintenance)
+
+            if hw.realtime and ts - last_stats_ts >= STATS_PRINT_SEC:
+                last_stats_ts = ts
+                for sampler in samplers:
+                    st = sampler.stats.snapshot()
+                    rate = f" 排程={sampler.period * 1000:.0f}ms×{sampler.rate.reads}" if sampler.rate else ""
+                    print(
+                        f"[取樣 {sampler.tag}] 週期={st['period_ms']:.1f}ms 抖動={st['jitter_ms']:.1f}ms "
+                        f"最大延遲={st['max_late_ms']:.1f}ms 延遲次數={st['late']} 丟棄={st['overruns']}{rate}"
+                    )
 
     except KeyboardInterrupt:
         print("\n\n系統停止")
 
+    except TraceExhausted:
+        print("\n重播結束")
+
     finally:
+        scheduler.stop()
+        for sink in reminder_sinks:
+            if isinstance(sink, reminders.WebhookSink):
+                sink.stop()
+        for sampler in samplers:
+            sampler.stop()
+        for sampler in samplers:
+            sampler.join(2)
+        lcd_worker.stop()
+        # 最後一次把日誌中的事件寫入資料庫（失敗也沒關係，下次啟動會補寫）
+        flusher.stop()
+        journal.close()
+        for c in coasters:
+            if c.recorder:
+                persist_worker.submit(c.recorder.close)
+        if use_checkpoint:
+            persist_worker.submit(checkpoint.save, {c.id: c.checkpoint(clock()) for c in coasters})
+        # 等待尚未寫入的飲水事件與狀態完成
+        persist_worker.stop()
+        live.close()
+        if replay:
+            # 重播用的暫存狀態檔
+            try:
+                os.remove(live.path)
+            except OSError:
+                pass
         try:
             lcd.clear()
         except:
             pass
-        GPIO.cleanup()
+        hw.cleanup()
+
+    return {
+        'loops': loops,
+        'events': events,
+        'today_ml': primary.today_ml,
+        'elapsed': time.perf_counter() - started,
+        'sampling': {s.tag: s.stats.snapshot() for s in samplers},
+        'lcd': renderer.stats(),
+    }
+
+def record_drink(journal: DrinkJournal, worker: TaskWorker, coaster_id: str, drank_ml: int, ts: float):
+    """記錄飲水事件：寫入日誌後即返回，資料庫由 JournalFlusher 寫入"""
+    bottle = db.get_coaster_bottle(coaster_id)
+    bottle_id = bottle['id'] if bottle else None
+    try:
+        journal.append(drank_ml, ts, bottle_id, coaster_id)
+    except OSError as e:
+        # 日誌無法寫入（例如磁碟已滿）時退回直接寫資料庫
+        print(f"  ✗ 日誌寫入失敗，改為直接寫入資料庫: {e}")
+        timestamp = datetime.fromtimestamp(ts).strftime(db.TS_FORMAT)
+        worker.submit(db.add_drink_event, drank_ml, bottle_id, coaster_id, timestamp)
+
+def run_maintenance():
+    """封存超過保存期限的飲水記錄，並漸進回收資料庫空頁"""
+    result = db.run_maintenance()
+    if result['archived'] or result['vacuumed_pages']:
+        print(f"資料庫維護：封存 {result['archived']} 筆記錄，回收 {result['vacuumed_pages']} 頁")
+
+# =========================================================
+# 重播模式（不需硬體）
+# =========================================================
+
+def run_replay(args) -> Dict:
+    """以模擬 HX711 重播軌跡，量測迴圈吞吐量與飲水偵測結果"""
+    global EMPTY_BOTTLE_G
+
+    labels = None
+    if args.replay:
+        samples = hardware.load_trace(args.replay)
+        empty_g = args.empty_g
+    else:
+        trace = hardware.synthetic_trace(minutes=args.minutes, seed=args.seed)
+        samples, labels, empty_g = trace['samples'], trace['drinks'], trace['empty_g']
+    if empty_g is None:
+        raise SystemExit("重播記錄的軌跡需要指定 --empty-g（空壺重量）")
+
+    # 使用暫存資料庫，不影響正式資料
+    db.DB_PATH = args.db or os.path.join(tempfile.mkdtemp(prefix='hydration_replay_'), 'replay.db')
+    db.init_database()
+    db.set_active_bottle(db.add_bottle('replay', empty_g, 1000))
+    EMPTY_BOTTLE_G = None
+
+    hw = hardware.create_replay_hardware(samples, HX_OFFSET, HX_SCALE, LCD_COLS, LCD_ROWS)
+    result = main(hw, replay=True, verbose=args.verbose)
+
+    loops = result.get('loops', 0)
+    elapsed = result.get('elapsed', 0) or 1e-9
+    events = result.get('events', [])
+    print("\n========== 重播結果 ==========")
+    print(f"樣本數：{len(samples)}  迴圈數：{loops}")
+    print(f"耗時：{elapsed:.2f} s  吞吐量：{loops / elapsed:,.0f} 迴圈/秒")
+    print(f"偵測到飲水事件：{len(events)} 次，共 {sum(ml for _, ml in events)} ml")
+    if labels is not None:
+        print(f"標記的飲水事件：{len(labels)} 次，共 {sum(ml for _, ml in labels)} ml")
+    lcd_stats = result.get('lcd', {})
+    if lcd_stats.get('frames'):
+        print(f"LCD：更新 {lcd_stats['frames']} 次、送出 {lcd_stats['chars_sent']} 字元"
+              f"（平均 {lcd_stats['chars_sent'] / lcd_stats['frames']:.1f} 字元/次，整頁重寫為 {LCD_COLS * LCD_ROWS}）")
+    print(f"資料庫：{db.DB_PATH}")
+    return result
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="智慧飲水提醒系統")
+    parser.add_argument('--replay', metavar='TRACE',
+                        help="重播重量軌跡（traces/*.bin 或 ts,grams CSV），不需硬體")
+    parser.add_argument('--simulate', action='store_true', help="重播合成軌跡，不需硬體")
+    parser.add_argument('--minutes', type=float, default=60, help="合成軌跡長度（分鐘）")
+    parser.add_argument('--seed', type=int, default=0, help="合成軌跡亂數種子")
+    parser.add_argument('--empty-g', type=float, default=None, help="重播時的空壺重量 (g)")
+    parser.add_argument('--db', default=None, help="重播時使用的資料庫路徑（預設為暫存檔）")
+    parser.add_argument('--verbose', action='store_true', help="重播時列出每一輪的狀態")
+    parser.add_argument('--fast', action='store_true',
+                        help="快速啟動：略過 HX711 讀取測試，由檢查點還原感測狀態")
+    parser.add_argument('--hub', metavar='URL',
+                        help="同時把飲水記錄與狀態上傳到 hub（例如 http://hub.local:5000）")
+    parser.add_argument('--device-id', default=None, help="上傳到 hub 時的裝置 ID（預設為主機名稱）")
+    parser.add_argument('--coasters', metavar='JSON',
+                        help="杯墊設定檔：[{\"id\", \"dout\", \"sck\", \"offset\", \"scale\"}, ...]")
+    args = parser.parse_args()
+
+    if args.replay or args.simulate:
+        run_replay(args)
+    else:
+        configs = None
+        if args.coasters:
+            with open(args.coasters, encoding='utf-8') as f:
+                configs = json.load(f)
+        uploader = None
+        if args.hub:
+            # 本機資料庫就是上傳緩衝：感測迴圈照常寫入，上傳執行緒在背景分批送出
+            db.init_database()
+            uploader = Uploader(args.hub, args.device_id, os.environ.get('HYDRATION_HUB_TOKEN'))
+            uploader.start()
+        main(coaster_configs=configs, fast=args.fast)
+        if uploader:
+            uploader.stop()
\ No newline at end of file
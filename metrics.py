@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+智慧飲水系統 - 效能量測（Prometheus 文字格式）
+
+Histogram 只做一次 bisect 與兩個加法，可以在正式環境一直開著。
+main.py 與 app.py 是不同行程：main.py 定期把自己的量測值寫成快照檔，
+app.py 的 /metrics 再合併兩邊，並以 process 標籤區分：
+
+    hydration_db_call_seconds_bucket{process="sensor",function="add_drink_events",le="0.005"} 12
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence
+
+_SHM_DIR = '/dev/shm'
+METRICS_PATH = (
+    os.path.join(_SHM_DIR, 'hydration_metrics.json')
+    if os.path.isdir(_SHM_DIR)
+    else os.path.join(os.path.dirname(__file__), 'hydration_metrics.json')
+)
+STALE_SEC = 60   # 快照超過這個秒數沒更新就視為 main.py 未執行
+
+# 預設的延遲區間（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """累積分布直方圖；每組標籤值各自一份計數"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def time(self, *labelvalues) -> '_Timer':
+        """with metric.time(...): 量測區塊耗時"""
+        return _Timer(self, labelvalues)
+
+    def _dump(self) -> List:
+        with self._lock:
+            return [[list(k), list(v[0]), v[1]] for k, v in self._series.items()]
+
+
+class Gauge:
+    """目前值"""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._series: Dict[tuple, float] = {}
+
+    def set(self, value: float, *labelvalues):
+        self._series[labelvalues] = value
+
+    def _dump(self) -> List:
+        return [[list(k), v] for k, v in list(self._series.items())]
+
+
+class Counter:
+    """只會增加的累計值（名稱以 _total 結尾）"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._series: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *labelvalues):
+        with self._lock:
+            self._series[labelvalues] = self._series.get(labelvalues, 0) + amount
+
+    def _dump(self) -> List:
+        with self._lock:
+            return [[list(k), v] for k, v in self._series.items()]
+
+
+class _Timer:
+    __slots__ = ('metric', 'labelvalues', 'start')
+
+    def __init__(self, metric: Histogram, labelvalues: tuple):
+        self.metric = metric
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metric.observe(time.perf_counter() - self.start, *self.labelvalues)
+        return False
+
+
+# ========== 註冊表 ==========
+
+REGISTRY: Dict[str, object] = {}
+_registry_lock = threading.Lock()
+
+
+def histogram(name: str, help: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    """取得（或建立）一個 Histogram"""
+    with _registry_lock:
+        if name not in REGISTRY:
+            REGISTRY[name] = Histogram(name, help, labelnames, buckets)
+        return REGISTRY[name]
+
+
+def gauge(name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+    """取得（或建立）一個 Gauge"""
+    with _registry_lock:
+        if name not in REGISTRY:
+            REGISTRY[name] = Gauge(name, help, labelnames)
+        return REGISTRY[name]
+
+
+def counter(name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+    """取得（或建立）一個 Counter"""
+    with _registry_lock:
+        if name not in REGISTRY:
+            REGISTRY[name] = Counter(name, help, labelnames)
+        return REGISTRY[name]
+
+
+def timed(metric: Histogram, *labelvalues) -> Callable:
+    """函式裝飾器：把每次呼叫的耗時記錄到 metric"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                metric.observe(time.perf_counter() - start, *labelvalues)
+        return wrapper
+    return decorator
+
+
+# ========== 快照與輸出 ==========
+
+def snapshot() -> Dict:
+    """本行程所有量測值（可 JSON 序列化）"""
+    with _registry_lock:
+        metrics = list(REGISTRY.values())
+    out = {}
+    for m in metrics:
+        entry = {'type': m.kind, 'help': m.help, 'labelnames': list(m.labelnames), 'series': m._dump()}
+        if m.kind == 'histogram':
+            entry['buckets'] = list(m.buckets)
+        out[m.name] = entry
+    return out
+
+
+def write_snapshot(path: str = METRICS_PATH):
+    """把快照寫到檔案（先寫暫存檔再換名，讀取端不會讀到一半）"""
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'time': time.time(), 'metrics': snapshot()}, f)
+    os.replace(tmp, path)
+
+
+def read_snapshot(path: str = METRICS_PATH, max_age: float = STALE_SEC) -> Optional[Dict]:
+    """讀取其他行程寫出的快照；不存在或過期時回傳 None"""
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - data.get('time', 0) > max_age:
+        return None
+    return data.get('metrics')
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs: List[tuple]) -> str:
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _fmt(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(snapshots: Dict[str, Dict]) -> str:
+    """把 {行程名稱: snapshot()} 合併成 Prometheus 文字格式"""
+    families: Dict[str, list] = {}
+    for process, metrics in snapshots.items():
+        if not metrics:
+            continue
+        for name, entry in metrics.items():
+            families.setdefault(name, []).append((process, entry))
+
+    lines = []
+    for name in sorted(families):
+        first = families[name][0][1]
+        lines.append(f'# HELP {name} {first["help"]}')
+        lines.append(f'# TYPE {name} {first["type"]}')
+        for process, entry in families[name]:
+            for series in entry['series']:
+                base = [('process', process)] + list(zip(entry['labelnames'], series[0]))
+                if entry['type'] == 'histogram':
+                    counts, total = series[1], series[2]
+                    cumulative = 0
+                    for bound, count in zip(entry['buckets'] + [float('inf')], counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{_labels(base + [("le", _fmt(bound))])} {cumulative}')
+                    lines.append(f'{name}_sum{_labels(base)} {_fmt(total)}')
+                    lines.append(f'{name}_count{_labels(base)} {cumulative}')
+                else:
+                    lines.append(f'{name}{_labels(base)} {_fmt(series[1])}')
+    return '\n'.join(lines) + '\n'
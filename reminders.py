@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+智慧飲水系統 - 喝水提醒排程
+
+每個杯墊（hub 上則是每台裝置）只記一個「下次提醒時間」，全部放在一個 heap：
+
+    track(key, 最後飲水時間) ──▶ heap[(到期時間, 世代, key)] ──▶ 到期時呼叫各個 sink
+
+- 排程執行緒只在最早的提醒到期、或排程有變動時醒來，不逐一輪詢；上千個使用者也只有一條執行緒
+- 喝水後 track() 重新排程；舊的 heap 項目以世代編號判斷失效，到期時直接丟棄
+- 提醒間隔讀 settings：remind_interval_min，水壺可用 remind_interval_min:<水壺 ID> 個別設定
+- quiet_hours（例如 22:00-07:00）內到期的提醒延到靜音結束才送出
+- 送出後每隔一個間隔再提醒一次，直到下一次喝水
+
+sink 為 callable(reminder: Dict)，例如 LCD 顯示、webhook、SSE 推播。
+重播模式（虛擬時鐘）不啟動執行緒，由主迴圈呼叫 fire_due(ts)。
+"""
+
+import heapq
+import json
+import threading
+import time
+import urllib.request
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+import database as db
+import metrics
+from acquisition import TaskWorker
+
+DEFAULT_INTERVAL_MIN = 60
+WEBHOOK_TIMEOUT_SEC = 5
+
+REMINDERS_FIRED = metrics.counter(
+    'hydration_reminders_fired_total', '已送出的喝水提醒次數')
+REMINDERS_TRACKED = metrics.gauge(
+    'hydration_reminders_tracked', '排程中的提醒數（杯墊 / 裝置）')
+
+
+# ========== 設定 ==========
+
+def interval_sec(settings: Dict, bottle_id: int = None) -> float:
+    """提醒間隔（秒）：水壺個別設定優先，其次為全域設定"""
+    value = None
+    if bottle_id is not None:
+        value = settings.get(f'remind_interval_min:{bottle_id}')
+    if not value:
+        value = settings.get('remind_interval_min')
+    try:
+        minutes = float(value)
+    except (TypeError, ValueError):
+        minutes = DEFAULT_INTERVAL_MIN
+    return max(1.0, minutes) * 60
+
+
+def parse_quiet_hours(value: Optional[str]) -> Optional[Tuple[int, int]]:
+    """'22:00-07:00' → (開始, 結束) 為一天中的第幾分鐘；空白或格式錯誤時為 None"""
+    if not value:
+        return None
+    try:
+        start, end = value.split('-')
+        h1, m1 = start.strip().split(':')
+        h2, m2 = end.strip().split(':')
+        quiet = (int(h1) * 60 + int(m1), int(h2) * 60 + int(m2))
+    except ValueError:
+        return None
+    if quiet[0] == quiet[1]:
+        return None
+    return quiet
+
+
+def in_quiet(ts: float, quiet: Optional[Tuple[int, int]]) -> bool:
+    """ts 是否落在靜音時段"""
+    if quiet is None:
+        return False
+    start, end = quiet
+    dt = datetime.fromtimestamp(ts)
+    minute = dt.hour * 60 + dt.minute
+    if start < end:
+        return start <= minute < end
+    return minute >= start or minute < end   # 跨午夜
+
+
+def defer_quiet(ts: float, quiet: Optional[Tuple[int, int]]) -> float:
+    """ts 落在靜音時段時延到時段結束，否則原樣回傳"""
+    if not in_quiet(ts, quiet):
+        return ts
+    end = quiet[1]
+    dt = datetime.fromtimestamp(ts)
+    end_dt = dt.replace(hour=end // 60, minute=end % 60, second=0, microsecond=0)
+    if end_dt <= dt:
+        end_dt += timedelta(days=1)
+    return end_dt.timestamp()
+
+
+# ========== 排程 ==========
+
+class ReminderScheduler:
+    """以 heap 管理每個 key 的下次提醒時間；到期時依序呼叫 sinks"""
+
+    def __init__(self, sinks: List[Callable[[Dict], None]] = None,
+                 clock: Callable[[], float] = time.time,
+                 load_settings: Callable[[], Dict] = db.get_all_settings):
+        self.sinks = list(sinks or [])
+        self.clock = clock
+        self.load_settings = load_settings
+        self.fired = 0
+        self._heap: List[tuple] = []
+        self._entries: Dict[str, Dict] = {}
+        self._gen = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._settings = load_settings()
+        self._quiet = parse_quiet_hours(self._settings.get('quiet_hours'))
+
+    def add_sink(self, sink: Callable[[Dict], None]):
+        self.sinks.append(sink)
+
+    # ----- 排程 -----
+
+    def _schedule(self, key: str, entry: Dict, due: float):
+        """(呼叫端持有鎖) 設定下次提醒時間並放入 heap"""
+        self._gen += 1
+        entry['gen'] = self._gen
+        entry['due'] = defer_quiet(due, self._quiet)
+        heapq.heappush(self._heap, (entry['due'], self._gen, key))
+
+    def track(self, key: str, last_drink_ts: float, bottle_id: int = None):
+        """開始追蹤 key，或在喝水後重新排程（last_drink_ts 為最後飲水時間）"""
+        with self._cond:
+            entry = self._entries.get(key)
+            if entry is not None and last_drink_ts < entry['last_drink_ts']:
+                return   # 較舊的事件（例如補傳）不影響排程
+            entry = {'last_drink_ts': last_drink_ts, 'bottle_id': bottle_id, 'count': 0}
+            self._entries[key] = entry
+            self._schedule(key, entry, last_drink_ts + interval_sec(self._settings, bottle_id))
+            REMINDERS_TRACKED.set(len(self._entries))
+            self._cond.notify()
+
+    def untrack(self, key: str):
+        with self._cond:
+            self._entries.pop(key, None)
+            REMINDERS_TRACKED.set(len(self._entries))
+
+    def tracking(self, key: str) -> bool:
+        with self._cond:
+            return key in self._entries
+
+    def reload(self, settings: Dict = None):
+        """設定變更（間隔、靜音時段）後重新計算所有 key 的下次提醒時間"""
+        with self._cond:
+            self._settings = settings if settings is not None else self.load_settings()
+            self._quiet = parse_quiet_hours(self._settings.get('quiet_hours'))
+            self._heap = []
+            for key, entry in self._entries.items():
+                interval = interval_sec(self._settings, entry['bottle_id'])
+                self._schedule(key, entry, entry['last_drink_ts'] + interval * (entry['count'] + 1))
+            heapq.heapify(self._heap)
+            self._cond.notify()
+
+    def quiet(self, ts: float) -> bool:
+        """ts 是否在目前設定的靜音時段內（顯示中的提醒要在靜音開始時清除）"""
+        return in_quiet(ts, self._quiet)
+
+    def next_due(self) -> Optional[float]:
+        """最早的提醒時間（略過已失效的 heap 項目）"""
+        with self._cond:
+            return self._peek()
+
+    def _peek(self) -> Optional[float]:
+        heap = self._heap
+        while heap:
+            due, gen, key = heap[0]
+            entry = self._entries.get(key)
+            if entry is not None and entry['gen'] == gen:
+                return due
+            heapq.heappop(heap)
+        return None
+
+    def fire_due(self, now: float = None) -> List[Dict]:
+        """送出所有已到期的提醒，回傳送出的提醒"""
+        now = self.clock() if now is None else now
+        fired = []
+        with self._cond:
+            while True:
+                due = self._peek()
+                if due is None or due > now:
+                    break
+                _, _, key = heapq.heappop(self._heap)
+                entry = self._entries[key]
+                entry['count'] += 1
+                interval = interval_sec(self._settings, entry['bottle_id'])
+                fired.append({
+                    'key': key,
+                    'due': due,
+                    'count': entry['count'],
+                    'minutes_since_drink': int((now - entry['last_drink_ts']) / 60),
+                    'bottle_id': entry['bottle_id'],
+                })
+                # 還沒喝水就每隔一個間隔再提醒一次
+                self._schedule(key, entry, max(due, now) + interval)
+        for reminder in fired:
+            self.fired += 1
+            for sink in self.sinks:
+                try:
+                    sink(reminder)
+                except Exception as e:
+                    print(f"提醒送出失敗: {e}")
+        if fired:
+            REMINDERS_FIRED.inc(len(fired))
+        return fired
+
+    # ----- 執行緒 -----
+
+    def start(self):
+        """啟動排程執行緒：睡到最早的提醒到期，track() / reload() 時提早醒來重算"""
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='reminders', daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: float = 2.0):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    due = self._peek()
+                    wait = None if due is None else due - self.clock()
+                    if wait is not None and wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                if self._stopping:
+                    return
+            self.fire_due()
+
+
+# ========== Sink ==========
+
+def print_sink(reminder: Dict):
+    """在終端機印出提醒"""
+    print(f"  💧 [{reminder['key']}] 已經 {reminder['minutes_since_drink']} 分鐘沒有喝水了")
+
+
+class WebhookSink:
+    """把提醒以 JSON POST 到指定網址（例如本機的通知服務）；在背景執行緒送出，不拖慢排程"""
+
+    def __init__(self, url: str, timeout: float = WEBHOOK_TIMEOUT_SEC):
+        self.url = url
+        self.timeout = timeout
+        self.errors = 0
+        self._worker = TaskWorker(name='reminder-webhook')
+        self._worker.start()
+
+    def __call__(self, reminder: Dict):
+        self._worker.submit(self._post, reminder)
+
+    def _post(self, reminder: Dict):
+        body = json.dumps({'event': 'reminder', **reminder}, ensure_ascii=False).encode('utf-8')
+        req = urllib.request.Request(self.url, data=body, method='POST')
+        req.add_header('Content-Type', 'application/json')
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                resp.read()
+        except OSError as e:
+            self.errors += 1
+            print(f"提醒 webhook 失敗: {e}")
+
+    def stop(self):
+        self._worker.stop()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+智慧飲水系統 - 離線重新推導飲水事件
+
+調整 EMA / 拿起 / 穩定 / 飲水門檻後，用 traces/ 中記錄的重量軌跡重新推導歷史飲水事件。
+每一天的軌跡由一個工作行程處理，偵測規則與 detector.DrinkDetector 相同，
+但除了本質上是遞迴的 EMA 之外，其餘步驟都以 NumPy 向量化處理整天的資料。
+
+結果寫入 drink_events_staging（依 run_id 區分），並與 drink_events 的每日彙總比較：
+
+    python3 reprocess.py --empty-g 150 --drink-min-ml 20
+    python3 reprocess.py --from 2024-01-01 --to 2024-01-31 --verify
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import database as db
+import detector
+import weight_trace
+
+TRACE_DTYPE = np.dtype([('ts', '<f8'), ('grams', '<f4'), ('ema', '<f4')])
+
+DEFAULT_PARAMS = {
+    'drink_min_ml': detector.DRINK_EVENT_MIN_ML,
+    'lift_drop_g': detector.LIFT_DROP_G,
+    'lift_min_present_g': detector.LIFT_MIN_PRESENT_G,
+    'stable_var_g': detector.STABLE_VAR_G,
+    'window': detector.STABLE_WINDOW,
+    'ema_fast_change_g': detector.EMA_FAST_CHANGE_G,
+    'ema_mid_change_g': detector.EMA_MID_CHANGE_G,
+    'ema_fast_alpha': detector.EMA_FAST_ALPHA,
+    'ema_mid_alpha': detector.EMA_MID_ALPHA,
+    'ema_slow_alpha': detector.EMA_SLOW_ALPHA,
+}
+
+
+def load_day(day: str, trace_dir: str = weight_trace.TRACE_DIR) -> np.ndarray:
+    """把一天的軌跡檔讀成結構化陣列"""
+    path = weight_trace.trace_path(day, trace_dir)
+    size = os.path.getsize(path)
+    return np.fromfile(path, dtype=TRACE_DTYPE, count=size // TRACE_DTYPE.itemsize)
+
+
+def adaptive_ema(grams: np.ndarray, p: Dict) -> np.ndarray:
+    """自適應 EMA；每一筆都依賴前一筆結果，只能循序計算"""
+    out = np.empty(len(grams), dtype=np.float64)
+    if not len(grams):
+        return out
+    fast, mid = p['ema_fast_change_g'], p['ema_mid_change_g']
+    a_fast, a_mid, a_slow = p['ema_fast_alpha'], p['ema_mid_alpha'], p['ema_slow_alpha']
+    values = grams.tolist()
+    ema = values[0]
+    out_list = [ema]
+    append = out_list.append
+    for g in values[1:]:
+        change = abs(g - ema)
+        alpha = a_fast if change > fast else (a_mid if change > mid else a_slow)
+        ema = alpha * g + (1 - alpha) * ema
+        append(ema)
+    out[:] = out_list
+    return out
+
+
+def detect(grams: np.ndarray, empty_g: float, p: Dict) -> List[Tuple[int, int]]:
+    """向量化的飲水偵測，回傳 [(樣本索引, 飲水量 ml)]"""
+    n = len(grams)
+    if n == 0:
+        return []
+    ema = adaptive_ema(grams.astype(np.float64), p)
+
+    # 最近 window 筆的最小 / 最大值；開頭不足一個視窗時以第一筆補齊（不影響結果）
+    window = p['window']
+    padded = np.concatenate([np.full(window - 1, ema[0]), ema])
+    view = np.lib.stride_tricks.sliding_window_view(padded, window)
+    g_var = view.max(axis=1) - view.min(axis=1)
+
+    drop_from_prev = np.zeros(n, dtype=bool)
+    drop_from_prev[1:] = (ema[:-1] - ema[1:]) > p['lift_drop_g']
+    lifting = (ema < p['lift_min_present_g']) | drop_from_prev
+
+    water_g = ema - empty_g
+    water_ml = np.where(water_g > 0, np.round(water_g), 0).astype(np.int64)
+    stable = ~lifting & (g_var <= p['stable_var_g'])
+
+    # 每個穩定樣本都會更新 last_stable_ml，所以只要比較相鄰兩個穩定樣本
+    idx = np.flatnonzero(stable & (water_ml > 0))
+    if len(idx) < 2:
+        return []
+    levels = water_ml[idx]
+    drops = levels[:-1] - levels[1:]
+    hits = np.flatnonzero(drops >= p['drink_min_ml'])
+    return list(zip(idx[hits + 1].tolist(), drops[hits].tolist()))
+
+
+def process_day(day: str, empty_g: float, params: Dict, trace_dir: str, verify: bool) -> Dict:
+    """工作行程：處理一天的軌跡"""
+    started = time.perf_counter()
+    data = load_day(day, trace_dir)
+    events = detect(data['grams'], empty_g, params)
+    result = {
+        'day': day,
+        'samples': len(data),
+        'events': [(float(data['ts'][i]), int(ml)) for i, ml in events],
+        'elapsed': time.perf_counter() - started,
+    }
+    if verify:
+        d = detector.DrinkDetector(
+            empty_g,
+            drink_min_ml=params['drink_min_ml'],
+            lift_drop_g=params['lift_drop_g'],
+            lift_min_present_g=params['lift_min_present_g'],
+            stable_var_g=params['stable_var_g'],
+            window=params['window'],
+        )
+        result['verified'] = d.feed_many(data['grams'].astype(np.float64).tolist()) == events
+    return result
+
+
+def run(days: List[str], empty_g: float, params: Dict, trace_dir: str = weight_trace.TRACE_DIR,
+        workers: int = None, verify: bool = False) -> List[Dict]:
+    """以行程池平行處理多天的軌跡"""
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(process_day, day, empty_g, params, trace_dir, verify) for day in days]
+        return [f.result() for f in futures]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--from', dest='start', help="起始日期 YYYY-MM-DD")
+    parser.add_argument('--to', dest='end', help="結束日期 YYYY-MM-DD（含）")
+    parser.add_argument('--trace-dir', default=weight_trace.TRACE_DIR)
+    parser.add_argument('--empty-g', type=float, default=None, help="空壺重量（預設為目前使用中的水壺）")
+    parser.add_argument('--bottle-id', type=int, default=None, help="寫入 staging 的水壺 ID")
+    parser.add_argument('--workers', type=int, default=None, help="工作行程數（預設為 CPU 核心數）")
+    parser.add_argument('--run-id', default=None, help="staging 批次名稱（預設為目前時間）")
+    parser.add_argument('--verify', action='store_true', help="同時以 DrinkDetector 逐筆驗證結果一致")
+    for key, value in DEFAULT_PARAMS.items():
+        parser.add_argument('--' + key.replace('_', '-'), type=type(value), default=value)
+    args = parser.parse_args()
+
+    params = {key: getattr(args, key) for key in DEFAULT_PARAMS}
+    days = [d for d in weight_trace.trace_days(args.trace_dir)
+            if (not args.start or d >= args.start) and (not args.end or d <= args.end)]
+    if not days:
+        print("沒有符合條件的重量軌跡")
+        return
+
+    db.init_database()
+    empty_g = args.empty_g
+    bottle_id = args.bottle_id
+    if empty_g is None:
+        bottle = db.get_active_bottle()
+        if not bottle:
+            raise SystemExit("沒有使用中的水壺，請指定 --empty-g")
+        empty_g = bottle['empty_weight']
+        bottle_id = bottle_id or bottle['id']
+
+    run_id = args.run_id or datetime.now().strftime('%Y%m%d_%H%M%S')
+    started = time.perf_counter()
+    results = run(days, empty_g, params, args.trace_dir, args.workers, args.verify)
+    elapsed = time.perf_counter() - started
+
+    events = [(ts, ml) for r in results for ts, ml in r['events']]
+    db.replace_staging_events(run_id, bottle_id, events, params)
+
+    samples = sum(r['samples'] for r in results)
+    print(f"處理 {len(days)} 天、{samples:,} 筆樣本，耗時 {elapsed:.2f} s（{samples / max(elapsed, 1e-9):,.0f} 樣本/秒）")
+    print(f"staging run_id = {run_id}\n")
+    print(f"{'日期':<12}{'原記錄':>14}{'重新推導':>14}{'差異':>10}")
+    for row in db.compare_staging(run_id, days[0], days[-1]):
+        diff = row['staged_ml'] - row['recorded_ml']
+        print(f"{row['date']:<12}{row['recorded_count']:>5} 次 {row['recorded_ml']:>5} ml"
+              f"{row['staged_count']:>5} 次 {row['staged_ml']:>5} ml{diff:>+8} ml")
+
+    if args.verify:
+        bad = [r['day'] for r in results if not r.get('verified')]
+        print("\n✓ 與 DrinkDetector 結果一致" if not bad else f"\n✗ 與 DrinkDetector 不一致：{', '.join(bad)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+智慧飲水系統 - 正式環境的 Web Server
+
+    python3 serve.py [--host 0.0.0.0] [--port 5000] [--threads 16]
+
+`python3 app.py` 是開發模式（單一執行緒的 debug server、自動重新載入）。
+這裡改用多執行緒的 WSGI server：有安裝 waitress 時使用 waitress，
+否則使用 werkzeug 內建的多執行緒 server（關閉 debug 與 reloader）。
+
+SSE（/api/stream）每個開啟的頁面會佔用一條執行緒，--threads 需大於同時開啟的頁面數。
+需要多行程時也可以直接用 gunicorn（每個 worker 在第一個請求前各自初始化資料庫）：
+
+    gunicorn -w 4 -k gthread --threads 8 -b 0.0.0.0:5000 app:app
+"""
+
+import argparse
+
+try:
+    import waitress
+except ImportError:   # waitress 為選用套件
+    waitress = None
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import app as webapp
+
+DEFAULT_THREADS = 16
+
+
+class _RequestHandler(WSGIRequestHandler):
+    """keep-alive（HTTP/1.1），且不逐筆印出請求記錄（在 SD 卡上的終端機輸出也有成本）"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_request(self, code='-', size='-'):
+        pass
+
+
+def create_server(host: str, port: int, threads: int = DEFAULT_THREADS):
+    """建立 server（尚未開始服務），回傳 (server, 名稱)；server 有 run() 與 close()"""
+    webapp.init_app_database()
+    if waitress is not None:
+        server = waitress.create_server(webapp.app, host=host, port=port, threads=threads)
+        return server, 'waitress'
+    server = make_server(host, port, webapp.app, threaded=True, request_handler=_RequestHandler)
+    server.run = server.serve_forever
+    server.close = server.shutdown
+    return server, 'werkzeug'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="智慧飲水系統 Web Server（正式環境）")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS, help="處理請求的執行緒數（waitress）")
+    args = parser.parse_args()
+
+    server, name = create_server(args.host, args.port, args.threads)
+    print(f"智慧飲水系統 Web Dashboard：http://{args.host}:{args.port}（{name}），按 Ctrl+C 停止")
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
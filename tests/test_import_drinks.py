@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""database.import_drinks 的資料檢查（python -m pytest tests 或 python -m unittest discover tests）"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import database as db
+
+
+class ImportDrinksTest(unittest.TestCase):
+
+    def setUp(self):
+        self._old_path = db.DB_PATH
+        self._tmp = tempfile.TemporaryDirectory()
+        db.DB_PATH = os.path.join(self._tmp.name, 'test.db')
+        db.init_database()
+
+    def tearDown(self):
+        db.close_connections()
+        db.DB_PATH = self._old_path
+        self._tmp.cleanup()
+
+    def _daily_total(self, date: str) -> int:
+        with db._connection() as conn:
+            row = conn.execute('SELECT total_ml FROM daily_totals WHERE date = ?', (date,)).fetchone()
+        return row[0] if row else 0
+
+    def test_import_valid_rows(self):
+        result = db.import_drinks([
+            {'timestamp': '2024-01-01 08:00:00', 'amount_ml': '150'},
+            {'timestamp': '2024-01-01T09:30:00', 'amount_ml': 42},
+        ])
+        self.assertEqual(result, {'rows': 2, 'inserted': 2, 'skipped': 0})
+        self.assertEqual(self._daily_total('2024-01-01'), 192)
+
+    def test_reject_non_positive_amount(self):
+        db.import_drinks([{'timestamp': '2024-01-01 08:00:00', 'amount_ml': 192}])
+        for amount in (0, -100):
+            with self.assertRaisesRegex(ValueError, '第 2 筆格式錯誤'):
+                db.import_drinks([
+                    {'timestamp': '2024-01-01 09:00:00', 'amount_ml': 50},
+                    {'timestamp': '2024-01-01 10:00:00', 'amount_ml': amount},
+                ])
+        # 整批在同一個交易中：有錯誤時前面的記錄也不寫入
+        self.assertEqual(self._daily_total('2024-01-01'), 192)
+
+
+if __name__ == '__main__':
+    unittest.main()
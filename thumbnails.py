@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+智慧飲水系統 - 水壺照片與縮圖
+
+上傳的照片以內容雜湊命名（相同照片只存一份），縮圖由背景執行緒產生：
+
+    static/media/3f9a0c1b2d4e5f60.jpg        原圖
+    static/media/3f9a0c1b2d4e5f60_160.jpg    縮圖（寬 160 / 320 / 640）
+
+檔名由內容決定，內容不會再變，所以 /media 可以用 immutable 快取。
+縮圖需要 Pillow；沒有安裝時（或縮圖還沒產生好）縮圖網址會直接回原圖。
+"""
+
+import hashlib
+import os
+import threading
+from typing import Dict, Optional
+
+from acquisition import TaskWorker
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:   # Pillow 為選用套件
+    Image = None
+
+MEDIA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'media')
+THUMB_WIDTHS = (160, 320, 640)
+THUMB_QUALITY = 82
+ALLOWED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+DIGEST_LEN = 16
+
+_worker: Optional[TaskWorker] = None
+_worker_lock = threading.Lock()
+
+
+def _get_worker() -> TaskWorker:
+    """縮圖背景執行緒（第一次上傳時才建立）"""
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = TaskWorker(name='thumbnails')
+            _worker.start()
+        return _worker
+
+
+def save_upload(file) -> str:
+    """儲存上傳的照片（werkzeug FileStorage），回傳存入資料庫的 photo_path；縮圖交給背景執行緒"""
+    ext = os.path.splitext(file.filename or '')[1].lower()
+    if ext not in ALLOWED_EXTENSIONS:
+        raise ValueError(f'不支援的圖片格式: {ext or "(無副檔名)"}')
+    data = file.read()
+    digest = hashlib.sha256(data).hexdigest()[:DIGEST_LEN]
+    name = digest + ext
+    path = os.path.join(MEDIA_DIR, name)
+    if not os.path.exists(path):
+        os.makedirs(MEDIA_DIR, exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    if Image is not None:
+        _get_worker().submit(make_thumbnails, path)
+    return f'media/{name}'
+
+
+def make_thumbnails(path: str):
+    """產生各尺寸縮圖（已存在的略過）"""
+    digest = os.path.splitext(os.path.basename(path))[0]
+    todo = [w for w in THUMB_WIDTHS if not os.path.exists(_thumb_path(digest, w))]
+    if not todo:
+        return
+    with Image.open(path) as im:
+        im = ImageOps.exif_transpose(im).convert('RGB')
+        for width in todo:
+            thumb = im.copy()
+            thumb.thumbnail((width, width * 4))
+            out = _thumb_path(digest, width)
+            tmp = f'{out}.{os.getpid()}.{threading.get_ident()}.tmp'
+            thumb.save(tmp, 'JPEG', quality=THUMB_QUALITY, optimize=True)
+            os.replace(tmp, out)
+
+
+def _thumb_path(digest: str, width: int) -> str:
+    return os.path.join(MEDIA_DIR, f'{digest}_{width}.jpg')
+
+
+def find_original(digest: str) -> Optional[str]:
+    """由雜湊找出原圖檔名"""
+    for ext in ALLOWED_EXTENSIONS:
+        name = digest + ext
+        if os.path.exists(os.path.join(MEDIA_DIR, name)):
+            return name
+    return None
+
+
+def photo_urls(photo_path: Optional[str]) -> Optional[Dict]:
+    """水壺照片的網址：{'original': url, 'thumbs': {寬度: url}}；沒有照片時回傳 None"""
+    if not photo_path:
+        return None
+    if not photo_path.startswith('media/'):
+        # 舊版直接存在 static/uploads 的照片，沒有縮圖
+        return {'original': f'/static/{photo_path}', 'thumbs': {}}
+    digest = os.path.splitext(os.path.basename(photo_path))[0]
+    return {
+        'original': f'/{photo_path}',
+        'thumbs': {w: f'/media/{digest}_{w}.jpg' for w in THUMB_WIDTHS},
+    }
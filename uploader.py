@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+智慧飲水系統 - 上傳到 hub
+
+每個杯墊自己的 hydration.db 就是本機緩衝：Uploader 定期把尚未上傳的飲水記錄
+連同最新狀態整批 gzip 後 POST 到 hub 的 /api/ingest：
+
+    drink_events (本機) ──Uploader──▶ POST /api/ingest ──▶ drink_events (hub)
+
+- 含事件的批次有遞增的序號 seq；hub 以 event_uid 去除重複的事件，seq 只用來判斷整批重送。
+  hub_upload.json 遺失而序號重新開始時，依 hub 回覆的 last_seq 接續編號
+  只有狀態的批次 seq 為 0，不寫本機檔案（SD 卡每 5 秒一次 fsync 太多）
+- 送出前先把這一批的範圍寫入 hub_upload.json；沒收到回應時以相同 seq 與範圍重送，
+  因此 hub 已經寫入、只是回應遺失的批次不會重複，也不會漏掉之後的事件
+- 網路中斷時事件留在本機資料庫，恢復後依序補傳（指數退避）
+
+    python3 uploader.py --hub http://hub.local:5000 [--device-id desk-3]
+"""
+
+import argparse
+import gzip
+import json
+import os
+import socket
+import threading
+import urllib.request
+from typing import Dict, Optional, Tuple
+
+import database as db
+from live_status import LiveStatusReader
+
+STATE_NAME = 'hub_upload.json'
+UPLOAD_SEC = 5.0              # 上傳週期（沒有新事件時也會送出狀態）
+BATCH_MAX_EVENTS = 500        # 每批最多的事件數；積欠較多時連續送出
+HTTP_TIMEOUT_SEC = 10
+RETRY_MIN_SEC = 1.0           # 上傳失敗後的重試間隔（指數退避）
+RETRY_MAX_SEC = 300.0
+STATUS_FIELDS = ('water_ml', 'status', 'last_drink_minutes', 'today_total_ml')
+
+
+def default_state_path() -> str:
+    """上傳進度與資料庫放在同一個資料夾"""
+    return os.path.join(os.path.dirname(os.path.abspath(db.DB_PATH)), STATE_NAME)
+
+
+class Uploader(threading.Thread):
+    """背景執行緒：把本機飲水記錄與狀態分批上傳到 hub"""
+
+    def __init__(self, hub_url: str, device_id: str = None, token: str = None,
+                 interval: float = UPLOAD_SEC, state_path: str = None):
+        super().__init__(name='hub-uploader', daemon=True)
+        self.url = hub_url.rstrip('/') + '/api/ingest'
+        self.device_id = device_id or socket.gethostname()
+        self.token = token
+        self.interval = interval
+        self.state_path = state_path or default_state_path()
+        self.live = LiveStatusReader()
+        self.sent = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self._stop_event = threading.Event()
+
+    # ----- 上傳進度 -----
+
+    def load_state(self) -> Dict:
+        """{'seq': 已確認的序號, 'last_id': 已上傳到的 id, 'pending': 送出但未確認的批次}"""
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'seq': 0, 'last_id': 0, 'pending': None}
+
+    def _save_state(self, state: Dict):
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.state_path)
+
+    # ----- 上傳 -----
+
+    def build_batch(self, state: Dict) -> Tuple[Dict, Dict]:
+        """組出下一批（有未確認的批次時以相同 seq 與範圍重組），回傳 (payload, pending)；
+        沒有事件時 pending 為 None"""
+        pending = state.get('pending')
+        rows = db.get_drinks_since(state['last_id'], BATCH_MAX_EVENTS)
+        if pending:
+            rows = [r for r in rows if r['id'] <= pending['end_id']]
+        elif rows:
+            pending = {'seq': state['seq'] + 1, 'end_id': rows[-1]['id']}
+        status = self.live.read() or db.get_current_status()
+        payload = {
+            'device_id': self.device_id,
+            'seq': pending['seq'] if pending else 0,
+            'events': [
+                {
+                    # 網頁手動新增或匯入的記錄沒有 event_uid，用裝置與 id 組成
+                    'uid': r['event_uid'] or f"{self.device_id}-{r['id']}",
+                    'timestamp': r['timestamp'],
+                    'amount_ml': r['amount_ml'],
+                    'coaster_id': r['coaster_id'],
+                }
+                for r in rows
+            ],
+            'status': {k: status.get(k) for k in STATUS_FIELDS},
+        }
+        return payload, pending
+
+    def _post(self, payload: Dict) -> Dict:
+        body = gzip.compress(json.dumps(payload, ensure_ascii=False).encode('utf-8'))
+        req = urllib.request.Request(self.url, data=body, method='POST')
+        req.add_header('Content-Type', 'application/json')
+        req.add_header('Content-Encoding', 'gzip')
+        if self.token:
+            req.add_header('Authorization', f'Bearer {self.token}')
+        with urllib.request.urlopen(req, timeout=HTTP_TIMEOUT_SEC) as resp:
+            result = json.loads(resp.read())
+        if not result.get('success'):
+            raise ValueError(result.get('error') or 'hub 拒絕了這一批')
+        return result
+
+    def upload_once(self) -> int:
+        """送出一批，回傳事件數；失敗時拋出例外（進度不變，下次以相同 seq 重送）"""
+        state = self.load_state()
+        payload, pending = self.build_batch(state)
+        if pending and state.get('pending') != pending:
+            state['pending'] = pending
+            self._save_state(state)
+        result = self._post(payload)
+        if pending:
+            # hub 已寫入（以 event_uid 去重）這一批；序號落後 hub 時（進度檔遺失）接續 hub 的序號
+            seq = max(pending['seq'], int(result.get('last_seq') or 0))
+            self._save_state({'seq': seq, 'last_id': pending['end_id'], 'pending': None})
+        self.sent += len(payload['events'])
+        return len(payload['events'])
+
+    def stop(self, timeout: float = HTTP_TIMEOUT_SEC + 1):
+        self._stop_event.set()
+        self.join(timeout)
+
+    def run(self):
+        delay = RETRY_MIN_SEC
+        while not self._stop_event.is_set():
+            try:
+                count = self.upload_once()
+            except Exception as e:
+                # 連線 / HTTP 錯誤（OSError、http.client.HTTPException）、hub 拒絕或本機資料庫忙碌：
+                # 事件還在本機資料庫，稍後重送；任何錯誤都不能讓上傳執行緒結束
+                self.failures += 1
+                self.last_error = str(e)
+                print(f"  ✗ 上傳到 hub 失敗，{delay:.0f} 秒後重試: {e}")
+                self._stop_event.wait(delay)
+                delay = min(delay * 2, RETRY_MAX_SEC)
+                continue
+            delay = RETRY_MIN_SEC
+            if count < BATCH_MAX_EVENTS:
+                self._stop_event.wait(self.interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="把本機飲水記錄上傳到 hub")
+    parser.add_argument('--hub', required=True, help="hub 的網址，例如 http://hub.local:5000")
+    parser.add_argument('--device-id', default=None, help="裝置 ID（預設為主機名稱）")
+    parser.add_argument('--token', default=os.environ.get('HYDRATION_HUB_TOKEN'),
+                        help="hub 的上傳權杖（預設讀取 HYDRATION_HUB_TOKEN）")
+    parser.add_argument('--interval', type=float, default=UPLOAD_SEC, help="上傳週期（秒）")
+    args = parser.parse_args()
+
+    db.init_database()
+    uploader = Uploader(args.hub, args.device_id, args.token, args.interval)
+    print(f"上傳到 {uploader.url}（裝置 {uploader.device_id}），按 Ctrl+C 停止")
+    uploader.start()
+    try:
+        while uploader.is_alive():
+            uploader.join(1)
+    except KeyboardInterrupt:
+        uploader.stop()
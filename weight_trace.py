@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+智慧飲水系統 - 重量原始軌跡記錄
+
+main.py 每個迴圈的重量樣本先寫入記憶體中的環形緩衝區，
+累積一批後再一次附加到每日一個的二進位檔（traces/YYYY-MM-DD.bin）。
+
+每筆記錄固定 16 bytes（little-endian）：
+    ts(d)  取樣時間（epoch 秒）
+    grams(f)  換算後的原始重量
+    ema_g(f)  EMA 濾波後的重量
+
+檔案只會附加、時間遞增，因此可以直接二分搜尋時間範圍。
+"""
+
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+TRACE_DIR = os.path.join(os.path.dirname(__file__), 'traces')
+
+RING_CAPACITY = 2048   # 記憶體中最多保留的樣本數
+FLUSH_SAMPLES = 256    # 累積多少筆就寫入檔案
+FLUSH_SEC = 10         # 或距上次寫入超過幾秒
+
+RECORD = struct.Struct('<dff')
+
+
+def trace_path(day: str, trace_dir: str = TRACE_DIR) -> str:
+    """取得某一天（YYYY-MM-DD）的軌跡檔路徑"""
+    return os.path.join(trace_dir, f'{day}.bin')
+
+
+def trace_days(trace_dir: str = TRACE_DIR) -> List[str]:
+    """列出已有軌跡檔的日期（由舊到新）"""
+    try:
+        names = os.listdir(trace_dir)
+    except FileNotFoundError:
+        return []
+    return sorted(name[:-4] for name in names if name.endswith('.bin'))
+
+
+def _day_of(ts: float) -> str:
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d')
+
+
+class WeightRecorder:
+    """以 array 實作的環形緩衝區，分批寫入附加式軌跡檔"""
+
+    def __init__(self, trace_dir: str = TRACE_DIR, capacity: int = RING_CAPACITY,
+                 flush_samples: int = FLUSH_SAMPLES, flush_sec: float = FLUSH_SEC,
+                 auto_flush: bool = True):
+        self.trace_dir = trace_dir
+        self.auto_flush = auto_flush
+        self.capacity = capacity
+        self.flush_samples = min(flush_samples, capacity)
+        self.flush_sec = flush_sec
+
+        self._ts = array('d', bytes(8 * capacity))
+        self._grams = array('f', bytes(4 * capacity))
+        self._ema = array('f', bytes(4 * capacity))
+        self._written = 0   # 累計寫入緩衝區的筆數
+        self._flushed = 0   # 累計已寫入檔案的筆數
+        self._last_flush = time.monotonic()
+        self.dropped = 0    # 來不及寫入而被覆蓋的筆數
+        self._lock = threading.Lock()
+
+        os.makedirs(trace_dir, exist_ok=True)
+
+    def append(self, ts: float, grams: float, ema_g: float):
+        """加入一筆樣本；auto_flush 時達到批次大小或時間間隔就寫入檔案"""
+        with self._lock:
+            i = self._written % self.capacity
+            self._ts[i] = ts
+            self._grams[i] = grams
+            self._ema[i] = ema_g
+            self._written += 1
+
+            if self._written - self._flushed > self.capacity:
+                # 緩衝區滿了仍未寫出：捨棄最舊的樣本
+                self.dropped += self._written - self._flushed - self.capacity
+                self._flushed = self._written - self.capacity
+
+        if self.auto_flush and self.flush_due():
+            self.flush()
+
+    def flush_due(self) -> bool:
+        """是否達到寫入檔案的批次大小或時間間隔"""
+        return self.pending() >= self.flush_samples or time.monotonic() - self._last_flush >= self.flush_sec
+
+    def pending(self) -> int:
+        return self._written - self._flushed
+
+    def recent(self, n: int) -> List[Tuple[float, float, float]]:
+        """取得最近 n 筆樣本（不論是否已寫入檔案）"""
+        with self._lock:
+            n = min(n, self._written, self.capacity)
+            out = []
+            for k in range(self._written - n, self._written):
+                i = k % self.capacity
+                out.append((self._ts[i], self._grams[i], self._ema[i]))
+        return out
+
+    def flush(self):
+        """把尚未寫出的樣本附加到對應日期的軌跡檔（可在其他執行緒呼叫）"""
+        self._last_flush = time.monotonic()
+        with self._lock:
+            start, end = self._flushed, self._written
+            if start == end:
+                return
+            records = []
+            for k in range(start, end):
+                i = k % self.capacity
+                records.append((self._ts[i], self._grams[i], self._ema[i]))
+            self._flushed = end
+
+        # 檔案 I/O 不持有鎖，不會擋住 append()
+        chunk = bytearray()
+        day = None
+        for ts, grams, ema_g in records:
+            d = _day_of(ts)
+            if day is not None and d != day:
+                self._write(day, chunk)
+                chunk = bytearray()
+            day = d
+            chunk += RECORD.pack(ts, grams, ema_g)
+        self._write(day, chunk)
+
+    def _write(self, day: str, data: bytes):
+        with open(trace_path(day, self.trace_dir), 'ab') as f:
+            f.write(data)
+
+    def close(self):
+        self.flush()
+
+
+# ========== 讀取 ==========
+
+def _bisect(mm, n: int, ts: float) -> int:
+    """在 n 筆記錄中找出第一筆時間 >= ts 的索引"""
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if RECORD.unpack_from(mm, mid * RECORD.size)[0] < ts:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def read_range(start_ts: float, end_ts: float, trace_dir: str = TRACE_DIR) -> Dict[str, array]:
+    """讀取 [start_ts, end_ts) 之間的樣本，回傳 ts / grams / ema 三個欄位陣列"""
+    out = {'ts': array('d'), 'grams': array('d'), 'ema': array('d')}
+    if end_ts <= start_ts:
+        return out
+
+    first_day = _day_of(start_ts)
+    last_day = _day_of(end_ts)
+    for day in trace_days(trace_dir):
+        if not first_day <= day <= last_day:
+            continue
+        path = trace_path(day, trace_dir)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            continue
+        n = size // RECORD.size
+        if n == 0:
+            continue
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), n * RECORD.size, access=mmap.ACCESS_READ) as mm:
+            lo = _bisect(mm, n, start_ts)
+            hi = _bisect(mm, n, end_ts)
+            for ts, grams, ema_g in RECORD.iter_unpack(mm[lo * RECORD.size:hi * RECORD.size]):
+                out['ts'].append(ts)
+                out['grams'].append(grams)
+                out['ema'].append(ema_g)
+    return out
+
+
+# ========== 降採樣 ==========
+
+def lttb(xs, ys, threshold: int) -> List[int]:
+    """Largest-Triangle-Three-Buckets 降採樣，回傳被選中的樣本索引"""
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+
+    selected = [0]
+    bucket = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # 下一個桶的平均點
+        nxt_start = int((i + 1) * bucket) + 1
+        nxt_end = min(int((i + 2) * bucket) + 1, n)
+        span = nxt_end - nxt_start
+        avg_x = sum(xs[nxt_start:nxt_end]) / span
+        avg_y = sum(ys[nxt_start:nxt_end]) / span
+
+        # 目前桶中與前一點、下一桶平均點構成最大三角形的點
+        start = int(i * bucket) + 1
+        end = int((i + 1) * bucket) + 1
+        ax, ay = xs[a], ys[a]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+        a = best
+
+    selected.append(n - 1)
+    return selected
+
+
+def downsample_range(start_ts: float, end_ts: float, points: int,
+                     series: str = 'grams', trace_dir: str = TRACE_DIR) -> Dict:
+    """讀取時間範圍並以 LTTB 降採樣到最多 points 點"""
+    data = read_range(start_ts, end_ts, trace_dir)
+    idx = lttb(data['ts'], data[series], points)
+    return {
+        'raw_count': len(data['ts']),
+        'points': [
+            [round(data['ts'][i], 3), round(data['grams'][i], 1), round(data['ema'][i], 1)]
+            for i in idx
+        ],
+    }